@@ -0,0 +1,217 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Builds of a matrix affected by the changes since a git reference.
+
+A build is affected when:
+
+* the code of the builder or the packaging of the project changed,
+* a file of an element it uses, directly or through element-deps, changed,
+* its compiled configuration (elements, packages and environment) is not the
+  same with the config.yaml files of the reference,
+* its definition in the matrix file changed or is new.
+'''
+
+import argparse
+import json
+from os import path
+import subprocess
+
+from typing import Dict, List, Optional, Tuple  # noqa: H301
+
+from kanod_image_builder import elements
+from kanod_image_builder import main as builder
+from kanod_image_builder import matrix
+
+# Files of the project changing the behaviour of every build.
+PROJECT_FILES = ['setup.cfg', 'setup.py', 'requirements.txt']
+
+
+def git(args: List[str], cwd: str) -> str:
+    return subprocess.check_output(['git'] + args, cwd=cwd, encoding='utf-8')
+
+
+class ChangeSet:
+    '''Files changed in a git working tree since a reference'''
+
+    def __init__(self, ref: str, cwd: str = '.'):
+        self.ref = ref
+        self.root = path.realpath(
+            git(['rev-parse', '--show-toplevel'], cwd).strip())
+        output = git(['diff', '--name-only', '--no-renames', ref, '--'],
+                     self.root)
+        self.files = [
+            path.join(self.root, line) for line in output.splitlines()
+            if line != '']
+
+    def __contains__(self, filename: str) -> bool:
+        return path.realpath(filename) in self.files
+
+    def old_content(self, filename: str) -> Optional[str]:
+        '''Content of a file at the reference or None if it did not exist'''
+        relative = path.relpath(path.realpath(filename), self.root)
+        try:
+            return subprocess.check_output(
+                ['git', 'show', f'{self.ref}:{relative}'], cwd=self.root,
+                encoding='utf-8', stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return None
+
+    def under(self, folder: str) -> List[str]:
+        '''Changed files in a folder, relative to it'''
+        folder = path.realpath(folder)
+        return [
+            path.relpath(f, folder) for f in self.files
+            if f.startswith(folder + path.sep)]
+
+
+def global_changes(changes: ChangeSet) -> List[str]:
+    '''Changed files affecting every build'''
+    result = [
+        path.join(changes.root, name) for name in PROJECT_FILES
+        if path.join(changes.root, name) in changes.files]
+    builder_folder = builder.module_folder('kanod_image_builder')
+    for relative in changes.under(builder_folder):
+        if relative == 'config.yaml' or relative.startswith('elements/'):
+            continue
+        if relative.endswith('.py') or relative.endswith('.yaml'):
+            result.append(relative)
+    return result
+
+
+def changed_elements(
+    image_builder: builder.ImageBuilder, changes: ChangeSet
+) -> Dict[str, List[str]]:
+    '''Changed files of the elements defined by the modules of a build'''
+    result: Dict[str, List[str]] = {}
+    for folder in image_builder.folders:
+        for relative in changes.under(path.join(folder, 'elements')):
+            element = relative.split(path.sep, 1)[0]
+            result.setdefault(element, []).append(relative)
+    return result
+
+
+def reference_builder(
+    build: matrix.Build, changes: ChangeSet
+) -> Optional[builder.ImageBuilder]:
+    '''Builder compiled with the config.yaml files of the reference
+
+    :return: None if a config.yaml file did not exist at the reference.
+    '''
+    image_builder = builder.ImageBuilder(validate=False)
+    for module in ['kanod_image_builder'] + build.modules:
+        folder = builder.module_folder(module)
+        config = path.join(folder, 'config.yaml')
+        if config in changes:
+            content = changes.old_content(config)
+            if content is None:
+                return None
+        else:
+            content = builder.read_resource(module, 'config.yaml')
+        image_builder.parse_config(folder, content)
+    image_builder.compute_git_url()
+    image_builder.compile(build.flags, build.vars)
+    return image_builder
+
+
+def outcome(image_builder: builder.ImageBuilder) -> Tuple:
+    return (
+        list(image_builder.elements), list(image_builder.packages),
+        sorted(image_builder.osEnv.items()))
+
+
+def signature(build: matrix.Build) -> Tuple:
+    return (
+        build.modules, build.flags, sorted(build.vars.items()), build.format,
+        build.packages, build.output)
+
+
+def reasons(
+    build: matrix.Build, image_builder: builder.ImageBuilder,
+    changes: ChangeSet, old_builds: Optional[Dict[str, Tuple]]
+) -> List[str]:
+    '''Reasons why a build is affected by the changes'''
+    result = []
+    if old_builds is not None and (
+            old_builds.get(build.name, None) != signature(build)):
+        result.append('definition changed in the matrix')
+    configs = [
+        path.join(folder, 'config.yaml') for folder in image_builder.folders]
+    if any(config in changes for config in configs):
+        try:
+            old_builder = reference_builder(build, changes)
+        except Exception:
+            old_builder = None
+        if old_builder is None or outcome(old_builder) != outcome(
+                image_builder):
+            result.append('compiled configuration changed')
+    used = set(elements.closure(
+        image_builder.elements,
+        elements.element_index(image_builder.elements_path())))
+    for (element, files) in changed_elements(image_builder, changes).items():
+        if element in used:
+            result.append(f'element {element} changed ({", ".join(files)})')
+    return result
+
+
+def old_matrix(filename: str, changes: ChangeSet) -> Optional[Dict]:
+    '''Signatures of the builds of the reference if the matrix changed'''
+    if filename not in changes:
+        return None
+    content = changes.old_content(filename)
+    if content is None:
+        return {}
+    try:
+        (_, builds) = matrix.parse_matrix(content, filename)
+    except Exception:
+        return {}
+    return {build.name: signature(build) for build in builds}
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='kanod-image-builder affected')
+    parser.add_argument('matrix', help='matrix definition file')
+    parser.add_argument(
+        '--since', required=True,
+        help='git reference the changes are computed from'
+    )
+    parser.add_argument(
+        '--explain', action='store_true',
+        help='print why each build is affected'
+    )
+    parser.add_argument(
+        '--json', action='store_true',
+        help='print the affected builds and the reasons in JSON'
+    )
+    args = parser.parse_args(argv)
+    (_, builds) = matrix.load_matrix(args.matrix)
+    changes = ChangeSet(
+        args.since, path.dirname(path.abspath(args.matrix)))
+    old_builds = old_matrix(args.matrix, changes)
+    common = global_changes(changes)
+    affected = {}
+    for build in builds:
+        image_builder = builder.make_builder(
+            build.modules, build.flags, build.vars, validate=False)
+        if len(common) > 0:
+            why = [f'builder changed ({", ".join(common)})']
+        else:
+            why = reasons(build, image_builder, changes, old_builds)
+        if len(why) > 0:
+            affected[build.name] = why
+    if args.json:
+        print(json.dumps(affected, indent=2))
+        return
+    for (name, why) in affected.items():
+        print(f'{name}: {"; ".join(why)}' if args.explain else name)
@@ -0,0 +1,39 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Rebuild an image from its previous version and a delta.'''
+
+import argparse
+
+from typing import List  # noqa: H301
+
+from kanod_image_builder import delta as image_delta
+from kanod_image_builder import main as builder
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='kanod-image-builder apply')
+    parser.add_argument('old', help='previous version of the image')
+    parser.add_argument('delta', help='delta produced by the delta command')
+    parser.add_argument(
+        '--output', '-o', required=True,
+        help='new version of the image'
+    )
+    builder.add_parallelism_arguments(parser)
+    args = parser.parse_args(argv)
+    new = image_delta.apply_delta(
+        args.old, args.delta, args.output,
+        builder.open_parallelism(args).threads)
+    print(f'{args.output}: guest data of {new["size"]} bytes, sha256 '
+          f'{new["sha256"]}')
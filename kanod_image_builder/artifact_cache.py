@@ -0,0 +1,33 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Cache of components compiled from source during builds.
+
+The folder is bind-mounted in the chroot of builds by the
+kanod-artifact-cache element. Each artifact is an install tarball named after
+the component and a key identifying what it was built for (version of the
+component, distribution, release and kernel). Elements restore it instead of
+installing a toolchain and compiling the component.
+'''
+
+from kanod_image_builder import package_cache
+
+ARTIFACT_CACHE_ELEMENT = 'kanod-artifact-cache'
+
+
+class ArtifactCache(package_cache.PackageCache):
+    '''Artifact cache with LRU eviction
+
+    Restoring an artifact updates its modification date.
+    '''
@@ -0,0 +1,337 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Store of the base cloud images given to diskimage-builder.
+
+Without a store, the image variable is a local file given as
+DIB_LOCAL_IMAGE, or diskimage-builder downloads the cloud image of the
+distribution again in its own cache, without eviction nor verification
+across runners. With a store, the builder provides DIB_LOCAL_IMAGE itself
+when the image variable is an http(s) URL, or - for the default cloud image
+of Ubuntu:
+
+* the upstream sha256 is given by the image_sha256 variable or read from
+  <url>.sha256, SHA256SUMS or CHECKSUM next to the image. Downloads are
+  verified against it,
+* entries are keyed by distribution, release and upstream sha256. Images
+  compressed with gz, xz, bz2 or zstd are stored decompressed,
+* concurrent builds download an image once and hold a shared lock on the
+  entries they use. The least recently used entries that are not locked
+  are evicted above the size limit,
+* offline, the sha256 last seen for a URL is used and the network is never
+  accessed.
+
+The upstream sha256 is part of the digest of the recipe.
+'''
+
+import bz2
+import fcntl
+import gzip
+import hashlib
+import json
+import lzma
+import os
+from os import path
+import re
+import shutil
+import tempfile
+from urllib import error as urlerror
+from urllib import parse
+from urllib import request
+
+from typing import Any, Dict, IO, List, Optional  # noqa: H301
+
+from kanod_image_builder import cache as image_cache
+
+UBUNTU_CLOUD_IMAGE = (
+    'https://cloud-images.ubuntu.com/{release}/current/'
+    '{release}-server-cloudimg-amd64.squashfs')
+# Checksum files published next to the images by the distributions.
+CHECKSUM_FILES = ['SHA256SUMS', 'CHECKSUM']
+GNU_CHECKSUM = re.compile(r'^([0-9a-fA-F]{64}) [ *]?(.+)$')
+BSD_CHECKSUM = re.compile(r'^SHA256 \((.+)\) = ([0-9a-fA-F]{64})$')
+SHA256 = re.compile(r'^[0-9a-fA-F]{64}$')
+COMPRESSIONS = ['.gz', '.xz', '.bz2', '.zst']
+INDEX = 'index.json'
+LOCKS = '.locks'
+TMP = '.tmp'
+TIMEOUT = 60
+
+
+def find_checksum(content: str, name: str) -> Optional[str]:
+    '''sha256 of a file in the content of a checksum file'''
+    lines = [line.strip() for line in content.splitlines()]
+    if len(lines) == 1 and SHA256.match(lines[0]):
+        return lines[0].lower()
+    for line in lines:
+        match = GNU_CHECKSUM.match(line)
+        if match is not None and path.basename(match.group(2)) == name:
+            return match.group(1).lower()
+        match = BSD_CHECKSUM.match(line)
+        if match is not None and path.basename(match.group(1)) == name:
+            return match.group(2).lower()
+    return None
+
+
+def fetch_text(url: str) -> Optional[str]:
+    try:
+        with request.urlopen(url, timeout=TIMEOUT) as response:
+            return response.read().decode('utf-8', errors='replace')
+    except urlerror.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+
+
+def upstream_checksum(url: str) -> str:
+    '''sha256 of an image published by its distribution'''
+    name = path.basename(parse.urlparse(url).path)
+    folder = url.rsplit('/', 1)[0]
+    candidates = [f'{url}.sha256'] + [
+        f'{folder}/{filename}' for filename in CHECKSUM_FILES]
+    for candidate in candidates:
+        content = fetch_text(candidate)
+        if content is None:
+            continue
+        checksum = find_checksum(content, name)
+        if checksum is not None:
+            return checksum
+    raise Exception(f'No sha256 published for {url}')
+
+
+def open_decompressed(filename: str, compression: str) -> IO[bytes]:
+    if compression == '.gz':
+        return gzip.open(filename, 'rb')
+    if compression == '.xz':
+        return lzma.open(filename, 'rb')
+    if compression == '.bz2':
+        return bz2.open(filename, 'rb')
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception(
+            'zstd decompression requires the zstandard python module '
+            '(zstd extra)')
+    return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+
+
+class Lease:
+    '''Base image of the store used by a build
+
+    The shared lock on the entry prevents its eviction until the lease is
+    released.
+    '''
+
+    def __init__(self, filename: str, lock: IO[str]):
+        self.path = filename
+        self.lock: Optional[IO[str]] = lock
+
+    def release(self):
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+
+class BaseImageStore:
+    '''Base images verified, decompressed and evicted by the builder'''
+
+    def __init__(
+        self, root: str, max_size: Optional[int] = None,
+        offline: bool = False
+    ):
+        self.root = path.abspath(root)
+        self.max_size = max_size
+        self.offline = offline
+        os.makedirs(path.join(self.root, LOCKS), exist_ok=True)
+        os.makedirs(path.join(self.root, TMP), exist_ok=True)
+
+    def lock(self, name: str) -> IO[str]:
+        return open(path.join(self.root, LOCKS, f'{name}.lock'), 'a')
+
+    def read_index(self) -> Dict[str, str]:
+        filename = path.join(self.root, INDEX)
+        if not path.isfile(filename):
+            return {}
+        with open(filename, encoding='utf-8') as fd:
+            return json.load(fd)
+
+    def remember(self, url: str, sha256: str):
+        '''Record the last sha256 seen for a URL, used offline'''
+        with self.lock('index') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.read_index()
+            if index.get(url, None) == sha256:
+                return
+            index[url] = sha256
+            (fd, tmp) = tempfile.mkstemp(dir=self.root, prefix='.')
+            with os.fdopen(fd, 'w', encoding='utf-8') as out:
+                json.dump(index, out, indent=2, sort_keys=True)
+            os.replace(tmp, path.join(self.root, INDEX))
+
+    def source(self, image_builder) -> Optional[Dict[str, str]]:
+        '''Upstream base image of a compiled build
+
+        :return: the URL, distribution, release and sha256 of the image or
+            None if the build does not download a base image.
+        '''
+        image = image_builder.vars.get('image', None)
+        distro = image_builder.vars.get('target', 'unknown')
+        release = image_builder.environment().get('DIB_RELEASE', 'unknown')
+        if image == '-' and distro == 'ubuntu':
+            url = UBUNTU_CLOUD_IMAGE.format(release=release)
+        elif image is not None and image.startswith(('http://', 'https://')):
+            url = image
+        else:
+            return None
+        sha256 = image_builder.vars.get('image_sha256', None)
+        if sha256 is not None:
+            sha256 = sha256.lower()
+        elif self.offline:
+            sha256 = self.read_index().get(url, None)
+            if sha256 is None:
+                raise Exception(f'{url} is not in the base image store '
+                                '(offline)')
+        else:
+            sha256 = upstream_checksum(url)
+        return {
+            'url': url, 'distro': distro, 'release': release,
+            'sha256': sha256}
+
+    def folder(self, source: Dict[str, str]) -> str:
+        return path.join(
+            self.root, source['distro'], source['release'], source['sha256'])
+
+    def entry(self, source: Dict[str, str]) -> Optional[str]:
+        folder = self.folder(source)
+        if not path.isdir(folder):
+            return None
+        files = os.listdir(folder)
+        return path.join(folder, files[0]) if len(files) == 1 else None
+
+    def download(self, source: Dict[str, str], log=None) -> str:
+        '''Download, verify and decompress a base image in the store
+
+        It must be called with the download lock of the entry.
+        '''
+        url = source['url']
+        name = path.basename(parse.urlparse(url).path)
+        print(f'Downloading base image {url}', file=log, flush=True)
+        tmp = tempfile.mkdtemp(dir=path.join(self.root, TMP))
+        try:
+            filename = path.join(tmp, name)
+            digest = hashlib.sha256()
+            with request.urlopen(url, timeout=TIMEOUT) as response, \
+                    open(filename, 'wb') as out:
+                for chunk in iter(
+                        lambda: response.read(image_cache.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    out.write(chunk)
+            if digest.hexdigest() != source['sha256']:
+                raise Exception(
+                    f'Checksum of {url} is {digest.hexdigest()}, expected '
+                    f'{source["sha256"]}')
+            (stem, compression) = path.splitext(filename)
+            if compression in COMPRESSIONS:
+                with open_decompressed(filename, compression) as fd, \
+                        open(stem, 'wb') as out:
+                    shutil.copyfileobj(fd, out, image_cache.CHUNK_SIZE)
+                os.remove(filename)
+                filename = stem
+            folder = self.folder(source)
+            os.makedirs(path.dirname(folder), exist_ok=True)
+            # An entry left incomplete by a crash is replaced. The caller
+            # holds the download lock of the entry.
+            if path.exists(folder):
+                shutil.rmtree(folder)
+            os.rename(tmp, folder)
+            return path.join(folder, path.basename(filename))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def acquire(self, source: Dict[str, str], log=None) -> Lease:
+        '''Base image of a build, downloaded if it is not in the store
+
+        Concurrent builds wait for the download of the same image.
+        '''
+        lock = self.lock(source['sha256'])
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            with self.lock(f'{source["sha256"]}.download') as download:
+                fcntl.flock(download, fcntl.LOCK_EX)
+                filename = self.entry(source)
+                if filename is None:
+                    if self.offline:
+                        raise Exception(
+                            f'{source["url"]} is not in the base image '
+                            'store (offline)')
+                    filename = self.download(source, log)
+            # The date of last modification of the folder of an entry is
+            # its date of last use.
+            os.utime(path.dirname(filename))
+        except BaseException:
+            lock.close()
+            raise
+        self.remember(source['url'], source['sha256'])
+        self.evict()
+        return Lease(filename, lock)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        result = []
+        for folder in sorted(os.listdir(self.root)):
+            distro = path.join(self.root, folder)
+            if folder.startswith('.') or not path.isdir(distro):
+                continue
+            for release in os.listdir(distro):
+                for sha256 in os.listdir(path.join(distro, release)):
+                    entry = path.join(distro, release, sha256)
+                    try:
+                        size = sum(
+                            os.stat(path.join(entry, name)).st_size
+                            for name in os.listdir(entry))
+                        used = os.stat(entry).st_mtime
+                    except FileNotFoundError:
+                        continue
+                    result.append({
+                        'path': entry, 'sha256': sha256, 'size': size,
+                        'used': used})
+        return result
+
+    def evict(self) -> int:
+        '''Remove the least recently used images above the size limit
+
+        Images used by running builds are kept.
+
+        :return: the size of the store.
+        '''
+        entries = sorted(self.entries(), key=lambda e: e['used'])
+        total = sum(e['size'] for e in entries)
+        if self.max_size is None:
+            return total
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            with self.lock(entry['sha256']) as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(entry['path'], ignore_errors=True)
+            total -= entry['size']
+        return total
+
+
+def summary(source: Dict[str, str], lease: Lease) -> str:
+    return (
+        f'Base image {source["url"]} (sha256 {source["sha256"][:12]}) '
+        f'from {lease.path}')
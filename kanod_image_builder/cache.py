@@ -0,0 +1,286 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Content addressed cache of built images.
+
+The key of an image is a digest of everything that defines the build: the
+compiled elements and packages, the DIB_* environment and the content of the
+element folders. Paths of the host (checkouts, site-packages, local base
+images) are never part of it and the git URL of the checkout is reduced to
+its host and path so that builders share their hits.
+'''
+
+import hashlib
+import json
+import os
+from os import path
+import re
+import shutil
+import sys
+import tempfile
+from urllib import error as urlerror
+from urllib import parse
+from urllib import request
+
+from typing import Any, Dict, List, Optional, Tuple  # noqa: H301
+
+CHUNK_SIZE = 4 * 1024 * 1024
+TIMEOUT = 60
+# Files generated on the host that are not part of the elements.
+IGNORED_FOLDERS = ['__pycache__']
+IGNORED_SUFFIXES = ['.pyc']
+# Digests of the local base images by path, size and modification date.
+_file_digests: Dict[Tuple[str, int, int], str] = {}
+# scp-like syntax of git: [user@]host:path
+SCP_URL = re.compile(r'^(?:[^@/]+@)?([^:/]+):(?!//)(.*)$')
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value: str) -> int:
+    '''Parse a size with an optional K, M, G or T suffix'''
+    value = value.strip().upper().rstrip('B')
+    if value != '' and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def hash_tree(digest, root: str):
+    '''Add the content of a folder to a digest.
+
+    File names, executable bits, symbolic link targets and contents are
+    taken into account. Files are visited in a deterministic order.
+    '''
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames[:] = sorted(
+            name for name in dirnames if name not in IGNORED_FOLDERS)
+        rel_dir = path.relpath(dirpath, root)
+        for filename in sorted(filenames):
+            if filename.endswith(tuple(IGNORED_SUFFIXES)):
+                continue
+            file = path.join(dirpath, filename)
+            digest.update(path.join(rel_dir, filename).encode('utf-8'))
+            if path.islink(file):
+                digest.update(b'link:' + os.readlink(file).encode('utf-8'))
+                continue
+            mode = os.stat(file).st_mode
+            digest.update(b'x' if mode & 0o111 else b'-')
+            with open(file, 'rb') as fd:
+                for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+
+
+def file_digest(filename: str) -> str:
+    '''sha256 of a file, computed once per process while it is unchanged'''
+    stat = os.stat(filename)
+    key = (path.abspath(filename), stat.st_size, int(stat.st_mtime))
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def normalize_git_url(url: str) -> str:
+    '''Host and path of a git URL, whatever the protocol and the user'''
+    match = SCP_URL.match(url)
+    if match is not None:
+        (host, folder) = match.groups()
+    else:
+        parsed = parse.urlparse(url)
+        if parsed.hostname is None:
+            return url
+        (host, folder) = (parsed.hostname, parsed.path)
+    folder = folder.strip('/')
+    if folder.endswith('.git'):
+        folder = folder[:-4]
+    return f'{host.lower()}/{folder}'
+
+
+def dib_version() -> Optional[str]:
+    try:
+        from importlib import metadata
+        return metadata.version('diskimage-builder')
+    except Exception:
+        return None
+
+
+def recipe_digest(
+    image_builder, format: str, additional: str,
+    optimize: Optional[Dict[str, Any]] = None
+) -> str:
+    '''Digest identifying the image produced by a compiled builder'''
+    env = image_builder.environment()
+    dib_env = {
+        key: value for (key, value) in env.items()
+        if key.startswith('DIB_')}
+    local_image = dib_env.get('DIB_LOCAL_IMAGE', None)
+    if local_image is not None and path.isfile(local_image):
+        dib_env['DIB_LOCAL_IMAGE'] = file_digest(local_image)
+    if 'DIB_KANOD_GIT_URL' in dib_env:
+        # Checkouts cloned over ssh or https build the same images.
+        dib_env['DIB_KANOD_GIT_URL'] = normalize_git_url(
+            dib_env['DIB_KANOD_GIT_URL'])
+    if 'DIB_KANOD_LAYER_RESTORE' in dib_env:
+        # Snapshots are named after the digest of their layer.
+        dib_env['DIB_KANOD_LAYER_RESTORE'] = path.basename(
+            dib_env['DIB_KANOD_LAYER_RESTORE'])
+    recipe = {
+        'format': format,
+        'elements': image_builder.elements,
+        'packages': image_builder.packages,
+        'additional': additional,
+        'env': dib_env,
+        'diskimage-builder': dib_version(),
+    }
+    if optimize is not None:
+        recipe['optimize'] = optimize
+    if image_builder.base_image is not None:
+        recipe['base-image'] = image_builder.base_image['sha256']
+    digest = hashlib.sha256()
+    digest.update(json.dumps(recipe, sort_keys=True).encode('utf-8'))
+    for folder in image_builder.elements_path().split(':'):
+        # Folders are told apart by their rank in ELEMENTS_PATH only.
+        digest.update(b'\0elements\0')
+        if path.isdir(folder):
+            hash_tree(digest, folder)
+    return digest.hexdigest()
+
+
+class LocalCache:
+    '''Cache of images in a local folder with LRU eviction
+
+    The date of last modification of an entry is updated on each hit and is
+    used as the date of last use.
+    '''
+
+    def __init__(self, root: str, max_size: Optional[int] = None):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    def entry(self, key: str) -> str:
+        return path.join(self.root, key)
+
+    def fetch(self, key: str, target: str) -> bool:
+        entry = self.entry(key)
+        if not path.isfile(entry):
+            return False
+        os.utime(entry)
+        copy_file(entry, target)
+        return True
+
+    def store(self, key: str, source: str):
+        copy_file(source, self.entry(key))
+        self.evict()
+
+    def entries(self) -> List[Dict[str, Any]]:
+        result = []
+        for name in os.listdir(self.root):
+            if name.startswith('.'):
+                continue
+            entry = path.join(self.root, name)
+            try:
+                stat = os.stat(entry)
+            except FileNotFoundError:
+                continue
+            result.append(
+                {'path': entry, 'size': stat.st_size,
+                 'used': stat.st_mtime})
+        return result
+
+    def evict(self):
+        '''Remove the least recently used entries above the size limit'''
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e['used'])
+        total = sum(e['size'] for e in entries)
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                pass
+            total -= entry['size']
+
+
+class HttpCache:
+    '''Cache of images shared through an HTTP server
+
+    Entries are read with GET and written with PUT on ``url/key``. The
+    cache is an optimization: a server that fails or does not answer is a
+    miss and images that cannot be stored are only reported.
+    '''
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+
+    def fetch(self, key: str, target: str) -> bool:
+        try:
+            with request.urlopen(
+                    f'{self.url}/{key}', timeout=TIMEOUT) as response:
+                write_atomically(target, response)
+        except urlerror.HTTPError as e:
+            if e.code != 404:
+                print(f'Image cache {self.url} failed: {e}', file=sys.stderr)
+            return False
+        except OSError as e:
+            # URLError, timeouts and connections reset during the transfer.
+            print(f'Image cache {self.url} failed: {e}', file=sys.stderr)
+            return False
+        return True
+
+    def store(self, key: str, source: str):
+        size = os.stat(source).st_size
+        try:
+            with open(source, 'rb') as fd:
+                req = request.Request(
+                    f'{self.url}/{key}', data=fd, method='PUT',
+                    headers={'Content-Length': str(size),
+                             'Content-Type': 'application/octet-stream'})
+                with request.urlopen(req, timeout=TIMEOUT):
+                    pass
+        except OSError as e:
+            print(f'Image {key} not stored in {self.url}: {e}',
+                  file=sys.stderr)
+
+
+def write_atomically(target: str, stream):
+    '''Copy a stream to a file that appears only once complete'''
+    folder = path.dirname(path.abspath(target))
+    (fd, tmp) = tempfile.mkstemp(dir=folder, prefix='.')
+    try:
+        os.chmod(tmp, 0o644)
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(stream, out, CHUNK_SIZE)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def copy_file(source: str, target: str):
+    with open(source, 'rb') as fd:
+        write_atomically(target, fd)
+
+
+def open_cache(location: str, max_size: Optional[str] = None):
+    '''Cache backend from a folder name or an http(s) URL'''
+    if location.startswith('http://') or location.startswith('https://'):
+        return HttpCache(location)
+    return LocalCache(
+        location, None if max_size is None else parse_size(max_size))
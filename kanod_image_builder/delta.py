@@ -0,0 +1,432 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Block-level delta between two versions of an image.
+
+The delta is computed on the guest data of the images: qcow2 images are
+compressed cluster by cluster, so the bytes of two versions of the file
+differ even where their content is the same. qcow2 images are first
+converted by qemu-img to sparse raw files next to the delta. The guest data
+is cut in chunks aligned on the cluster size of the new image. Each chunk of
+the new image is either:
+
+* a run of zeros, not stored,
+* found in the old image: only its offset and its sha256 are stored,
+* stored compressed in the delta, once even if it appears several times.
+
+A delta file starts with MAGIC, followed by the compressed chunks, the
+index of the chunks in compressed JSON and a trailer giving the offset and
+the length of the index. Images are read chunk by chunk, holes are not read
+and chunks are hashed and compressed by a pool of threads. Applying a delta
+checks the chunks taken from the old image and the sha256 of the guest data
+of the result. A qcow2 image is then converted again like the optimizer
+does: its guest data is the one of the new image, but its file is not
+necessarily identical.
+'''
+
+import argparse
+from concurrent import futures
+import hashlib
+import json
+import lzma
+import os
+from os import path
+import struct
+import subprocess
+import tempfile
+import zlib
+
+from typing import Any, Callable, Dict, Iterator, List  # noqa: H301
+from typing import Optional, Tuple  # noqa: H301
+
+from kanod_image_builder import main as builder
+from kanod_image_builder import optimize
+from kanod_image_builder import postbuild
+
+MAGIC = b'KANOD-DELTA\x01'
+TRAILER = struct.Struct('<QQ')
+DEFAULT_CHUNK_SIZE = 1 << 20
+MIN_CHUNK_SIZE = 64 * 1024
+QCOW2_MAGIC = b'QFI\xfb'
+
+# Chunk of an image: offset, data (None for zeros) and sha256.
+Chunk = Tuple[int, Optional[bytes], Optional[bytes]]
+
+
+def gzip_decompress(data: bytes) -> bytes:
+    return zlib.decompress(data, 31)
+
+
+def xz_decompress(data: bytes) -> bytes:
+    return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+
+def zstd_decompress(data: bytes) -> bytes:
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception(
+            'zstd decompression requires the zstandard python module '
+            '(zstd extra)')
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+DECOMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    'gz': gzip_decompress,
+    'xz': xz_decompress,
+    'zstd': zstd_decompress,
+}
+
+
+def image_format(image: str) -> str:
+    with open(image, 'rb') as fd:
+        return 'qcow2' if fd.read(4) == QCOW2_MAGIC else 'raw'
+
+
+def default_chunk_size(image: str) -> int:
+    '''Cluster size of a qcow2 image, or DEFAULT_CHUNK_SIZE'''
+    with open(image, 'rb') as fd:
+        header = fd.read(24)
+    if len(header) == 24 and header[:4] == QCOW2_MAGIC:
+        (cluster_bits,) = struct.unpack('>I', header[20:24])
+        return max(MIN_CHUNK_SIZE, 1 << cluster_bits)
+    return DEFAULT_CHUNK_SIZE
+
+
+def guest_data(image: str, folder: str, name: str) -> str:
+    '''Raw file with the guest data of an image
+
+    qcow2 images are converted to a sparse raw file in folder, raw images
+    are used as is.
+    '''
+    if image_format(image) == 'raw':
+        return image
+    raw = path.join(folder, f'{name}.raw')
+    subprocess.run(
+        ['qemu-img', 'convert', '-f', 'qcow2', '-O', 'raw', image, raw],
+        check=True)
+    return raw
+
+
+def is_zero(data: bytes) -> bool:
+    if len(data) <= postbuild.BLOCK_SIZE:
+        return data == postbuild.ZEROS[:len(data)]
+    return data == bytes(len(data))
+
+
+def read_chunk(fd: int, offset: int, length: int, hole: bool) -> Chunk:
+    if hole:
+        return (offset, None, None)
+    data = os.pread(fd, length, offset)
+    if is_zero(data):
+        return (offset, None, None)
+    return (offset, data, hashlib.sha256(data).digest())
+
+
+def ordered(
+    pool: futures.ThreadPoolExecutor, tasks: Iterator, depth: int
+) -> Iterator[Any]:
+    '''Results of tasks run by a pool, in order, with at most depth pending
+
+    :param tasks: pairs of a function and its arguments.
+    '''
+    pending: List[futures.Future] = []
+    for (function, args) in tasks:
+        pending.append(pool.submit(function, *args))
+        if len(pending) > depth:
+            yield pending.pop(0).result()
+    for task in pending:
+        yield task.result()
+
+
+def chunk_tasks(fd: int, size: int, chunk_size: int) -> Iterator:
+    extents = postbuild.data_extents(fd, size)
+    # First data extent ending after the current chunk.
+    current = 0
+    for offset in range(0, size, chunk_size):
+        length = min(chunk_size, size - offset)
+        while current < len(extents) and extents[current][1] <= offset:
+            current += 1
+        hole = (
+            current == len(extents) or
+            extents[current][0] >= offset + length)
+        yield (read_chunk, (fd, offset, length, hole))
+
+
+def chunks(
+    fd: int, size: int, chunk_size: int, pool: futures.ThreadPoolExecutor,
+    depth: int
+) -> Iterator[Chunk]:
+    '''Chunks of an image read and hashed by a pool of threads'''
+    return ordered(pool, chunk_tasks(fd, size, chunk_size), depth)
+
+
+def zeros_digest(worker: postbuild.DigestWorker, length: int):
+    while length > 0:
+        step = min(length, postbuild.BLOCK_SIZE)
+        worker.blocks.put(postbuild.ZEROS[:step])
+        length -= step
+
+
+def make_delta(
+    old: str, new: str, output: str, chunk_size: Optional[int] = None,
+    compress: str = 'gz', threads: int = 1
+) -> Dict[str, Any]:
+    '''Write the delta between the guest data of two images
+
+    :return: statistics of the delta.
+    '''
+    chunk_size = chunk_size or default_chunk_size(new)
+    format = image_format(new)
+    with tempfile.TemporaryDirectory(
+            dir=path.dirname(path.abspath(output)),
+            prefix='.kanod-delta-') as tmp:
+        return write_delta(
+            guest_data(old, tmp, 'old'), guest_data(new, tmp, 'new'), output,
+            chunk_size, compress, threads, format)
+
+
+def write_delta(
+    old: str, new: str, output: str, chunk_size: int, compress: str,
+    threads: int, format: str
+) -> Dict[str, Any]:
+    '''Write the delta between two raw files
+
+    :param format: format of the image rebuilt from the delta.
+    '''
+    compressor = postbuild.COMPRESSORS[compress]
+    depth = 2 * threads
+    known: Dict[bytes, int] = {}
+    old_digest = postbuild.DigestWorker('sha256', depth)
+    old_digest.start()
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        with open(old, 'rb', buffering=0) as fd:
+            old_size = os.fstat(fd.fileno()).st_size
+            for (offset, data, digest) in chunks(
+                    fd.fileno(), old_size, chunk_size, pool, depth):
+                if data is None:
+                    zeros_digest(old_digest, min(
+                        chunk_size, old_size - offset))
+                    continue
+                old_digest.blocks.put(data)
+                known.setdefault(digest, offset)
+        old_digest.blocks.put(None)
+        new_digest = postbuild.DigestWorker('sha256', depth)
+        new_digest.start()
+        index: List[List[Any]] = []
+        stored: Dict[bytes, List[Any]] = {}
+        stats = {'zero': 0, 'old': 0, 'stored': 0, 'duplicate': 0}
+        with open(new, 'rb', buffering=0) as fd, \
+                open(output, 'wb') as out:
+            out.write(MAGIC)
+            new_size = os.fstat(fd.fileno()).st_size
+            pieces = []
+            for (offset, data, digest) in chunks(
+                    fd.fileno(), new_size, chunk_size, pool, depth):
+                if data is None:
+                    zeros_digest(new_digest, min(
+                        chunk_size, new_size - offset))
+                    pieces.append((['z'], None))
+                    continue
+                new_digest.blocks.put(data)
+                if digest in known:
+                    pieces.append((['o', known[digest], digest.hex()], None))
+                elif digest in stored:
+                    pieces.append((stored[digest], None))
+                else:
+                    entry = ['d', 0, 0]
+                    stored[digest] = entry
+                    pieces.append((entry, pool.submit(compressor, data)))
+                # Compressed chunks are written in order as they complete.
+                while len(pieces) > depth:
+                    write_piece(out, pieces.pop(0), index, stats)
+            for piece in pieces:
+                write_piece(out, piece, index, stats)
+            new_digest.blocks.put(None)
+            old_digest.join()
+            new_digest.join()
+            header = {
+                'version': 2, 'chunk-size': chunk_size,
+                'compression': compress, 'format': format,
+                'old': {'size': old_size,
+                        'sha256': old_digest.hash.hexdigest()},
+                'new': {'size': new_size,
+                        'sha256': new_digest.hash.hexdigest()},
+                'chunks': index,
+            }
+            index_offset = out.tell()
+            content = zlib.compress(json.dumps(header).encode('utf-8'))
+            out.write(content)
+            out.write(TRAILER.pack(index_offset, len(content)) + MAGIC)
+            stats['delta-size'] = out.tell()
+    stats['new-size'] = new_size
+    stats['sha256'] = header['new']['sha256']
+    return stats
+
+
+def write_piece(out, piece, index: List[List[Any]], stats: Dict[str, int]):
+    (entry, task) = piece
+    if task is not None:
+        data = task.result()
+        entry[1] = out.tell()
+        entry[2] = len(data)
+        out.write(data)
+        stats['stored'] += 1
+    else:
+        stats[{'z': 'zero', 'o': 'old', 'd': 'duplicate'}[entry[0]]] += 1
+    index.append(entry)
+
+
+def read_index(fd: int) -> Dict[str, Any]:
+    size = os.fstat(fd).st_size
+    trailer_size = TRAILER.size + len(MAGIC)
+    if (size < len(MAGIC) + trailer_size or
+            os.pread(fd, len(MAGIC), 0) != MAGIC or
+            os.pread(fd, len(MAGIC), size - len(MAGIC)) != MAGIC):
+        raise Exception('Not a delta of kanod images')
+    (offset, length) = TRAILER.unpack(
+        os.pread(fd, TRAILER.size, size - trailer_size))
+    return json.loads(zlib.decompress(os.pread(fd, length, offset)))
+
+
+def build_chunk(
+    old_fd: int, delta_fd: int, decompress: Callable[[bytes], bytes],
+    entry: List[Any], offset: int, length: int
+) -> Optional[bytes]:
+    '''Content of a chunk of the new image, None for zeros'''
+    kind = entry[0]
+    if kind == 'z':
+        return None
+    if kind == 'd':
+        data = decompress(os.pread(delta_fd, entry[2], entry[1]))
+    else:
+        data = os.pread(old_fd, length, entry[1])
+        if hashlib.sha256(data).hexdigest() != entry[2]:
+            raise Exception(
+                f'The old image does not match the delta at offset '
+                f'{entry[1]}')
+    if len(data) != length:
+        raise Exception(f'Corrupted chunk at offset {offset}')
+    return data
+
+
+def apply_delta(
+    old: str, delta: str, output: str, threads: int = 1
+) -> Dict[str, Any]:
+    '''Rebuild the new image from the old one and a delta
+
+    The new image is written in output only if the sha256 of its guest data
+    is the expected one.
+    '''
+    with open(delta, 'rb', buffering=0) as delta_fd:
+        format = read_index(delta_fd.fileno()).get('format', 'raw')
+    if format == 'raw':
+        return rebuild(old, delta, output, threads)
+    partial = f'{output}.part'
+    with tempfile.TemporaryDirectory(
+            dir=path.dirname(path.abspath(output)),
+            prefix='.kanod-delta-') as tmp:
+        raw = path.join(tmp, 'new.raw')
+        new = rebuild(guest_data(old, tmp, 'old'), delta, raw, threads)
+        try:
+            optimize.convert(
+                raw, partial, format, new['chunk-size'], threads)
+        except BaseException:
+            if path.exists(partial):
+                os.remove(partial)
+            raise
+    os.rename(partial, output)
+    return new
+
+
+def rebuild(
+    old: str, delta: str, output: str, threads: int
+) -> Dict[str, Any]:
+    '''Rebuild the raw guest data of the new image'''
+    depth = 2 * threads
+    partial = f'{output}.part'
+    with open(old, 'rb', buffering=0) as old_fd, \
+            open(delta, 'rb', buffering=0) as delta_fd:
+        header = read_index(delta_fd.fileno())
+        decompress = DECOMPRESSORS[header['compression']]
+        chunk_size = header['chunk-size']
+        size = header['new']['size']
+        digest = postbuild.DigestWorker('sha256', depth)
+        digest.start()
+        tasks = (
+            (build_chunk, (
+                old_fd.fileno(), delta_fd.fileno(), decompress, entry,
+                index * chunk_size,
+                min(chunk_size, size - index * chunk_size)))
+            for (index, entry) in enumerate(header['chunks']))
+        try:
+            with open(partial, 'wb') as out, \
+                    futures.ThreadPoolExecutor(max_workers=threads) as pool:
+                offset = 0
+                for data in ordered(pool, tasks, depth):
+                    length = min(chunk_size, size - offset)
+                    if data is None:
+                        zeros_digest(digest, length)
+                    else:
+                        digest.blocks.put(data)
+                        os.pwrite(out.fileno(), data, offset)
+                    offset += length
+                out.truncate(size)
+            digest.blocks.put(None)
+            digest.join()
+            if digest.hash.hexdigest() != header['new']['sha256']:
+                raise Exception(
+                    f'The rebuilt image has the sha256 '
+                    f'{digest.hash.hexdigest()} instead of '
+                    f'{header["new"]["sha256"]}')
+        except BaseException:
+            digest.blocks.put(None)
+            if path.exists(partial):
+                os.remove(partial)
+            raise
+    os.rename(partial, output)
+    return dict(header['new'], **{'chunk-size': header['chunk-size']})
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='kanod-image-builder delta')
+    parser.add_argument('old', help='previous version of the image')
+    parser.add_argument('new', help='new version of the image')
+    parser.add_argument(
+        '--output', '-o', default=None,
+        help='delta file (default: <new>.delta)'
+    )
+    parser.add_argument(
+        '--chunk-size', default=None,
+        help='size of the chunks (default: cluster size of a qcow2 image '
+             'or 1M)'
+    )
+    parser.add_argument(
+        '--compress', choices=sorted(postbuild.COMPRESSORS), default='gz',
+        help='compression of the chunks stored in the delta'
+    )
+    builder.add_parallelism_arguments(parser)
+    args = parser.parse_args(argv)
+    chunk_size = None
+    if args.chunk_size is not None:
+        from kanod_image_builder import cache as image_cache
+        chunk_size = image_cache.parse_size(args.chunk_size)
+    output = args.output or f'{args.new}.delta'
+    stats = make_delta(
+        args.old, args.new, output, chunk_size, args.compress,
+        builder.open_parallelism(args).threads)
+    print(f'{path.basename(output)}: {stats["delta-size"]} bytes for an '
+          f'image of {stats["new-size"]} bytes ({stats["stored"]} chunks '
+          f'stored, {stats["old"]} reused, {stats["duplicate"]} duplicated, '
+          f'{stats["zero"]} zero)')
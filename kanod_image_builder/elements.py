@@ -0,0 +1,172 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Elements available to a build and their dependencies.
+
+Elements are looked up in ELEMENTS_PATH then in the elements shipped with
+diskimage-builder. The first element found with a given name is used.
+
+The element graph of a build can be checked before diskimage-builder is
+launched: problems it would only report during the build are found in a
+fraction of a second.
+'''
+
+from importlib import util
+import os
+from os import path
+
+from typing import Dict, List, Optional, Tuple  # noqa: H301
+
+# Sub-folders of elements that diskimage-builder does not copy as hooks.
+NOT_HOOKS = {'tests', '__pycache__'}
+
+
+def dib_elements_folder() -> Optional[str]:
+    '''Folder of the elements shipped with diskimage-builder'''
+    spec = util.find_spec('diskimage_builder')
+    if spec is None or spec.origin is None:
+        return None
+    return path.join(path.dirname(spec.origin), 'elements')
+
+
+def element_index(elements_path: str) -> Dict[str, str]:
+    '''Map the name of each available element to its folder'''
+    folders = [f for f in elements_path.split(':') if f != '']
+    dib_folder = dib_elements_folder()
+    if dib_folder is not None:
+        folders.append(dib_folder)
+    index: Dict[str, str] = {}
+    for folder in folders:
+        if not path.isdir(folder):
+            continue
+        for element in sorted(os.listdir(folder)):
+            element_dir = path.join(folder, element)
+            if path.isdir(element_dir):
+                index.setdefault(element, element_dir)
+    return index
+
+
+def read_list(filename: str) -> List[str]:
+    '''Read a list of names, one per line, ignoring comments'''
+    if not path.isfile(filename):
+        return []
+    with open(filename, encoding='utf-8') as fd:
+        lines = [line.split('#', 1)[0].strip() for line in fd]
+    return [line for line in lines if line != '']
+
+
+def element_deps(element_dir: str) -> List[str]:
+    return read_list(path.join(element_dir, 'element-deps'))
+
+
+def element_provides(element_dir: str) -> List[str]:
+    return read_list(path.join(element_dir, 'element-provides'))
+
+
+def closure(elements: List[str], index: Dict[str, str]) -> List[str]:
+    '''Elements and their transitive dependencies, in discovery order
+
+    Unknown elements are kept: diskimage-builder reports them.
+    '''
+    result: Dict[str, None] = {}
+    todo = list(elements)
+    while len(todo) > 0:
+        element = todo.pop(0)
+        if element in result:
+            continue
+        result[element] = None
+        if element in index:
+            todo += element_deps(index[element])
+    return list(result)
+
+
+def resolve(
+    elements: List[str], index: Dict[str, str]
+) -> Tuple[List[str], List[str]]:
+    '''Resolve the elements of a build like diskimage-builder
+
+    Virtual elements provided by an element are not expanded. Unlike
+    diskimage-builder, every problem is reported, not only the first one.
+
+    :return: the elements of the build and the problems found.
+    '''
+    problems = []
+    result: Dict[str, None] = {}
+    provided_by: Dict[str, List[str]] = {}
+    todo: List[Tuple[str, Optional[str]]] = [
+        (element, None) for element in elements]
+    while len(todo) > 0:
+        (element, parent) = todo.pop(0)
+        if element in result or element in provided_by:
+            continue
+        if element not in index:
+            problems.append(
+                f'element {element} not found' if parent is None
+                else f'element {element} required by {parent} not found')
+            continue
+        result[element] = None
+        for provide in element_provides(index[element]):
+            if provide in provided_by:
+                problems.append(
+                    f'{provide} provided by both {element} and '
+                    f'{", ".join(provided_by[provide])}')
+            provided_by.setdefault(provide, []).append(element)
+        todo += [(dep, element) for dep in element_deps(index[element])]
+    for element in elements:
+        if element in provided_by:
+            problems.append(
+                f'element {element} already provided by '
+                f'{", ".join(provided_by[element])}')
+    if 'operating-system' not in provided_by:
+        problems.append('no operating system element')
+    resolved = [
+        element for element in result if element not in provided_by]
+    return (resolved, problems)
+
+
+def duplicated_files(
+    elements: List[str], index: Dict[str, str]
+) -> List[str]:
+    '''Files that several elements would install at the same place
+
+    diskimage-builder merges the sub-folders of elements and stops on
+    duplicated hooks. The kanod-configure element stops on duplicated
+    kanod templates.
+    '''
+    owners: Dict[str, List[str]] = {}
+    for element in elements:
+        element_dir = index[element]
+        for folder in sorted(os.listdir(element_dir)):
+            if folder in NOT_HOOKS or not path.isdir(
+                    path.join(element_dir, folder)):
+                continue
+            for name in sorted(os.listdir(path.join(element_dir, folder))):
+                if path.isfile(path.join(element_dir, folder, name)):
+                    owners.setdefault(f'{folder}/{name}', []).append(element)
+        templates = path.join(element_dir, 'kanod', 'templates')
+        if path.isdir(templates):
+            for name in sorted(os.listdir(templates)):
+                if name.endswith('.tmpl'):
+                    owners.setdefault(
+                        f'kanod/templates/{name}', []).append(element)
+    return [
+        f'{name} defined by {", ".join(defined_by)}'
+        for (name, defined_by) in owners.items() if len(defined_by) > 1]
+
+
+def check(elements: List[str], elements_path: str) -> List[str]:
+    '''Problems of the element graph of a build'''
+    index = element_index(elements_path)
+    (resolved, problems) = resolve(elements, index)
+    return problems + duplicated_files(resolved, index)
@@ -0,0 +1,100 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Ansible callback recording the status and duration of each CIS rule.
+
+The tasks of the role are attributed to the rules of their rule_* tags. The
+records have the format of the reports of kanod-cis and are written in the
+file given by KANOD_CIS_REPORT at the end of the playbook.
+'''
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = '''
+    name: kanod_cis_report
+    type: aggregate
+    short_description: status and duration of each CIS rule
+    description:
+      - Writes the status and duration of each rule_* tag in the file given
+        by KANOD_CIS_REPORT.
+'''
+
+# Results of a rule from the best to the worst.
+STATUSES = ['skipped', 'compliant', 'remediated', 'failed']
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'kanod_cis_report'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super().__init__()
+        self.report = {}
+        self.rules = []
+        self.start = None
+
+    def close_task(self):
+        if self.start is None:
+            return
+        seconds = time.monotonic() - self.start
+        for rule in self.rules:
+            record = self.report[rule]
+            record['seconds'] = round(record['seconds'] + seconds, 3)
+        self.rules = []
+        self.start = None
+
+    def record(self, status):
+        for rule in self.rules:
+            record = self.report[rule]
+            record['status'] = max(
+                record['status'], status, key=STATUSES.index)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.close_task()
+        self.rules = sorted(
+            tag for tag in task.tags if tag.startswith('rule_'))
+        for rule in self.rules:
+            self.report.setdefault(rule, {
+                'engine': 'ansible', 'title': task.get_name(),
+                'status': 'skipped', 'seconds': 0.0})
+        self.start = time.monotonic()
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.close_task()
+
+    def v2_runner_on_ok(self, result):
+        self.record(
+            'remediated' if result._result.get('changed', False)
+            else 'compliant')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.record('failed')
+
+    def v2_runner_on_unreachable(self, result):
+        self.record('failed')
+
+    def v2_runner_on_skipped(self, result):
+        self.record('skipped')
+
+    def v2_playbook_on_stats(self, stats):
+        self.close_task()
+        with open(os.environ['KANOD_CIS_REPORT'], 'w',
+                  encoding='utf-8') as fd:
+            json.dump(self.report, fd, indent=2, sort_keys=True)
@@ -0,0 +1,10 @@
+# The proxy is only used in the chroot: the certificate authority of the
+# download cache is not trusted on the host.
+if [ -n "${DIB_KANOD_DOWNLOAD_PROXY:-}" ] && [ -d /etc/kanod-download-cache ]; then
+    export http_proxy=${DIB_KANOD_DOWNLOAD_PROXY}
+    export https_proxy=${DIB_KANOD_DOWNLOAD_PROXY}
+    export HTTP_PROXY=${DIB_KANOD_DOWNLOAD_PROXY}
+    export HTTPS_PROXY=${DIB_KANOD_DOWNLOAD_PROXY}
+    # Hosts of the environment that bypass proxies keep doing so.
+    export no_proxy=${no_proxy:+${no_proxy},}localhost,127.0.0.1
+fi
@@ -0,0 +1,5 @@
+# The apt cache of diskimage-builder is replaced by the cache managed by
+# kanod-image-builder.
+if [ -n "${DIB_KANOD_PACKAGE_CACHE:-}" ]; then
+    export DIB_APT_LOCAL_CACHE=0
+fi
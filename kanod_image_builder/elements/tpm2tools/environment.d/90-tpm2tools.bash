@@ -0,0 +1,12 @@
+# Key of the tpm2-tss and tpm2-tools binaries in the artifact cache.
+export DIB_TPM2TOOLS_ARTIFACT_KEY="${DIB_TPM2_TSS}-${DIB_TPM2_TOOLS}-${DISTRO_NAME}-${DIB_RELEASE:-default}"
+
+# The build toolchain is not installed when the binaries are already in the
+# artifact cache. The decision is taken on the host, before the chroot exists.
+if [ -z "${DIB_TPM2TOOLS_PREBUILT:-}" ]; then
+    export DIB_TPM2TOOLS_PREBUILT=0
+    if [ -n "${DIB_KANOD_ARTIFACT_CACHE:-}" ] && \
+            [ -f "${DIB_KANOD_ARTIFACT_CACHE}/tpm2tools-${DIB_TPM2TOOLS_ARTIFACT_KEY}.tar.gz" ]; then
+        export DIB_TPM2TOOLS_PREBUILT=1
+    fi
+fi
@@ -0,0 +1,166 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Footprint of the elements and packages on the devices of an image.
+
+The kanod-footprint element records the disk usage of each mount point of
+the image after every script of the phases modifying it and the disk usage
+of the files of each installed package at the end of the build. The growth
+of each device during a script is attributed to the element defining the
+script.
+
+The report is written in name.footprint.json with sorted keys so that the
+reports of two builds can be compared with diff or with::
+
+    kanod-image-builder footprint old.footprint.json new.footprint.json
+'''
+
+import argparse
+import json
+from os import path
+
+from typing import Any, Dict, List, Tuple  # noqa: H301
+
+FOOTPRINT_ELEMENT = 'kanod-footprint'
+
+# Usage of the devices of an image in bytes.
+Usage = Dict[str, int]
+
+
+def read_mounts(folder: str) -> Dict[str, str]:
+    '''Mount point of each device of the image'''
+    result = {}
+    with open(path.join(folder, 'mounts'), encoding='utf-8') as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) == 2:
+                result[fields[1]] = fields[0]
+    return result
+
+
+def read_snapshots(folder: str) -> List[Tuple[str, Usage]]:
+    '''Steps of the build and the usage of the devices after each of them'''
+    snapshots = []
+    filename = path.join(folder, 'snapshots')
+    if not path.isfile(filename):
+        return []
+    with open(filename, encoding='utf-8') as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) == 0:
+                continue
+            usage = {}
+            for field in fields[1:]:
+                (device, _, value) = field.partition('=')
+                usage[device] = int(value or 0)
+            snapshots.append((fields[0], usage))
+    return snapshots
+
+
+def add_usage(total: Usage, usage: Usage):
+    for (device, value) in usage.items():
+        if value != 0:
+            total[device] = total.get(device, 0) + value
+
+
+def make_report(
+    folder: str, owners: Dict[Tuple[str, str], str]
+) -> Dict[str, Any]:
+    '''Footprint report of a build from the records of kanod-footprint
+
+    :param folder: the folder given to the element.
+    :param owners: element defining each (phase, script).
+    :return: the usage of each device at the end of the build and the growth
+        of each device by step, element and package.
+    '''
+    previous: Usage = {}
+    steps: Dict[str, Dict[str, Any]] = {}
+    elements: Dict[str, Usage] = {}
+    for (step, usage) in read_snapshots(folder):
+        delta = {
+            device: value - previous.get(device, 0)
+            for (device, value) in usage.items()
+            if value != previous.get(device, 0)}
+        previous = usage
+        if len(delta) == 0:
+            continue
+        (phase, _, script) = step.partition('/')
+        element = owners.get((phase[:-len('.d')], script), 'unknown')
+        steps[step] = {'element': element, 'devices': delta}
+        add_usage(elements.setdefault(element, {}), delta)
+    packages: Dict[str, Usage] = {}
+    filename = path.join(folder, 'packages.json')
+    if path.isfile(filename):
+        with open(filename, encoding='utf-8') as fd:
+            packages = json.load(fd)
+    return {
+        'mounts': read_mounts(folder),
+        'total': previous,
+        'steps': steps,
+        'elements': elements,
+        'packages': packages,
+    }
+
+
+def write_report(report: Dict[str, Any], name: str) -> str:
+    filename = f'{name}.footprint.json'
+    with open(filename, 'w', encoding='utf-8') as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+        fd.write('\n')
+    return filename
+
+
+def compare(
+    old: Dict[str, Usage], new: Dict[str, Usage]
+) -> Dict[str, Usage]:
+    '''Change of the usage of each device by key between two reports'''
+    result = {}
+    for key in sorted(set(old) | set(new)):
+        delta = dict(new.get(key, {}))
+        add_usage(delta, {
+            device: -value for (device, value) in old.get(key, {}).items()})
+        delta = {
+            device: value for (device, value) in delta.items() if value != 0}
+        if len(delta) > 0:
+            result[key] = delta
+    return result
+
+
+def print_changes(title: str, changes: Dict[str, Usage]):
+    print(f'{title}:')
+    if len(changes) == 0:
+        print('  no change')
+    for (key, delta) in sorted(
+            changes.items(), key=lambda item: -sum(item[1].values())):
+        devices = ', '.join(
+            f'{device} {value:+,d}' for (device, value) in sorted(
+                delta.items()))
+        print(f'  {key}: {devices}')
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog='kanod-image-builder footprint',
+        description='Compare the footprint reports of two builds')
+    parser.add_argument('old', help='footprint report of the reference')
+    parser.add_argument('new', help='footprint report of the new build')
+    args = parser.parse_args(argv)
+    with open(args.old, encoding='utf-8') as fd:
+        old = json.load(fd)
+    with open(args.new, encoding='utf-8') as fd:
+        new = json.load(fd)
+    print_changes('Devices', compare(
+        {'total': old['total']}, {'total': new['total']}))
+    print_changes('Elements', compare(old['elements'], new['elements']))
+    print_changes('Packages', compare(old['packages'], new['packages']))
@@ -0,0 +1,158 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Base layer snapshots shared by the variants of a matrix.
+
+Builds with the same DIB_* environment are grouped together. Their base
+layer is made of the elements and packages common to all the builds of the
+group, except block device layouts. The root filesystem of the base layer is
+captured once by the kanod-layer element and variant builds start from this
+snapshot.
+'''
+
+import copy
+import os
+from os import path
+import shutil
+import tempfile
+
+from typing import Dict, List, Optional, Tuple  # noqa: H301
+
+from kanod_image_builder import cache as image_cache
+
+LAYER_ELEMENT = 'kanod-layer'
+
+
+def common_items(lists: List[List[str]]) -> List[str]:
+    '''Items present in every list, in the order of the first one'''
+    others = [set(items) for items in lists[1:]]
+    return [
+        item for item in lists[0]
+        if all(item in items for items in others)]
+
+
+def base_layer(image_builders) -> Tuple[List[str], List[str]]:
+    '''Elements and packages of the base layer of a group of builds'''
+    elements = [
+        element
+        for element in common_items([b.elements for b in image_builders])
+        if not element.startswith('block-device-')]
+    packages = common_items([b.packages for b in image_builders])
+    return (elements, packages)
+
+
+def group_key(image_builder) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted(
+        (key, value) for (key, value) in image_builder.osEnv.items()
+        if key.startswith('DIB_')))
+
+
+def with_layer(image_builder, elements=None, packages=None):
+    '''Copy of a builder using the kanod-layer element'''
+    layer_builder = copy.copy(image_builder)
+    layer_builder.osEnv = dict(image_builder.osEnv)
+    layer_builder.elements = list(
+        image_builder.elements if elements is None else elements)
+    layer_builder.elements.append(LAYER_ELEMENT)
+    layer_builder.packages = list(
+        image_builder.packages if packages is None else packages)
+    return layer_builder
+
+
+def layer_options(options):
+    '''Build options used for the capture of a base layer
+
+    The layer is neither an image to cache, optimize or measure nor a build
+    to time. It keeps the shared caches and the resources of the build.
+    '''
+    if options is None:
+        return None
+    layer = copy.copy(options)
+    layer.cache = None
+    layer.timing = False
+    layer.optimize = None
+    layer.footprint = False
+    layer.workspace = None
+    return layer
+
+
+class LayerStore:
+    '''Folder of base layer snapshots indexed by the digest of the layer'''
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def snapshot(self, key: str) -> Optional[str]:
+        folder = path.join(self.root, key)
+        if path.isfile(path.join(folder, 'hooks')):
+            return folder
+        return None
+
+    def capture(
+        self, base_builder, key: str, workdir: str, options=None
+    ) -> str:
+        '''Build the base layer and save its snapshot'''
+        build_dir = path.join(workdir, f'layer-{key[:12]}')
+        os.makedirs(build_dir, exist_ok=True)
+        target = tempfile.mkdtemp(dir=self.root, prefix=f'.{key}-')
+        base_builder.setenv('DIB_KANOD_LAYER_CAPTURE', target)
+        try:
+            with open(path.join(build_dir, 'build.log'), 'w',
+                      encoding='utf-8') as log:
+                base_builder.run(
+                    path.join(build_dir, 'layer.tar'), '', 'tar',
+                    workdir=build_dir, log=log,
+                    options=layer_options(options))
+            try:
+                os.rename(target, path.join(self.root, key))
+            except OSError:
+                # Another build captured the same layer concurrently.
+                shutil.rmtree(target)
+        except BaseException:
+            shutil.rmtree(target, ignore_errors=True)
+            raise
+        finally:
+            image = path.join(build_dir, 'layer.tar')
+            if path.isfile(image):
+                os.remove(image)
+        return path.join(self.root, key)
+
+
+def plan_layers(image_builders) -> Dict[str, Tuple[object, List[int]]]:
+    '''Compute the base layers of a list of compiled builders
+
+    :return: for each layer digest, the builder of the base layer and the
+        indices of the builds using it.
+    '''
+    groups: Dict[Tuple[Tuple[str, str], ...], List[int]] = {}
+    for (index, image_builder) in enumerate(image_builders):
+        groups.setdefault(group_key(image_builder), []).append(index)
+    layers = {}
+    for indices in groups.values():
+        members = [image_builders[i] for i in indices]
+        (elements, packages) = base_layer(members)
+        if len(elements) == 0:
+            continue
+        base_builder = with_layer(members[0], elements, packages)
+        key = image_cache.recipe_digest(base_builder, 'layer', '')
+        layers[key] = (base_builder, indices)
+    return layers
+
+
+def restore_from(image_builder, snapshot: str):
+    '''Builder of a variant starting from a base layer snapshot'''
+    variant_builder = with_layer(image_builder)
+    variant_builder.setenv('DIB_KANOD_LAYER_RESTORE', snapshot)
+    return variant_builder
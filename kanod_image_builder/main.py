@@ -13,95 +13,223 @@
 #    under the License.
 
 import argparse
+import copy
 import importlib
+from importlib import resources
 import os
 import sys
 from os import path
-import pkg_resources
-import re
+import shutil
 import subprocess
+import tempfile
 
-import jinja2
-import jsonschema
 import yaml
 
-from typing import Any, Dict, List  # noqa: H301
+from kanod_image_builder import recipes as compiled
 
+from typing import Any, Dict, List, Optional  # noqa: H301
 
-def filter_regex_replace(value, pat, target):
-    return re.sub(pat, target, value)
+# jinja2, jsonschema and the cache are imported only when needed: commands
+# like plan are called very often and must start quickly.
+
+COMMANDS = {
+    'matrix': 'kanod_image_builder.matrix',
+    'plan': 'kanod_image_builder.plan',
+    'affected': 'kanod_image_builder.affected',
+    'serve': 'kanod_image_builder.serve',
+    'delta': 'kanod_image_builder.delta',
+    'apply': 'kanod_image_builder.apply',
+    'footprint': 'kanod_image_builder.footprint',
+    'patch': 'kanod_image_builder.patch',
+}
+
+# Element writing the CIS compliance report in DIB_KANOD_CIS_REPORT.
+CIS_ELEMENT = 'cis-remediation'
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def read_resource(package: str, name: str) -> str:
+    if hasattr(resources, 'files'):
+        return resources.files(package).joinpath(name).read_text(
+            encoding='utf-8')
+    return resources.read_text(package, name, encoding='utf-8')
+
+
+def module_folder(package: str) -> str:
+    '''Folder containing a module with a recipe configuration'''
+    if hasattr(resources, 'files'):
+        return str(resources.files(package))
+    module = importlib.import_module(package)
+    return path.dirname(module.__file__)
+
+
+def load_schema(name):
+    '''Load one of the json schemas shipped with the builder'''
+    return yaml.load(read_resource(__package__, name), Loader=YamlLoader)
+
+
+def make_validator(schema):
+    import jsonschema
+    return jsonschema.Draft7Validator(schema)
+
+
+def report_errors(validator, content, location):
+    '''Print validation errors and fail if there is any.'''
+    errors = 0
+    for error in validator.iter_errors(content):
+        errors += 1
+        msg = error.message.replace('\n', '\n  ')
+        err_path = '.'.join([str(e) for e in error.absolute_path])
+        print(f'* {msg}')
+        print(f'  at {"." if err_path == "" else err_path}')
+    if errors > 0:
+        raise Exception(
+            f'Invalid configuration ({errors} error(s)) in {location}')
+
+
+class BuildOptions:
+    '''Options of a build given besides its recipe
+
+    :param cache: a cache of images indexed by the digest of the recipe
+    :param timing: save the timing of phases and scripts of the build in
+        name.timing.json and as a Chrome trace in name.trace.json
+    :param package_cache: a distribution package cache shared by builds.
+        It does not change the image and is not part of its digest.
+    :param proxy: a caching download proxy used in the chroot. It is not
+        part of the digest either.
+    :param artifact_cache: a cache of components compiled from source
+        shared by builds. It is not part of the digest either.
+    :param parallelism: processors and memory given to the build,
+        exported to elements and to the conversion of the image. It is
+        not part of the digest either.
+    :param optimize: options of the optimizer stage run on the raw image
+        produced by diskimage-builder before its conversion to format.
+        They are part of the digest.
+    :param footprint: save the disk usage of each device of the image by
+        element and package in name.footprint.json. The image is built
+        even if it is in the cache.
+    :param workspace: placement of the chroot and of the image while
+        they are built: auto, tmpfs or disk. The tmpfs policy of
+        diskimage-builder is used if None. It is not part of the digest.
+    :param base_images: a store of the base cloud images given by an
+        http(s) URL in the image variable or by image=- on Ubuntu. The
+        upstream checksum of the base image is part of the digest.
+    '''
+
+    def __init__(
+        self, cache=None, timing: bool = False, package_cache=None,
+        proxy=None, artifact_cache=None, parallelism=None,
+        optimize: Optional[Dict[str, Any]] = None, footprint: bool = False,
+        workspace: Optional[str] = None, base_images=None
+    ):
+        self.cache = cache
+        self.timing = timing
+        self.package_cache = package_cache
+        self.proxy = proxy
+        self.artifact_cache = artifact_cache
+        self.parallelism = parallelism
+        self.optimize = optimize
+        self.footprint = footprint
+        self.workspace = workspace
+        self.base_images = base_images
+
+    def with_parallelism(self, parallelism) -> 'BuildOptions':
+        '''Copy of the options giving other resources to the build'''
+        options = copy.copy(self)
+        options.parallelism = parallelism
+        return options
 
 
 class ImageBuilder:
     '''Parameters of call to diskimage-builder'''
 
-    def __init__(self):
+    def __init__(self, validate: bool = True):
+        self.validate = validate
         self.folders = []
         self.bools = []
         self.vars = {}
         self.options: List[Any] = []
         self.shell_env: List[Any] = []
         self.recipes: List[Any] = []
+        self.bindings: List[compiled.Binding] = []
+        self.recipe_index = compiled.RecipeIndex()
         self.packages: List[str] = []
         self.elements: List[str] = []
         self.osEnv: Dict[str, str] = {}
-        self.env = jinja2.Environment()
-        self.env.filters['regex_replace'] = filter_regex_replace
-        schema_string = pkg_resources.resource_string(
-            __name__, 'schema_config.yaml')
-        schema = yaml.safe_load(schema_string)
-        self.validator = jsonschema.Draft7Validator(schema)
+        self.digest: Optional[str] = None
+        self.cache_hit = False
+        self.timings: Optional[Dict[str, Any]] = None
+        self.optimization: Optional[Dict[str, Any]] = None
+        self.footprint: Optional[Dict[str, Any]] = None
+        self.workspace: Optional[Dict[str, Any]] = None
+        self.base_image: Optional[Dict[str, str]] = None
+        self._validator = None
+
+    @property
+    def env(self):
+        '''Jinja2 environment used for the expansion of templates'''
+        return compiled.jinja_environment()
+
+    @property
+    def validator(self):
+        if self._validator is None:
+            self._validator = make_validator(
+                load_schema('schema_config.yaml'))
+        return self._validator
 
     def setenv(self, var, value):
-        os.environ[var] = value
+        '''Set a variable in the environment of the build.
+
+        The environment of the builder process is left untouched so that
+        several builds can be run concurrently from the same process.
+        '''
         self.osEnv[var] = value
 
+    def environment(self):
+        '''Complete environment given to diskimage-builder'''
+        env = dict(os.environ)
+        env.update(self.osEnv)
+        return env
+
     def parse(self, modname):
         '''Parse a yaml config'''
-        module = importlib.import_module(modname)
-        folder = pkg_resources.resource_filename(module.__name__, '/')
+        self.parse_config(
+            module_folder(modname), read_resource(modname, 'config.yaml'))
+
+    def parse_config(self, folder: str, content: str):
+        '''Parse the content of the yaml config of the module in folder'''
+        config = yaml.load(content, Loader=YamlLoader)
+        if self.validate:
+            report_errors(self.validator, config, folder)
+        self.add_config(folder, config)
+
+    def add_config(self, folder: str, config: Dict[str, Any]):
+        '''Add the parsed config of the module in folder
+
+        The config is not modified and may be shared between builders.
+        '''
         self.folders += [folder]
-        with open(
-            path.join(folder, 'config.yaml'),
-            mode='r', encoding='utf-8'
-        ) as fd:
-            config = yaml.safe_load(fd)
-            errors = 0
-            for error in self.validator.iter_errors(config):
-                errors += 1
-                msg = error.message.replace('\n', '\n  ')
-                err_path = '.'.join([str(e) for e in error.absolute_path])
-                print(f'* {msg}')
-                print(f'  at {"." if err_path == "" else err_path}')
-            if errors > 0:
-                raise Exception(
-                    f'Invalid configuration ({errors} error(s)) in {folder}')
-            self.options += config.get('options', [])
-            self.shell_env += config.get('env', [])
-            self.recipes += config.get('recipes', [])
+        self.options += config.get('options', [])
+        self.shell_env += config.get('env', [])
+        self.recipes += config.get('recipes', [])
+        for env in config.get('env', []):
+            if env.get('name', None) is None or env.get('value') is None:
+                continue
+            self.bindings.append(compiled.Binding(env))
+        for recipe in config.get('recipes', []):
+            self.recipe_index.add(compiled.Recipe(recipe))
 
     def valid(self, elt):
-        when = elt.get('when', None)
-        if when is not None:
-            for cond in when:
-                if cond[0] == '!':
-                    ifValid = False
-                    cond = cond[1:]
-                else:
-                    ifValid = True
-                if '=' in cond:
-                    [key, value] = cond.split('=', 1)
-                    if (self.vars.get(key, None) != value) == ifValid:
-                        return False
-                else:
-                    check = (cond not in self.bools and cond not in self.vars)
-                    if check == ifValid:
-                        return False
-        return True
+        '''Check the when clause of a raw configuration element'''
+        condition = compiled.Condition(elt.get('when', None))
+        return condition.holds(set(self.bools), self.vars)
 
     def expand(self, value):
         "Jinja2 expansion of a template"
-        return self.env.from_string(value).render(self.vars)
+        if isinstance(value, compiled.Template):
+            return value.render(self.vars)
+        return compiled.Template(value).render(self.vars)
 
     def compute_git_url(self):
         """Compute the current git URL if possible.
@@ -110,7 +238,7 @@ class ImageBuilder:
         often used in elements. This makes possible having reference
         relative to the current git server.
         """
-        if 'DIB_KANOD_GIT_URL' in os.environ:
+        if 'DIB_KANOD_GIT_URL' in self.environment():
             return
         try:
             command = ['git', 'remote', 'get-url', 'origin']
@@ -145,63 +273,246 @@ class ImageBuilder:
             else:
                 raise Exception(f'Unknown kind {kind}')
 
-        for env in self.shell_env:
-            if not self.valid(env):
-                continue
-            name = env.get('name', None)
-            value = env.get('value', None)
-            if name is None or value is None:
-                continue
-            self.setenv(name, self.expand(value))
+        bools = set(self.bools)
+        for binding in self.bindings:
+            if binding.condition.holds(bools, self.vars):
+                self.setenv(binding.name, self.expand(binding.value))
 
-        for recipe in self.recipes:
-            if not self.valid(recipe):
+        packages = compiled.OrderedSet(self.packages)
+        elements = compiled.OrderedSet(self.elements)
+        for recipe in self.recipe_index.candidates(bools, self.vars):
+            if not recipe.condition.holds(bools, self.vars):
                 continue
+            for package in recipe.packages:
+                packages.update(self.expand(package))
+            for element in recipe.elements:
+                elements.update(self.expand(element))
+        self.packages = list(packages)
+        self.elements = list(elements)
 
-            def update(list, entry):
-                new_content = recipe.get(entry, [])
-                for raw_elt in new_content:
-                    elt = self.expand(raw_elt)
-                    if elt[0] == '!':
-                        elt = elt[1:]
-                        list[:] = [p for p in list if p != elt]
-                    else:
-                        list.append(elt)
-
-            update(self.packages, 'packages')
-            update(self.elements, 'elements')
-
-    def run(self, name, additional, format):
-        elements_path = [
+    def elements_path(self):
+        return ':'.join(
             path.abspath(path.join(folder, 'elements'))
-            for folder in self.folders]
-        self.setenv('ELEMENTS_PATH', ':'.join(elements_path))
+            for folder in self.folders)
+
+    def preflight(
+        self, elements: Optional[List[str]] = None, additional: str = '',
+        package_index=None
+    ):
+        '''Check the build before launching diskimage-builder
+
+        Missing elements, conflicting element-provides and files defined by
+        several elements are reported. With a package index, packages
+        missing from the repositories of the mirror are reported too.
+
+        :param elements: elements of the build if not the compiled ones.
+        :param additional: comma separated list of additional packages
+        :param package_index: index of the packages of the repositories.
+        :raise Exception: listing every problem found.
+        '''
+        from kanod_image_builder import elements as element_graph
+        problems = element_graph.check(
+            self.elements if elements is None else elements,
+            self.elements_path())
+        if package_index is not None:
+            from kanod_image_builder import package_index as pkg_index
+            problems += pkg_index.check(self, additional, package_index)
+        if len(problems) > 0:
+            raise Exception(
+                'Pre-flight check failed:\n' +
+                '\n'.join(f'  - {problem}' for problem in problems))
+
+    def run(
+        self, name, additional, format,
+        workdir: Optional[str] = None, log=None,
+        options: Optional[BuildOptions] = None
+    ):
+        '''Launch diskimage-builder
+
+        :param name: name of the image produced
+        :param additional: comma separated list of additional packages
+        :param format: format of the image
+        :param workdir: a private folder for the temporary files of the build
+        :param log: a file receiving the output of diskimage-builder
+        :param options: caches, stages and resources of the build given
+            besides its recipe
+        '''
+        if options is None:
+            options = BuildOptions()
+        self.setenv('ELEMENTS_PATH', self.elements_path())
         self.setenv('PATH', (
             f"{path.dirname(sys.executable)}:" +
             '/usr/local/bin:' + path.join(os.environ['HOME'], '.local/bin') +
             ':/usr/bin:/usr/sbin:/bin:/sbin'))
+        if workdir is not None:
+            tmp_dir = path.join(workdir, 'tmp')
+            os.makedirs(tmp_dir, exist_ok=True)
+            self.setenv('TMP_DIR', path.abspath(tmp_dir))
+        env = self.environment()
         packages = ','.join(self.packages)
+        output = path.abspath(name)
+        if options.optimize is not None:
+            from kanod_image_builder import optimize as optimizer
+            if format not in optimizer.FORMATS:
+                raise Exception(
+                    f'The optimizer does not support {format} images')
+            output = optimizer.raw_name(output, format)
         command = [
-            'disk-image-create', '-a', 'amd64', '-t', format, '-o', name,
+            'disk-image-create', '-a', 'amd64',
+            '-t', format if options.optimize is None else 'raw', '-o', output,
             '-p', packages, '-p', additional
-        ] + self.elements
-        if os.environ.get('KANOD_IMAGE_DEBUG', None) is not None:
-            with open(os.environ['KANOD_IMAGE_DEBUG'], 'w') as fd:
+        ]
+        first_element = len(command)
+        command += self.elements
+        if env.get('KANOD_IMAGE_DEBUG', None) is not None:
+            with open(env['KANOD_IMAGE_DEBUG'], 'w') as fd:
                 fd.write('#!/bin/bash\n\n')
                 for (var, value) in self.osEnv.items():
                     fd.write(f'{var}={value}\n')
                 fd.write(' '.join(command))
                 fd.write('\n')
-        subprocess.run(command, check=True)
+        if options.base_images is not None:
+            self.base_image = options.base_images.source(self)
+        if options.cache is not None:
+            from kanod_image_builder import cache as image_cache
+            self.digest = image_cache.recipe_digest(
+                self, format, additional, options.optimize)
+            key = f'{self.digest}.{format}'
+            if not options.footprint and options.cache.fetch(key, name):
+                self.cache_hit = True
+                print(f'Image {name} reused from cache ({self.digest})',
+                      file=log or sys.stdout, flush=True)
+                return
+        if options.package_cache is not None:
+            from kanod_image_builder import package_cache as pkg_cache
+            env['DIB_KANOD_PACKAGE_CACHE'] = options.package_cache.root
+            command.append(pkg_cache.PACKAGE_CACHE_ELEMENT)
+        if options.proxy is not None:
+            from kanod_image_builder import proxy as download_proxy
+            env.update(options.proxy.environment())
+            command.append(download_proxy.DOWNLOAD_CACHE_ELEMENT)
+        if options.artifact_cache is not None:
+            from kanod_image_builder import artifact_cache as artifacts
+            env['DIB_KANOD_ARTIFACT_CACHE'] = options.artifact_cache.root
+            command.append(artifacts.ARTIFACT_CACHE_ELEMENT)
+        if options.footprint:
+            from kanod_image_builder import footprint as image_footprint
+            command.append(image_footprint.FOOTPRINT_ELEMENT)
+        if CIS_ELEMENT in self.elements:
+            env['DIB_KANOD_CIS_REPORT'] = path.abspath(f'{name}.cis.json')
+        self.preflight(command[first_element:])
+        tmp_dir = None if workdir is None else env['TMP_DIR']
+        work = None
+        if options.workspace is not None:
+            from kanod_image_builder import workspace as build_workspace
+            self.workspace = build_workspace.decide(
+                options.workspace, env, command[first_element:],
+                env['ELEMENTS_PATH'])
+            work = build_workspace.Workspace(self.workspace, tmp_dir)
+            work.mount(log)
+            env.update(work.environment())
+            tmp_dir = work.folder
+            print(build_workspace.summary(self.workspace),
+                  file=log or sys.stdout, flush=True)
+        lease = None
+        try:
+            if self.base_image is not None:
+                from kanod_image_builder import base_images as images
+                lease = options.base_images.acquire(self.base_image, log)
+                env['DIB_LOCAL_IMAGE'] = lease.path
+                print(images.summary(self.base_image, lease),
+                      file=log or sys.stdout, flush=True)
+            self.run_dib(
+                command, env, workdir, log, name, options.timing,
+                options.parallelism, options.footprint, tmp_dir)
+        finally:
+            if lease is not None:
+                lease.release()
+            if work is not None:
+                work.release(log)
+        if options.optimize is not None:
+            coroutines = (
+                None if options.parallelism is None
+                else options.parallelism.coroutines)
+            self.optimization = optimizer.optimize_image(
+                output, path.abspath(name), format,
+                options.optimize['cluster_size'], coroutines, log)
+            print(optimizer.summary(self.optimization),
+                  file=log or sys.stdout, flush=True)
+        if options.cache is not None and path.isfile(name):
+            options.cache.store(key, name)
 
+    def run_dib(
+        self, command, env, workdir, log, name, timing, parallelism,
+        footprint, tmp_dir
+    ):
+        '''Run diskimage-builder with the tools and records of the build
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('modules', nargs='*')
-    parser.add_argument(
-        '--output', '-o',
-        help='name of the image'
-    )
+        :param tmp_dir: folder of the temporary files of the build.
+        '''
+        wrappers = None
+        if parallelism is not None:
+            env.update(parallelism.environment())
+            wrappers = parallelism.wrappers(env['PATH'], tmp_dir)
+            if wrappers is not None:
+                env['PATH'] = f'{wrappers}:{env["PATH"]}'
+        footprint_dir = None
+        if footprint:
+            footprint_dir = tempfile.mkdtemp(
+                prefix='kanod-footprint-', dir=tmp_dir)
+            env['DIB_KANOD_FOOTPRINT'] = footprint_dir
+        try:
+            if timing:
+                self.run_timed(command, env, workdir, log, name)
+            else:
+                subprocess.run(
+                    command, check=True, env=env, cwd=workdir, stdout=log,
+                    stderr=None if log is None else subprocess.STDOUT)
+        except BaseException:
+            if footprint_dir is not None:
+                shutil.rmtree(footprint_dir, ignore_errors=True)
+            raise
+        finally:
+            if wrappers is not None:
+                shutil.rmtree(wrappers, ignore_errors=True)
+        if footprint_dir is not None:
+            self.save_footprint(footprint_dir, env['ELEMENTS_PATH'], name, log)
+
+    def save_footprint(self, folder, elements_path, name, log):
+        '''Write the footprint report of the build and remove its records'''
+        from kanod_image_builder import footprint as image_footprint
+        from kanod_image_builder import timing as build_timing
+        try:
+            self.footprint = image_footprint.make_report(
+                folder, build_timing.script_owners(elements_path))
+            filename = image_footprint.write_report(self.footprint, name)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        print(f'Footprint of {name} saved in {filename}',
+              file=log or sys.stdout, flush=True)
+
+    def run_timed(self, command, env, workdir, log, name):
+        '''Run diskimage-builder and analyze its output'''
+        from kanod_image_builder import timing as build_timing
+        parser = build_timing.TimingParser(
+            build_timing.script_owners(env['ELEMENTS_PATH']))
+        out = log or sys.stdout
+        with subprocess.Popen(
+            command, env=env, cwd=workdir, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, encoding='utf-8', errors='replace'
+        ) as proc:
+            for line in proc.stdout:
+                out.write(line)
+                parser.feed(line)
+            status = proc.wait()
+        self.timings = parser.report()
+        build_timing.write_reports(self.timings, name)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, command)
+
+
+def add_recipe_arguments(parser):
+    '''Arguments selecting the elements of a build'''
     parser.add_argument(
         '--bool', '-b', default=[], action='append',
         help='Define a boolean flag'
@@ -210,6 +521,11 @@ def main():
         '--set', '-s', default=[], action='append', dest='decl',
         help='Define a variable with syntax key=value'
     )
+
+
+def add_build_arguments(parser):
+    '''Arguments defining a single build'''
+    add_recipe_arguments(parser)
     parser.add_argument(
         '--format', '-t', default='qcow2',
         help='Format of the image'
@@ -218,25 +534,333 @@ def main():
         '--packages', '-p', default='',
         help='Additional packages (single comma separated list)'
     )
-    args = parser.parse_args()
-    image_builder = ImageBuilder()
-    flags = args.bool
+
+
+def add_timing_arguments(parser):
+    parser.add_argument(
+        '--timing', action='store_true',
+        help='Save the timing of the build phases and scripts'
+    )
+    parser.add_argument(
+        '--footprint', action='store_true',
+        help='Save the disk usage of the image by element and package'
+    )
+
+
+def add_postbuild_arguments(parser):
+    parser.add_argument(
+        '--digest', action='store_true',
+        help='Compute the checksums and size of the image in a manifest'
+    )
+    parser.add_argument(
+        '--compress', choices=['gz', 'zstd', 'xz'], default=None,
+        help='Compress the image (implies --digest)'
+    )
+    parser.add_argument(
+        '--keep-image', action='store_true',
+        help='Keep the uncompressed image after compression'
+    )
+    parser.add_argument(
+        '--sparse', action='store_true',
+        help='Archive a raw image as an Android sparse image'
+    )
+
+
+def postbuild_options(args) -> Optional[Dict[str, Any]]:
+    '''Options of the post-build stage or None if it is not requested'''
+    if not args.digest and args.compress is None and not args.sparse:
+        return None
+    return {
+        'compress': args.compress, 'keep': args.keep_image,
+        'sparse': args.sparse}
+
+
+def run_postbuild(
+    image: str, format: str, options: Dict[str, Any],
+    threads: Optional[int] = None
+) -> Dict[str, Any]:
+    from kanod_image_builder import postbuild
+    return postbuild.process_image(
+        image, format, postbuild.DIGESTS, threads=threads, **options)
+
+
+def add_optimize_arguments(parser):
+    parser.add_argument(
+        '--optimize', action='store_true',
+        help='Discard the free space of the filesystems of the image and '
+             'compress qcow2 images with zstd'
+    )
+    parser.add_argument(
+        '--cluster-size', default=None,
+        help='Cluster size of optimized qcow2 images (default 1M)'
+    )
+
+
+def optimize_options(args) -> Optional[Dict[str, Any]]:
+    '''Options of the optimizer stage or None if it is not requested'''
+    if not args.optimize:
+        return None
+    from kanod_image_builder import cache as image_cache
+    from kanod_image_builder import optimize as optimizer
+    return {'cluster_size': image_cache.parse_size(
+        args.cluster_size or optimizer.DEFAULT_CLUSTER_SIZE)}
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        '--cache', default=os.environ.get('KANOD_IMAGE_CACHE', None),
+        help='Folder or http(s) URL of a cache of built images'
+    )
+    parser.add_argument(
+        '--cache-size', default=None,
+        help='Maximum size of a local cache (eg. 200G)'
+    )
+
+
+def add_package_cache_arguments(parser):
+    parser.add_argument(
+        '--package-cache',
+        default=os.environ.get('KANOD_PACKAGE_CACHE', None),
+        help='Folder of distribution packages shared by builds'
+    )
+    parser.add_argument(
+        '--package-cache-size', default=None,
+        help='Maximum size of the package cache (eg. 20G)'
+    )
+
+
+def add_artifact_cache_arguments(parser):
+    parser.add_argument(
+        '--artifact-cache',
+        default=os.environ.get('KANOD_ARTIFACT_CACHE', None),
+        help='Folder of the components compiled from source shared by builds'
+    )
+    parser.add_argument(
+        '--artifact-cache-size', default=None,
+        help='Maximum size of the artifact cache (eg. 5G)'
+    )
+
+
+def add_package_index_arguments(parser):
+    parser.add_argument(
+        '--package-index',
+        default=os.environ.get('KANOD_PACKAGE_INDEX', None),
+        help='Folder of the package indexes of the mirrors: check that the '
+             'packages of builds exist before launching them'
+    )
+
+
+def add_parallelism_arguments(parser):
+    parser.add_argument(
+        '--parallelism', type=int,
+        default=os.environ.get('KANOD_PARALLELISM', None),
+        help='Processors used by the builds (default: limit of the cgroup '
+             'or processors of the host)'
+    )
+    parser.add_argument(
+        '--workspace', choices=['auto', 'tmpfs', 'disk'],
+        default=os.environ.get('KANOD_WORKSPACE', 'auto'),
+        help='Placement of the chroot and of the image during the build '
+             '(default: tmpfs if the memory of the build is large enough)'
+    )
+
+
+def add_download_cache_arguments(parser):
+    parser.add_argument(
+        '--download-cache',
+        default=os.environ.get('KANOD_DOWNLOAD_CACHE', None),
+        help='Folder of the files downloaded during builds'
+    )
+    parser.add_argument(
+        '--download-cache-size', default=None,
+        help='Maximum size of the download cache (eg. 50G)'
+    )
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='Only use the content of the caches for downloads'
+    )
+
+
+def add_base_image_arguments(parser):
+    parser.add_argument(
+        '--base-image-cache',
+        default=os.environ.get('KANOD_BASE_IMAGE_CACHE', None),
+        help='Folder of the base cloud images verified and decompressed by '
+             'the builder'
+    )
+    parser.add_argument(
+        '--base-image-cache-size', default=None,
+        help='Maximum size of the base image cache (eg. 20G)'
+    )
+
+
+def parse_bindings(decls: List[str]) -> Dict[str, str]:
     vars = {}
-    for decl in args.decl:
+    for decl in decls:
         if '=' in decl:
             [key, val] = decl.split('=', 1)
             vars[key.strip()] = val.strip()
         else:
             raise Exception(f'Incorrect binding syntax {decl}')
+    return vars
 
-    modules = ['kanod_image_builder'] + args.modules
 
-    for module in modules:
+def make_builder(
+    modules: List[str], flags: List[str], vars: Dict[str, str],
+    validate: bool = True
+) -> ImageBuilder:
+    '''Create a builder with the compiled configuration of the modules'''
+    image_builder = ImageBuilder(validate=validate)
+    for module in ['kanod_image_builder'] + modules:
         image_builder.parse(module)
-
     image_builder.compute_git_url()
     image_builder.compile(flags, vars)
-    output = args.output or 'img'
+    return image_builder
+
+
+def open_cache(args):
+    if args.cache is None:
+        return None
+    from kanod_image_builder import cache as image_cache
+    return image_cache.open_cache(args.cache, args.cache_size)
+
+
+def open_package_cache(args):
+    '''Open the package cache and evict packages above its size limit'''
+    if args.package_cache is None:
+        return None
+    from kanod_image_builder import cache as image_cache
+    from kanod_image_builder import package_cache as pkg_cache
+    max_size = (
+        None if args.package_cache_size is None
+        else image_cache.parse_size(args.package_cache_size))
+    package_cache = pkg_cache.PackageCache(args.package_cache, max_size)
+    package_cache.evict()
+    return package_cache
+
+
+def open_artifact_cache(args):
+    '''Open the artifact cache and evict artifacts above its size limit'''
+    if args.artifact_cache is None:
+        return None
+    from kanod_image_builder import artifact_cache as artifacts
+    from kanod_image_builder import cache as image_cache
+    max_size = (
+        None if args.artifact_cache_size is None
+        else image_cache.parse_size(args.artifact_cache_size))
+    artifact_cache = artifacts.ArtifactCache(args.artifact_cache, max_size)
+    artifact_cache.evict()
+    return artifact_cache
+
+
+def open_base_images(args):
+    '''Open the base image cache and evict images above its size limit'''
+    if args.base_image_cache is None:
+        return None
+    from kanod_image_builder import base_images as images
+    from kanod_image_builder import cache as image_cache
+    max_size = (
+        None if args.base_image_cache_size is None
+        else image_cache.parse_size(args.base_image_cache_size))
+    base_images = images.BaseImageStore(
+        args.base_image_cache, max_size, args.offline)
+    base_images.evict()
+    return base_images
+
+
+def open_package_index(args):
+    if args.package_index is None:
+        return None
+    from kanod_image_builder import package_index as pkg_index
+    return pkg_index.PackageIndex(args.package_index)
+
+
+def open_parallelism(args):
+    '''Processors and memory usable by the builds'''
+    from kanod_image_builder import parallelism
+    return parallelism.Parallelism.detect(args.parallelism)
+
+
+def open_proxy(args):
+    '''Start the caching download proxy used by the builds'''
+    if args.download_cache is None:
+        if args.offline and args.base_image_cache is None:
+            raise Exception(
+                '--offline requires a download cache or a base image cache')
+        return None
+    from kanod_image_builder import cache as image_cache
+    from kanod_image_builder import proxy as download_proxy
+    max_size = (
+        None if args.download_cache_size is None
+        else image_cache.parse_size(args.download_cache_size))
+    return download_proxy.open_proxy(
+        args.download_cache, max_size, args.offline)
+
+
+def build_options(args, proxy=None) -> BuildOptions:
+    '''Open the caches and stores of the builds given on the command line
+
+    :param proxy: the download proxy, started and stopped by the caller.
+    '''
+    return BuildOptions(
+        cache=open_cache(args), timing=args.timing,
+        package_cache=open_package_cache(args), proxy=proxy,
+        artifact_cache=open_artifact_cache(args),
+        parallelism=open_parallelism(args), optimize=optimize_options(args),
+        footprint=args.footprint, workspace=args.workspace,
+        base_images=open_base_images(args))
+
+
+def image_name(output: Optional[str], format: str) -> str:
+    output = output or 'img'
     if '.' not in output:
-        output = f'{output}.{args.format}'
-    image_builder.run(output, args.packages, args.format)
+        output = f'{output}.{format}'
+    return output
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        command = importlib.import_module(COMMANDS[sys.argv[1]])
+        command.main(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*')
+    parser.add_argument(
+        '--output', '-o',
+        help='name of the image'
+    )
+    add_build_arguments(parser)
+    add_cache_arguments(parser)
+    add_timing_arguments(parser)
+    add_optimize_arguments(parser)
+    add_postbuild_arguments(parser)
+    add_package_cache_arguments(parser)
+    add_artifact_cache_arguments(parser)
+    add_download_cache_arguments(parser)
+    add_base_image_arguments(parser)
+    add_package_index_arguments(parser)
+    add_parallelism_arguments(parser)
+    args = parser.parse_args()
+    vars = parse_bindings(args.decl)
+    image_builder = make_builder(args.modules, args.bool, vars)
+    output = image_name(args.output, args.format)
+    package_index = open_package_index(args)
+    if package_index is not None:
+        image_builder.preflight(
+            additional=args.packages, package_index=package_index)
+    proxy = open_proxy(args)
+    try:
+        options = build_options(args, proxy)
+        image_builder.run(
+            output, args.packages, args.format, options=options)
+    finally:
+        if proxy is not None:
+            proxy.stop()
+    if options.package_cache is not None:
+        options.package_cache.evict()
+    if options.artifact_cache is not None:
+        options.artifact_cache.evict()
+    postbuild = postbuild_options(args)
+    if postbuild is not None:
+        run_postbuild(
+            output, args.format, postbuild, options.parallelism.threads)
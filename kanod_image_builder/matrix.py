@@ -0,0 +1,302 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Parallel build of a matrix of images.'''
+
+import argparse
+from concurrent import futures
+import itertools
+import json
+import os
+from os import path
+import tempfile
+import time
+
+import yaml
+
+from typing import Any, Dict, List, Optional, Tuple  # noqa: H301
+
+from kanod_image_builder import layers
+from kanod_image_builder import main as builder
+
+
+class Build:
+    '''Definition of a single build of the matrix'''
+
+    def __init__(self, name: str, modules: List[str]):
+        self.name = name
+        self.modules = modules
+        self.vars: Dict[str, str] = {}
+        self.flags: List[str] = []
+        self.format = 'qcow2'
+        self.packages = ''
+        self.output: Optional[str] = None
+
+    def merge(self, variant: Dict[str, Any]):
+        self.vars.update(variant.get('set', {}))
+        for flag in variant.get('bool', []):
+            if flag not in self.flags:
+                self.flags.append(flag)
+        self.format = variant.get('format', self.format)
+        self.packages = variant.get('packages', self.packages)
+        self.output = variant.get('output', self.output)
+
+    def image(self, output_dir: str) -> str:
+        return path.join(
+            output_dir, builder.image_name(self.output or self.name,
+                                           self.format))
+
+
+def load_matrix(filename: str) -> Tuple[int, List[Build]]:
+    '''Read and expand a matrix file
+
+    :return: the number of concurrent jobs and the list of builds
+    '''
+    with open(filename, mode='r', encoding='utf-8') as fd:
+        return parse_matrix(fd.read(), filename)
+
+
+def parse_matrix(content: str, filename: str) -> Tuple[int, List[Build]]:
+    '''Expand the content of a matrix file'''
+    spec = yaml.safe_load(content)
+    validator = builder.make_validator(
+        builder.load_schema('schema_matrix.yaml'))
+    builder.report_errors(validator, spec, filename)
+    modules = spec.get('modules', [])
+    defaults = spec.get('defaults', {})
+    combinations = [[variant] for variant in spec.get('builds', [])]
+    axes = spec.get('axes', [])
+    if len(axes) > 0:
+        combinations += [list(c) for c in itertools.product(*axes)]
+    builds = []
+    names = set()
+    for combination in combinations:
+        name = '-'.join(variant['name'] for variant in combination)
+        if name in names:
+            raise Exception(f'Build {name} defined twice in {filename}')
+        names.add(name)
+        build = Build(name, modules)
+        for variant in [defaults] + combination:
+            build.merge(variant)
+        builds.append(build)
+    if len(builds) == 0:
+        raise Exception(f'No build defined in {filename}')
+    return (spec.get('jobs', 1), builds)
+
+
+def run_build(
+    build: Build, image_builder: builder.ImageBuilder,
+    workdir: str, output_dir: str,
+    options: Optional[builder.BuildOptions] = None,
+    postbuild: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    '''Run a compiled build in its private work directory.'''
+    if options is None:
+        options = builder.BuildOptions()
+    build_dir = path.join(workdir, build.name)
+    os.makedirs(build_dir, exist_ok=True)
+    log_file = path.join(build_dir, 'build.log')
+    image = path.abspath(build.image(output_dir))
+    result: Dict[str, Any] = {
+        'name': build.name, 'image': image, 'log': log_file}
+    start = time.monotonic()
+    try:
+        with open(log_file, 'w', encoding='utf-8') as log:
+            image_builder.run(
+                image, build.packages, build.format,
+                workdir=build_dir, log=log, options=options)
+        result['cached'] = image_builder.cache_hit
+        if image_builder.optimization is not None:
+            result['optimized'] = image_builder.optimization
+        if image_builder.workspace is not None:
+            result['workspace'] = image_builder.workspace
+        if image_builder.base_image is not None:
+            result['base_image'] = image_builder.base_image
+        if image_builder.footprint is not None:
+            result['footprint'] = image_builder.footprint['total']
+        if postbuild is not None:
+            threads = (
+                None if options.parallelism is None
+                else options.parallelism.threads)
+            result['manifest'] = builder.run_postbuild(
+                image, build.format, postbuild, threads)
+        result['status'] = 'success'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    result['duration'] = round(time.monotonic() - start, 1)
+    if image_builder.timings is not None:
+        result['elements'] = image_builder.timings['elements']
+    return result
+
+
+def use_layers(
+    store: layers.LayerStore, image_builders, jobs: int, workdir: str,
+    options: Optional[builder.BuildOptions] = None
+):
+    '''Capture the missing base layers and rebase builds on them.
+
+    Layers used by a single build are only used if they already exist. If
+    the capture of a layer fails, its builds are done from scratch.
+    '''
+    plan = layers.plan_layers(image_builders)
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        captures = {
+            key: pool.submit(
+                store.capture, base_builder, key, workdir, options=options)
+            for (key, (base_builder, indices)) in plan.items()
+            if store.snapshot(key) is None and len(indices) > 1}
+        for (key, task) in captures.items():
+            try:
+                task.result()
+                print(f'base layer {key[:12]}: captured', flush=True)
+            except Exception as e:
+                print(f'base layer {key[:12]}: failed ({e})', flush=True)
+    result = list(image_builders)
+    for (key, (_, indices)) in plan.items():
+        snapshot = store.snapshot(key)
+        if snapshot is None:
+            continue
+        for index in indices:
+            result[index] = layers.restore_from(
+                image_builders[index], snapshot)
+    return result
+
+
+def preflight(builds: List[Build], image_builders, package_index=None):
+    '''Check all the builds before launching any'''
+    errors = []
+    for (build, image_builder) in zip(builds, image_builders):
+        try:
+            image_builder.preflight(
+                additional=build.packages, package_index=package_index)
+        except Exception as e:
+            errors.append(f'{build.name}: {e}')
+    if len(errors) > 0:
+        raise Exception('\n'.join(errors))
+
+
+def run_matrix(
+    builds: List[Build], jobs: int, workdir: str, output_dir: str,
+    options: Optional[builder.BuildOptions] = None,
+    layer_store: Optional[layers.LayerStore] = None,
+    postbuild: Optional[Dict[str, Any]] = None, package_index=None
+) -> List[Dict[str, Any]]:
+    '''Run the builds through a pool of at most jobs workers.
+
+    Configurations are compiled and their element graphs checked upfront
+    so that errors in the recipes are reported before any build is
+    launched. The processors and the memory are shared between concurrent
+    builds.
+    '''
+    image_builders = [
+        builder.make_builder(build.modules, build.flags, build.vars)
+        for build in builds]
+    preflight(builds, image_builders, package_index)
+    if options is None:
+        options = builder.BuildOptions()
+    parallelism = options.parallelism
+    if parallelism is None:
+        from kanod_image_builder import parallelism as resources
+        parallelism = resources.Parallelism.detect()
+    shared = options.with_parallelism(parallelism.share(jobs))
+    if layer_store is not None:
+        image_builders = use_layers(
+            layer_store, image_builders, jobs, workdir, options=shared)
+    compiled = list(zip(builds, image_builders))
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        tasks = [
+            pool.submit(
+                run_build, build, image_builder, workdir, output_dir,
+                options=shared, postbuild=postbuild)
+            for (build, image_builder) in compiled]
+        for task in futures.as_completed(tasks):
+            result = task.result()
+            print(f'{result["name"]}: {result["status"]} '
+                  f'({result["duration"]}s)', flush=True)
+        return [task.result() for task in tasks]
+
+
+def print_summary(results: List[Dict[str, Any]]):
+    width = max(len(result['name']) for result in results)
+    print()
+    print(f'{"Build":<{width}}  {"Status":<8}  {"Seconds":>8}  Log')
+    for result in results:
+        status = 'cached' if result.get('cached', False) else result['status']
+        print(f'{result["name"]:<{width}}  {status:<8}  '
+              f'{result["duration"]:>8}  {result["log"]}')
+    failed = sum(1 for result in results if result['status'] != 'success')
+    print(f'\n{len(results) - failed} succeeded, {failed} failed')
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='kanod-image-builder matrix')
+    parser.add_argument('matrix', help='matrix definition file')
+    parser.add_argument(
+        '--jobs', '-j', type=int,
+        help='number of builds run concurrently'
+    )
+    parser.add_argument(
+        '--workdir', '-w',
+        help='folder containing the private work folder of each build'
+    )
+    parser.add_argument(
+        '--output-dir', '-d', default='.',
+        help='folder where images are produced'
+    )
+    parser.add_argument(
+        '--report', '-r',
+        help='file receiving the summary of the builds in JSON'
+    )
+    parser.add_argument(
+        '--layers', '-l',
+        help='folder of base layer snapshots shared between variants'
+    )
+    builder.add_cache_arguments(parser)
+    builder.add_timing_arguments(parser)
+    builder.add_optimize_arguments(parser)
+    builder.add_postbuild_arguments(parser)
+    builder.add_package_cache_arguments(parser)
+    builder.add_artifact_cache_arguments(parser)
+    builder.add_download_cache_arguments(parser)
+    builder.add_base_image_arguments(parser)
+    builder.add_package_index_arguments(parser)
+    builder.add_parallelism_arguments(parser)
+    args = parser.parse_args(argv)
+    (jobs, builds) = load_matrix(args.matrix)
+    jobs = args.jobs or jobs
+    workdir = args.workdir or tempfile.mkdtemp(prefix='kanod-matrix-')
+    layer_store = (
+        None if args.layers is None else layers.LayerStore(args.layers))
+    proxy = builder.open_proxy(args)
+    try:
+        options = builder.build_options(args, proxy)
+        results = run_matrix(
+            builds, jobs, workdir, args.output_dir, options=options,
+            layer_store=layer_store,
+            postbuild=builder.postbuild_options(args),
+            package_index=builder.open_package_index(args))
+    finally:
+        if proxy is not None:
+            proxy.stop()
+    if options.package_cache is not None:
+        options.package_cache.evict()
+    if options.artifact_cache is not None:
+        options.artifact_cache.evict()
+    print_summary(results)
+    if args.report is not None:
+        with open(args.report, 'w', encoding='utf-8') as fd:
+            json.dump(results, fd, indent=2)
+    if any(result['status'] != 'success' for result in results):
+        raise SystemExit(1)
@@ -0,0 +1,252 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Optimizer stage: free space of the image discarded and tuned conversion.
+
+diskimage-builder produces a raw image. Its partitions and the logical
+volumes of its volume groups are attached on the host with losetup, kpartx
+and vgchange, like diskimage-builder does during the build. The free space of
+every filesystem is discarded with fstrim, or zeroed when the filesystem does
+not support it, and swap devices are discarded and recreated with the same
+identity. Devices without a filesystem are not modified.
+
+The raw image is then converted with qemu-img: qcow2 images are compressed
+with zstd in clusters of the requested size. Raw images keep their format
+and zeroed blocks become holes.
+
+The effect of the discard is measured on the raw image alone: zeroed blocks
+are made holes before and after it and the allocated sizes are compared.
+The size of the converted image is reported separately.
+
+Attaching the image requires root privileges through sudo, like
+diskimage-builder itself.
+'''
+
+import os
+from os import path
+import subprocess
+import tempfile
+
+from typing import Any, Dict, List, Optional  # noqa: H301
+
+FORMATS = ['qcow2', 'raw']
+DEFAULT_CLUSTER_SIZE = '1M'
+FILESYSTEMS = ['ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'vfat']
+ZERO_FILE = '.kanod-optimizer-zero'
+
+
+def raw_name(image: str, format: str) -> str:
+    '''Name of the raw image produced by diskimage-builder for an image'''
+    if image.endswith(f'.{format}'):
+        image = image[:-len(format) - 1]
+    return f'{image}.raw'
+
+
+def summary(report: Dict[str, Any]) -> str:
+    before = report['before']['allocated'] >> 20
+    discarded = report['discarded']['allocated'] >> 20
+    after = report['after']['allocated'] >> 20
+    devices = ', '.join(
+        f'{device}: {method}'
+        for (device, method) in report['devices'].items())
+    return (
+        f'Image optimized: raw data {before} MiB -> {discarded} MiB '
+        f'({devices or "no filesystem"}), final image {after} MiB')
+
+
+def sudo(args: List[str], log=None, check: bool = True):
+    return subprocess.run(
+        ['sudo'] + args, check=check, stdout=log,
+        stderr=None if log is None else subprocess.STDOUT)
+
+
+def sudo_output(args: List[str]) -> str:
+    return subprocess.check_output(['sudo'] + args, encoding='utf-8')
+
+
+def disk_usage(filename: str) -> Dict[str, int]:
+    '''Apparent size and allocated size of an image'''
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'allocated': stat.st_blocks * 512}
+
+
+def probe(device: str) -> Dict[str, Any]:
+    '''Type, UUID and label of the content of a block device
+
+    blkid reads the device: it does not depend on the udev database that
+    is often missing in build containers.
+    '''
+    process = subprocess.run(
+        ['sudo', 'blkid', '-p', '-o', 'export', device],
+        stdout=subprocess.PIPE, encoding='utf-8')
+    fields = dict(
+        line.split('=', 1) for line in process.stdout.splitlines()
+        if '=' in line)
+    return {
+        'name': device, 'fstype': fields.get('TYPE', None),
+        'uuid': fields.get('UUID', None), 'label': fields.get('LABEL', None)}
+
+
+def partitions(loop: str) -> List[str]:
+    '''Map the partitions of an attached image like diskimage-builder
+
+    :return: the partitions or the image itself if it has no partition.
+    '''
+    output = sudo_output(['kpartx', '-avs', loop])
+    names = [
+        line.split()[2] for line in output.splitlines()
+        if line.startswith('add map')]
+    return [f'/dev/mapper/{name}' for name in names] or [loop]
+
+
+def device_name(device: str, loop: str) -> str:
+    '''Name of a device of an image independent of the loop device used'''
+    if device == loop:
+        return 'image'
+    prefix = f'/dev/mapper/{path.basename(loop)}'
+    if device.startswith(prefix):
+        return f'partition {device[len(prefix):].lstrip("p")}'
+    return path.relpath(device, '/dev')
+
+
+def logical_volumes(group: str) -> List[str]:
+    output = sudo_output(['lvs', '--noheadings', '-o', 'lv_path', group])
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def volume_group(device: str) -> str:
+    return sudo_output(
+        ['pvs', '--noheadings', '-o', 'vg_name', device]).strip()
+
+
+def discard_filesystem(device: Dict[str, Any], log=None) -> str:
+    '''Discard or zero the free space of a filesystem
+
+    :return: the method used.
+    '''
+    mount_point = tempfile.mkdtemp(prefix='kanod-optimizer-')
+    try:
+        sudo(['mount', device['name'], mount_point], log)
+        try:
+            sudo(['sync'], log)
+            if sudo(['fstrim', '--verbose', mount_point], log,
+                    check=False).returncode == 0:
+                return 'discard'
+            zero_file = path.join(mount_point, ZERO_FILE)
+            # dd stops when the filesystem is full.
+            sudo(['dd', 'if=/dev/zero', f'of={zero_file}', 'bs=4M'],
+                 log, check=False)
+            sudo(['rm', '-f', zero_file], log)
+            sudo(['sync'], log)
+            return 'zero'
+        finally:
+            sudo(['umount', mount_point], log)
+    finally:
+        os.rmdir(mount_point)
+
+
+def discard_swap(device: Dict[str, Any], log=None) -> str:
+    sudo(['blkdiscard', device['name']], log)
+    command = ['mkswap']
+    if device.get('uuid', None):
+        command += ['-U', device['uuid']]
+    if device.get('label', None):
+        command += ['-L', device['label']]
+    sudo(command + [device['name']], log)
+    return 'discard'
+
+
+def discard_free_space(image: str, log=None) -> Dict[str, str]:
+    '''Discard the free space of the filesystems of a raw image
+
+    :return: the method used for each partition or logical volume.
+    '''
+    loop = sudo_output(['losetup', '--find', '--show', image]).strip()
+    groups: List[str] = []
+    try:
+        devices = [probe(device) for device in partitions(loop)]
+        for device in devices:
+            if device['fstype'] == 'LVM2_member':
+                group = volume_group(device['name'])
+                if group != '' and group not in groups:
+                    groups.append(group)
+        for group in groups:
+            sudo(['vgchange', '-ay', group], log)
+            devices += [probe(volume) for volume in logical_volumes(group)]
+        result = {}
+        for device in devices:
+            name = device_name(device['name'], loop)
+            if device['fstype'] in FILESYSTEMS:
+                result[name] = discard_filesystem(device, log)
+            elif device['fstype'] == 'swap':
+                result[name] = discard_swap(device, log)
+        return result
+    finally:
+        for group in groups:
+            sudo(['vgchange', '-an', group], log, check=False)
+        sudo(['kpartx', '-d', loop], log, check=False)
+        sudo(['losetup', '--detach', loop], log, check=False)
+
+
+def dig_holes(raw: str, log=None):
+    '''Make the zeroed blocks of a raw image holes'''
+    subprocess.run(['fallocate', '--dig-holes', raw], check=True, stdout=log)
+
+
+def convert(
+    raw: str, target: str, format: str, cluster_size: int,
+    coroutines: Optional[int] = None, log=None
+):
+    '''Convert the raw image produced by diskimage-builder'''
+    if format == 'raw':
+        dig_holes(raw, log)
+        if raw != target:
+            os.rename(raw, target)
+        return
+    command = [
+        'qemu-img', 'convert', '-f', 'raw', '-O', 'qcow2', '-c',
+        '-o', f'compression_type=zstd,cluster_size={cluster_size}']
+    if coroutines is not None:
+        command += ['-m', str(coroutines)]
+    subprocess.run(
+        command + [raw, target], check=True, stdout=log,
+        stderr=None if log is None else subprocess.STDOUT)
+    os.remove(raw)
+
+
+def optimize_image(
+    raw: str, target: str, format: str, cluster_size: int,
+    coroutines: Optional[int] = None, log=None
+) -> Dict[str, Any]:
+    '''Optimize the raw image produced by diskimage-builder into target
+
+    :param raw: the raw image. It is removed or renamed to target.
+    :param format: format of the optimized image.
+    :param cluster_size: size of the clusters of a qcow2 image.
+    :param coroutines: coroutines of qemu-img.
+    :param log: a file receiving the output of the commands.
+    :return: the report of the optimization with the sizes of the raw image
+        before (before) and after (discarded) the discard of the free space,
+        both without zeroed blocks, and of the final image (after).
+    '''
+    dig_holes(raw, log)
+    before = disk_usage(raw)
+    devices = discard_free_space(raw, log)
+    dig_holes(raw, log)
+    discarded = disk_usage(raw)
+    convert(raw, target, format, cluster_size, coroutines, log)
+    after = disk_usage(target)
+    return {
+        'before': before, 'discarded': discarded, 'after': after,
+        'devices': devices}
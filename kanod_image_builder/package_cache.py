@@ -0,0 +1,83 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Distribution package cache shared by builds.
+
+The folder is bind-mounted in the chroot of builds by the kanod-package-cache
+element. Packages are written by apt and zypper as root but the folders are
+owned by the user running the builder, so that packages can be evicted.
+'''
+
+import os
+from os import path
+
+from typing import Any, Dict, List, Optional  # noqa: H301
+
+PACKAGE_CACHE_ELEMENT = 'kanod-package-cache'
+# Files and folders managed by the package managers themselves.
+IGNORED = {'lock', 'partial'}
+
+
+class PackageCache:
+    '''Package cache with LRU eviction
+
+    The date of last use of a package is the latest of its access and
+    modification dates.
+    '''
+
+    def __init__(self, root: str, max_size: Optional[int] = None):
+        self.root = path.abspath(root)
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        result = []
+        for (folder, dirs, files) in os.walk(self.root):
+            dirs[:] = [d for d in dirs if d not in IGNORED]
+            for name in files:
+                if name in IGNORED:
+                    continue
+                entry = path.join(folder, name)
+                try:
+                    stat = os.lstat(entry)
+                except FileNotFoundError:
+                    continue
+                result.append(
+                    {'path': entry, 'size': stat.st_size,
+                     'used': max(stat.st_atime, stat.st_mtime)})
+        return result
+
+    def usage(self) -> int:
+        return sum(entry['size'] for entry in self.entries())
+
+    def evict(self) -> int:
+        '''Remove the least recently used packages above the size limit
+
+        It must not be called while builds are using the cache.
+
+        :return: the size of the cache.
+        '''
+        entries = sorted(self.entries(), key=lambda e: e['used'])
+        total = sum(e['size'] for e in entries)
+        if self.max_size is None:
+            return total
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(entry['path'])
+            except (FileNotFoundError, PermissionError):
+                continue
+            total -= entry['size']
+        return total
@@ -0,0 +1,407 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Availability of the packages of a build in the repositories of its mirror.
+
+The indexes of the repositories (Packages files of Debian and Ubuntu,
+repodata of rpm distributions) are downloaded from DIB_DISTRIBUTION_MIRROR
+and kept as sqlite databases of package names and provided capabilities.
+They are revalidated with conditional requests when they are older than an
+hour, so that checking the packages of a build usually takes milliseconds.
+'''
+
+import difflib
+import gzip
+import hashlib
+import lzma
+import os
+from os import path
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from urllib import error as urlerror
+from urllib import request
+from xml.etree import ElementTree
+
+from typing import Dict, Iterable, Iterator, List, Optional  # noqa: H301
+from typing import Tuple  # noqa: H301
+
+MAX_AGE = 3600
+TIMEOUT = 30
+# Elements of operating systems and the distribution they install.
+OS_ELEMENTS = {
+    'ubuntu': 'ubuntu', 'ubuntu-minimal': 'ubuntu',
+    'debian': 'debian', 'debian-minimal': 'debian',
+    'opensuse': 'opensuse', 'opensuse-minimal': 'opensuse',
+    'centos': 'centos', 'centos-minimal': 'centos',
+}
+# Defaults of the distribution elements of diskimage-builder.
+DEFAULT_MIRRORS = {
+    'ubuntu': 'http://archive.ubuntu.com/ubuntu',
+    'debian': 'http://deb.debian.org/debian',
+    'opensuse': 'https://download.opensuse.org',
+    'centos': 'http://mirror.stream.centos.org',
+}
+DEFAULT_RELEASES = {
+    'ubuntu': 'noble', 'debian': 'stable', 'opensuse': '15.6',
+    'centos': '9-stream',
+}
+RPM_NS = {
+    'repo': 'http://linux.duke.edu/metadata/repo',
+    'common': 'http://linux.duke.edu/metadata/common',
+    'rpm': 'http://linux.duke.edu/metadata/rpm',
+}
+# Name of a package without version, architecture or release constraints.
+PACKAGE_NAME = re.compile(r'[^=<>:\s]+')
+
+
+def download(
+    url: str, validators: Dict[str, str], target: str
+) -> Optional[Dict[str, str]]:
+    '''Download a file unless it has not changed
+
+    :param validators: ETag and Last-Modified of the known version.
+    :return: the validators of the new version or None if it has not
+        changed.
+    '''
+    known = {
+        key: validators[key] for key in ['etag', 'last-modified']
+        if key in validators}
+    headers = {}
+    if 'etag' in known:
+        headers['If-None-Match'] = known['etag']
+    if 'last-modified' in known:
+        headers['If-Modified-Since'] = known['last-modified']
+    try:
+        with request.urlopen(
+                request.Request(url, headers=headers),
+                timeout=TIMEOUT) as response:
+            new = {
+                key: response.headers[key]
+                for key in ['etag', 'last-modified']
+                if response.headers.get(key, None) is not None}
+            # file:// URLs do not support conditional requests.
+            if len(new) > 0 and new == known:
+                return None
+            with open(target, 'wb') as fd:
+                shutil.copyfileobj(response, fd)
+            return new
+    except urlerror.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+
+def not_found(error: urlerror.URLError) -> bool:
+    '''Whether a download failed because the file does not exist'''
+    if isinstance(error, urlerror.HTTPError):
+        return error.code == 404
+    return isinstance(error.reason, FileNotFoundError)
+
+
+def open_compressed(filename: str):
+    '''Open a possibly compressed index according to its extension'''
+    if filename.endswith('.xz'):
+        return lzma.open(filename, 'rb')
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(
+                'zstd repository metadata requires the zstandard python '
+                'module (zstd extra)')
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), closefd=True)
+    return open(filename, 'rb')
+
+
+class DebRepository:
+    '''Component of a suite of a Debian or Ubuntu archive'''
+
+    FILES = ['Packages.xz', 'Packages.gz', 'Packages']
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def update(
+        self, validators: Dict[str, str], workdir: str
+    ) -> Optional[Tuple[Dict[str, str], Iterable[str]]]:
+        '''Download the index of the repository if it has changed
+
+        :return: the new validators and the names of the packages or None
+            if the index has not changed.
+        '''
+        for name in self.FILES:
+            if 'file' in validators and validators['file'] != name:
+                continue
+            target = path.join(workdir, name)
+            try:
+                new = download(f'{self.url}/{name}', validators, target)
+            except urlerror.URLError as e:
+                if not_found(e) and name != self.FILES[-1]:
+                    continue
+                raise
+            if new is None:
+                return None
+            new['file'] = name
+            return (new, self.names(target))
+        return None
+
+    @staticmethod
+    def names(filename: str) -> Iterator[str]:
+        with open_compressed(filename) as fd:
+            for raw in fd:
+                line = raw.decode('utf-8', errors='replace')
+                if line.startswith('Package:'):
+                    yield line[8:].strip()
+                elif line.startswith('Provides:'):
+                    for provide in line[9:].split(','):
+                        yield provide.split('(')[0].strip()
+
+
+class RpmRepository:
+    '''Repository with rpm-md metadata (zypper and dnf)'''
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def update(
+        self, validators: Dict[str, str], workdir: str
+    ) -> Optional[Tuple[Dict[str, str], Iterable[str]]]:
+        '''Download the primary metadata if it has changed
+
+        The primary metadata has a new location when it changes: the small
+        repomd.xml file is always downloaded to find it.
+        '''
+        repomd = path.join(workdir, 'repomd.xml')
+        download(f'{self.url}/repodata/repomd.xml', {}, repomd)
+        location = ElementTree.parse(repomd).find(
+            "repo:data[@type='primary']/repo:location", RPM_NS)
+        if location is None:
+            raise Exception(f'No primary metadata in {self.url}')
+        href = location.get('href', '')
+        if validators.get('primary', None) == href:
+            return None
+        primary = path.join(workdir, path.basename(href))
+        download(f'{self.url}/{href}', {}, primary)
+        return ({'primary': href}, self.names(primary))
+
+    @staticmethod
+    def names(filename: str) -> Iterator[str]:
+        package = f'{{{RPM_NS["common"]}}}package'
+        name = f'{{{RPM_NS["common"]}}}name'
+        provide = f'{{{RPM_NS["rpm"]}}}provides'
+        with open_compressed(filename) as fd:
+            for (_, elt) in ElementTree.iterparse(fd):
+                if elt.tag == name:
+                    yield elt.text or ''
+                elif elt.tag == provide:
+                    for entry in elt:
+                        yield entry.get('name', '')
+                elif elt.tag == package:
+                    elt.clear()
+
+
+def distribution(elements: List[str]) -> Optional[str]:
+    for element in elements:
+        if element in OS_ELEMENTS:
+            return OS_ELEMENTS[element]
+    return None
+
+
+def repositories(distro: str, env: Dict[str, str]) -> List:
+    '''Repositories configured by the distribution elements
+
+    The mirror is DIB_DISTRIBUTION_MIRROR or the DIB_<DISTRO>_MIRROR
+    variable used by kanod-mirror.
+    '''
+    mirror = (
+        env.get('DIB_DISTRIBUTION_MIRROR', None) or
+        env.get(f'DIB_{distro.upper()}_MIRROR', None) or
+        DEFAULT_MIRRORS[distro]).rstrip('/')
+    release = env.get('DIB_RELEASE', None) or DEFAULT_RELEASES[distro]
+    if distro in ['ubuntu', 'debian']:
+        default = 'main,universe' if distro == 'ubuntu' else 'main'
+        components = env.get('DIB_DEBIAN_COMPONENTS', default).split(',')
+        dists = (
+            env.get('DIB_UBUNTU_MIRROR_DISTS', 'updates,security,backports')
+            if distro == 'ubuntu' else 'updates')
+        suites = [release] + [
+            f'{release}-{dist}' for dist in dists.split(',') if dist != '']
+        return [
+            DebRepository(
+                f'{mirror}/dists/{suite}/{component}/binary-amd64')
+            for suite in suites for component in components]
+    if distro == 'opensuse':
+        if release == 'tumbleweed':
+            urls = [f'{mirror}/tumbleweed/repo/oss',
+                    f'{mirror}/update/tumbleweed']
+        else:
+            urls = [f'{mirror}/distribution/leap/{release}/repo/oss',
+                    f'{mirror}/update/leap/{release}/oss']
+        return [RpmRepository(url) for url in urls]
+    return [
+        RpmRepository(f'{mirror}/{release}/{repo}/x86_64/os')
+        for repo in ['BaseOS', 'AppStream']]
+
+
+def package_names(packages: List[str]) -> List[str]:
+    '''Names of packages given to diskimage-builder with -p'''
+    result: Dict[str, None] = {}
+    for entry in packages:
+        for package in entry.split(','):
+            match = PACKAGE_NAME.match(package.strip())
+            if match is not None and '*' not in match.group(0):
+                result[match.group(0)] = None
+    return list(result)
+
+
+class PackageIndex:
+    '''On-disk index of the packages of repositories'''
+
+    def __init__(self, root: str, max_age: int = MAX_AGE):
+        self.root = path.abspath(root)
+        self.max_age = max_age
+        os.makedirs(self.root, exist_ok=True)
+
+    def database(self, repository) -> Optional[str]:
+        '''Database of a repository, updated if needed
+
+        A stale database is used if the mirror cannot be reached.
+
+        :return: None if the repository does not exist.
+        '''
+        key = hashlib.sha256(repository.url.encode('utf-8')).hexdigest()
+        database = path.join(self.root, f'{key[:32]}.sqlite')
+        meta = self.metadata(database)
+        if meta is not None and (
+                time.time() - float(meta['checked']) < self.max_age):
+            return database
+        validators = {
+            k: v for (k, v) in (meta or {}).items() if k != 'checked'}
+        try:
+            with tempfile.TemporaryDirectory(dir=self.root) as workdir:
+                update = repository.update(validators, workdir)
+                if update is None:
+                    self.write(database, None, validators)
+                else:
+                    self.write(database, update[1], update[0])
+        except (urlerror.URLError, OSError) as e:
+            if meta is not None:
+                return database
+            if isinstance(e, urlerror.URLError) and not_found(e):
+                return None
+            raise Exception(
+                f'Cannot download the index of {repository.url}: {e}')
+        return database
+
+    @staticmethod
+    def metadata(database: str) -> Optional[Dict[str, str]]:
+        if not path.isfile(database):
+            return None
+        try:
+            db = sqlite3.connect(database)
+            try:
+                return dict(db.execute('SELECT key, value FROM meta'))
+            finally:
+                db.close()
+        except sqlite3.Error:
+            return None
+
+    def write(
+        self, database: str, names: Optional[Iterable[str]],
+        validators: Dict[str, str]
+    ):
+        '''Replace the names of a database or only refresh its metadata'''
+        meta = dict(validators)
+        meta['checked'] = str(time.time())
+        if names is None:
+            target = database
+        else:
+            (fd, target) = tempfile.mkstemp(dir=self.root, suffix='.sqlite')
+            os.close(fd)
+        with sqlite3.connect(target) as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS meta '
+                '(key TEXT PRIMARY KEY, value TEXT)')
+            if names is not None:
+                db.executemany(
+                    'INSERT OR IGNORE INTO names VALUES (?)',
+                    ((name,) for name in names if name != ''))
+            db.execute('DELETE FROM meta')
+            db.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+        db.close()
+        if target != database:
+            os.replace(target, database)
+
+    def missing(
+        self, repos: List, packages: List[str]
+    ) -> List[Tuple[str, List[str]]]:
+        '''Packages found in none of the repositories
+
+        :return: the missing packages and their closest names.
+        '''
+        databases = [
+            sqlite3.connect(database) for database in
+            (self.database(repository) for repository in repos)
+            if database is not None]
+        if len(databases) == 0:
+            raise Exception(
+                f'No package index found at {repos[0].url} and others')
+        try:
+            missing = [
+                package for package in packages
+                if not any(
+                    db.execute(
+                        'SELECT 1 FROM names WHERE name = ?', (package,)
+                    ).fetchone() is not None
+                    for db in databases)]
+            if len(missing) == 0:
+                return []
+            known = {
+                name for db in databases
+                for (name,) in db.execute('SELECT name FROM names')}
+        finally:
+            for db in databases:
+                db.close()
+        return [
+            (package, difflib.get_close_matches(package, known, n=3))
+            for package in missing]
+
+
+def check(
+    image_builder, additional: str, index: PackageIndex
+) -> List[str]:
+    '''Packages of a compiled build missing from its repositories'''
+    distro = distribution(image_builder.elements)
+    if distro is None:
+        raise Exception('Packages can only be checked for '
+                        f'{", ".join(sorted(set(OS_ELEMENTS.values())))}')
+    env = image_builder.environment()
+    release = env.get('DIB_RELEASE', None) or DEFAULT_RELEASES[distro]
+    packages = package_names(image_builder.packages + [additional])
+    result = []
+    for (package, close) in index.missing(
+            repositories(distro, env), packages):
+        hint = (
+            '' if len(close) == 0 else f' (did you mean {", ".join(close)}?)')
+        result.append(f'package {package} not found in {distro} {release}'
+                      f'{hint}')
+    return result
@@ -0,0 +1,197 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Processors and memory given to builds.
+
+By default, the builder uses the processors and the memory allowed to its
+cgroup (the limits of a CI container) or those of the host. They are shared
+between the concurrent builds and exported to elements as:
+
+* ``DIB_KANOD_JOBS``: parallel jobs of compilations (``make -j``), bounded
+  by the memory of the build,
+* ``DIB_KANOD_THREADS``: threads of compressions,
+* ``DIB_KANOD_QEMU_IMG_COROUTINES``: coroutines of ``qemu-img convert``.
+
+diskimage-builder converts images with ``qemu-img`` on the host without
+options for parallelism: a wrapper adding them is put first in the ``PATH``
+of ``disk-image-create``.
+'''
+
+import os
+from os import path
+import shutil
+import tempfile
+
+from typing import Dict, List, Optional  # noqa: H301
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+# Memory needed by a compilation job (compiler and linker).
+MEMORY_PER_JOB = 1 << 30
+# Maximum number of coroutines of qemu-img convert.
+MAX_COROUTINES = 16
+
+QEMU_IMG_WRAPPER = '''#!/bin/bash
+# Generated by kanod-image-builder: qemu-img convert uses the coroutines
+# given to the build. Out of order writes are not compatible with compression.
+if [ "${{1:-}}" = convert ]; then
+    shift
+    options=(-m "${{DIB_KANOD_QEMU_IMG_COROUTINES:-8}}")
+    case " $* " in
+        *" -c "*) ;;
+        *) options+=(-W) ;;
+    esac
+    exec {qemu_img} convert "${{options[@]}}" "$@"
+fi
+exec {qemu_img} "$@"
+'''
+
+
+def read_value(filename: str) -> Optional[str]:
+    try:
+        with open(filename, encoding='utf-8') as fd:
+            return fd.read().strip()
+    except OSError:
+        return None
+
+
+def meminfo() -> Dict[str, int]:
+    '''Content of /proc/meminfo in bytes'''
+    result = {}
+    with open('/proc/meminfo', encoding='utf-8') as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) >= 2:
+                result[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    return result
+
+
+def cgroup_files(controller: str, name: str) -> List[str]:
+    '''A setting of the cgroup of the process and of its ancestors
+
+    Both the unified hierarchy (v2) and the controller hierarchies (v1) are
+    searched.
+    '''
+    content = read_value('/proc/self/cgroup') or ''
+    result = []
+    for line in content.splitlines():
+        (_, controllers, group) = line.split(':', 2)
+        if controllers == '':
+            root = CGROUP_ROOT
+        elif controller in controllers.split(','):
+            root = path.join(CGROUP_ROOT, controllers)
+        else:
+            continue
+        folder = path.join(root, group.lstrip('/'))
+        while folder.startswith(root):
+            if path.isfile(path.join(folder, name)):
+                result.append(path.join(folder, name))
+            if folder == root:
+                break
+            folder = path.dirname(folder)
+    return result
+
+
+def cpu_limit() -> int:
+    '''Processors usable by the process, according to its cgroup quota'''
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = float(len(os.sched_getaffinity(0)))
+    else:
+        cpus = float(os.cpu_count() or 1)
+    for filename in cgroup_files('cpu', 'cpu.max'):
+        fields = (read_value(filename) or 'max').split()
+        if fields[0] != 'max':
+            cpus = min(cpus, int(fields[0]) / int(fields[1]))
+    for filename in cgroup_files('cpu', 'cpu.cfs_quota_us'):
+        quota = int(read_value(filename) or -1)
+        period = read_value(
+            path.join(path.dirname(filename), 'cpu.cfs_period_us'))
+        if quota > 0 and period is not None:
+            cpus = min(cpus, quota / int(period))
+    return max(1, int(cpus))
+
+
+def memory_limit() -> int:
+    '''Memory usable by the process, according to its cgroup limit'''
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for name in ['memory.max', 'memory.limit_in_bytes']:
+        for filename in cgroup_files('memory', name):
+            value = read_value(filename) or 'max'
+            if value != 'max':
+                memory = min(memory, int(value))
+    return memory
+
+
+class Parallelism:
+    '''Processors and memory given to a build or shared by several builds'''
+
+    def __init__(self, cpus: int, memory: int):
+        self.cpus = max(1, cpus)
+        self.memory = memory
+
+    @classmethod
+    def detect(cls, cpus: Optional[int] = None) -> 'Parallelism':
+        '''Limits of the cgroup of the builder
+
+        :param cpus: processors to use instead of the detected ones.
+        '''
+        return cls(cpus or cpu_limit(), memory_limit())
+
+    def share(self, builds: int) -> 'Parallelism':
+        '''Part given to each of several concurrent builds'''
+        builds = max(1, builds)
+        return Parallelism(self.cpus // builds, self.memory // builds)
+
+    @property
+    def jobs(self) -> int:
+        return max(1, min(self.cpus, self.memory // MEMORY_PER_JOB))
+
+    @property
+    def threads(self) -> int:
+        return self.cpus
+
+    @property
+    def coroutines(self) -> int:
+        return max(1, min(MAX_COROUTINES, 2 * self.cpus))
+
+    def environment(self) -> Dict[str, str]:
+        env = {
+            'DIB_KANOD_JOBS': str(self.jobs),
+            'DIB_KANOD_THREADS': str(self.threads),
+            'DIB_KANOD_QEMU_IMG_COROUTINES': str(self.coroutines),
+        }
+        pigz = shutil.which('pigz')
+        if pigz is not None:
+            # Used by diskimage-builder for tgz images and ramdisks.
+            env['DIB_GZIP_BIN'] = f'{pigz} -p {self.threads}'
+        return env
+
+    def wrappers(
+        self, search_path: str, workdir: Optional[str] = None
+    ) -> Optional[str]:
+        '''Create a folder of wrappers of the host tools used by a build
+
+        :param search_path: PATH where the wrapped tools are found.
+        :param workdir: folder of the temporary files of the build.
+        :return: the folder, to remove after the build, or None if there is
+            nothing to wrap.
+        '''
+        qemu_img = shutil.which('qemu-img', path=search_path)
+        if qemu_img is None:
+            return None
+        folder = tempfile.mkdtemp(prefix='kanod-wrappers-', dir=workdir)
+        wrapper = path.join(folder, 'qemu-img')
+        with open(wrapper, 'w', encoding='utf-8') as fd:
+            fd.write(QEMU_IMG_WRAPPER.format(qemu_img=qemu_img))
+        os.chmod(wrapper, 0o755)
+        return folder
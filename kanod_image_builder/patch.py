@@ -0,0 +1,399 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Patch of an image with the current kanod-configure and static files.
+
+Testing a change of kanod-configure, of the kanod/ plugins of an element or
+of its static/ tree does not need a full build. The patch is a qcow2
+overlay backed by an image built with the same recipe. In the overlay:
+
+* the plugins, templates and schemas of the elements of the recipe are
+  collected again by extra-data.d/30-collect-configure of kanod-configure,
+* the files of the static/ trees of the elements that differ from the image
+  are copied like install-static does,
+* kanod-configure is installed again in the chroot by
+  post-install.d/50-install-configure.
+
+The overlay is attached with qemu-nbd and its partitions and logical volumes
+are mounted following the fstab of the image. Like the optimizer stage, it
+requires root privileges through sudo. The base image is not modified and
+must be kept with the overlay.
+'''
+
+import argparse
+import json
+import os
+from os import path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from typing import Any, Dict, List, Optional, Tuple  # noqa: H301
+
+from kanod_image_builder import elements as element_graph
+from kanod_image_builder import main as builder
+from kanod_image_builder import optimize as optimizer
+
+CONFIGURE_ELEMENT = 'kanod-configure'
+COLLECT_SCRIPT = path.join('extra-data.d', '30-collect-configure')
+INSTALL_SCRIPT = path.join('post-install.d', '50-install-configure')
+# Location of the hooks in the chroot, like diskimage-builder.
+IN_TARGET = 'tmp/in_target.d'
+CHROOT_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+SYSTEM_MOUNTS = ['proc', 'sys', 'dev']
+RESOLV_CONF = 'etc/resolv.conf'
+RESOLV_CONF_SAVED = 'etc/resolv.conf.kanod-patch'
+NBD_DEVICES = 16
+NBD_TIMEOUT = 10
+
+
+def image_format(image: str) -> str:
+    output = subprocess.check_output(
+        ['qemu-img', 'info', '--output', 'json', image], encoding='utf-8')
+    return json.loads(output)['format']
+
+
+def create_overlay(base: str, output: str):
+    subprocess.run(
+        ['qemu-img', 'create', '-q', '-f', 'qcow2', '-F', image_format(base),
+         '-b', path.abspath(base), output], check=True)
+
+
+def nbd_size(index: int) -> int:
+    with open(f'/sys/block/nbd{index}/size', encoding='utf-8') as fd:
+        return int(fd.read())
+
+
+def connect(image: str, log=None) -> str:
+    '''Attach a qcow2 image to a free network block device'''
+    optimizer.sudo(['modprobe', 'nbd'], log, check=False)
+    for index in range(NBD_DEVICES):
+        device = f'/dev/nbd{index}'
+        if not path.exists(device) or nbd_size(index) != 0:
+            continue
+        process = optimizer.sudo(
+            ['qemu-nbd', '--connect', device, '--format', 'qcow2', image],
+            log, check=False)
+        if process.returncode != 0:
+            continue
+        deadline = time.monotonic() + NBD_TIMEOUT
+        while nbd_size(index) == 0:
+            if time.monotonic() > deadline:
+                optimizer.sudo(['qemu-nbd', '--disconnect', device], log)
+                raise Exception(f'{device} not ready for {image}')
+            time.sleep(0.1)
+        return device
+    raise Exception(f'No free network block device for {image}')
+
+
+def read_fstab(root: str) -> List[Tuple[str, str, str]]:
+    '''Device, mount point and type of the filesystems of an image'''
+    result = []
+    with open(path.join(root, 'etc/fstab'), encoding='utf-8') as fd:
+        for line in fd:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) >= 3:
+                result.append((fields[0], fields[1], fields[2]))
+    return result
+
+
+def find_device(
+    spec: str, devices: List[Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    '''Device of an image designated by an fstab entry'''
+    (key, _, value) = spec.partition('=')
+    for device in devices:
+        if key == 'UUID' and device['uuid'] == value:
+            return device
+        if key == 'LABEL' and device['label'] == value:
+            return device
+        if (spec.startswith('/dev/') and
+                path.realpath(spec) == path.realpath(device['name'])):
+            return device
+    return None
+
+
+class ChrootImage:
+    '''Filesystems of a qcow2 image mounted as a chroot on the host'''
+
+    def __init__(self, image: str, root: str, log=None):
+        '''Image to mount
+
+        :param image: the qcow2 image, modified in place.
+        :param root: an empty folder receiving the root filesystem.
+        :param log: a file receiving the output of the commands.
+        '''
+        self.image = image
+        self.root = root
+        self.log = log
+        self.device: Optional[str] = None
+        self.mapped = False
+        self.groups: List[str] = []
+        self.resolv_conf = False
+
+    def devices(self) -> List[Dict[str, Any]]:
+        '''Partitions and logical volumes of the image'''
+        self.device = connect(self.image, self.log)
+        self.mapped = True
+        devices = [
+            optimizer.probe(device)
+            for device in optimizer.partitions(self.device)]
+        for device in devices:
+            if device['fstype'] == 'LVM2_member':
+                group = optimizer.volume_group(device['name'])
+                if group != '' and group not in self.groups:
+                    self.groups.append(group)
+        for group in self.groups:
+            optimizer.sudo(['vgchange', '-ay', group], self.log)
+            devices += [
+                optimizer.probe(volume)
+                for volume in optimizer.logical_volumes(group)]
+        return devices
+
+    def mount(self):
+        '''Mount the filesystems of the image following its fstab'''
+        devices = [
+            device for device in self.devices()
+            if device['fstype'] in optimizer.FILESYSTEMS]
+        for device in devices:
+            if optimizer.sudo(
+                    ['mount', device['name'], self.root], self.log,
+                    check=False).returncode != 0:
+                continue
+            if path.isfile(path.join(self.root, 'etc/fstab')):
+                break
+            optimizer.sudo(['umount', self.root], self.log)
+        else:
+            raise Exception(f'No root filesystem found in {self.image}')
+        entries = sorted(
+            (entry for entry in read_fstab(self.root)
+             if entry[1] != '/' and entry[2] in optimizer.FILESYSTEMS),
+            key=lambda entry: entry[1].count('/'))
+        for (spec, mount_point, _) in entries:
+            device = find_device(spec, devices)
+            if device is None:
+                raise Exception(
+                    f'Device {spec} of {mount_point} not found in '
+                    f'{self.image}')
+            optimizer.sudo(
+                ['mount', device['name'],
+                 path.join(self.root, mount_point.lstrip('/'))], self.log)
+
+    def prepare_chroot(self, hooks: str):
+        '''Mount the system folders, the hooks and the DNS of the host'''
+        for folder in SYSTEM_MOUNTS:
+            optimizer.sudo(
+                ['mount', '--bind', f'/{folder}',
+                 path.join(self.root, folder)], self.log)
+        in_target = path.join(self.root, IN_TARGET)
+        optimizer.sudo(['mkdir', '-p', in_target], self.log)
+        optimizer.sudo(['mount', '--bind', hooks, in_target], self.log)
+        optimizer.sudo(
+            ['mount', '-o', 'remount,ro,bind', hooks, in_target], self.log)
+        resolv_conf = path.join(self.root, RESOLV_CONF)
+        if path.lexists(resolv_conf):
+            optimizer.sudo(
+                ['mv', resolv_conf, path.join(self.root, RESOLV_CONF_SAVED)],
+                self.log)
+        self.resolv_conf = True
+        if path.exists('/etc/resolv.conf'):
+            optimizer.sudo(
+                ['cp', '--dereference', '/etc/resolv.conf', resolv_conf],
+                self.log)
+
+    def run(self, command: List[str], env: Dict[str, str]):
+        variables = [f'{var}={value}' for (var, value) in env.items()]
+        optimizer.sudo(
+            ['chroot', self.root, 'env', '-u', 'TMPDIR',
+             f'PATH={CHROOT_PATH}'] + variables + command, self.log)
+
+    def release(self):
+        if self.resolv_conf:
+            resolv_conf = path.join(self.root, RESOLV_CONF)
+            optimizer.sudo(['rm', '-f', resolv_conf], self.log, check=False)
+            saved = path.join(self.root, RESOLV_CONF_SAVED)
+            if path.lexists(saved):
+                optimizer.sudo(['mv', saved, resolv_conf], self.log)
+            self.resolv_conf = False
+        # The hooks and system folders are mounted over the image.
+        optimizer.sudo(['umount', '--recursive', self.root], self.log,
+                       check=False)
+        for group in self.groups:
+            optimizer.sudo(['vgchange', '-an', group], self.log, check=False)
+        self.groups = []
+        if self.mapped:
+            optimizer.sudo(['kpartx', '-d', self.device], self.log,
+                           check=False)
+            self.mapped = False
+        if self.device is not None:
+            optimizer.sudo(['qemu-nbd', '--disconnect', self.device],
+                           self.log, check=False)
+            self.device = None
+
+
+def os_release(root: str) -> Dict[str, str]:
+    result = {}
+    filename = path.join(root, 'etc/os-release')
+    if not path.isfile(filename):
+        filename = path.join(root, 'usr/lib/os-release')
+    with open(filename, encoding='utf-8') as fd:
+        for line in fd:
+            (key, sep, value) = line.strip().partition('=')
+            if sep != '':
+                result[key] = value.strip('"\'')
+    return result
+
+
+def collect_configure(
+    index: Dict[str, str], elements: List[str], hooks: str, name: str,
+    log=None
+):
+    '''Collect the plugins of the elements like diskimage-builder
+
+    The schema of the configuration is written in name-schema.yaml.
+    '''
+    element_dir = index[CONFIGURE_ELEMENT]
+    env = dict(os.environ)
+    env.update({
+        'TMP_HOOKS_PATH': hooks,
+        'IMAGE_ELEMENT_YAML': yaml.safe_dump(
+            {element: index[element] for element in elements}),
+        'IMAGE_NAME': name,
+    })
+    subprocess.run(
+        [sys.executable, path.join(element_dir, COLLECT_SCRIPT)], env=env,
+        check=True, stdout=log,
+        stderr=None if log is None else subprocess.STDOUT)
+    os.makedirs(path.join(hooks, path.dirname(INSTALL_SCRIPT)))
+    shutil.copy2(
+        path.join(element_dir, INSTALL_SCRIPT),
+        path.join(hooks, INSTALL_SCRIPT))
+
+
+def copy_static(
+    index: Dict[str, str], elements: List[str], root: str, log=None
+) -> List[str]:
+    '''Copy the files of the static trees that differ from the image
+
+    :return: the files copied.
+    '''
+    copied = []
+    for element in elements:
+        static = path.join(index[element], 'static')
+        if not path.isdir(static):
+            continue
+        # Like install-static, with the content compared instead of the
+        # modification time that the image does not keep.
+        output = optimizer.sudo_output(
+            ['rsync', '-lCr', '--checksum', '--itemize-changes',
+             f'{static}/', f'{root}/'])
+        for line in output.splitlines():
+            (changes, _, filename) = line.partition(' ')
+            if changes[:1] in ('>', 'c') and changes[1:2] in ('f', 'L'):
+                copied.append(f'/{filename}')
+    if log is not None:
+        for filename in copied:
+            print(f'Copied {filename}', file=log)
+    return copied
+
+
+def patch_image(
+    image_builder, base: str, output: str, log=None
+) -> Dict[str, Any]:
+    '''Create output as a patched overlay of base
+
+    :param image_builder: the compiled recipe of the base image.
+    :param base: the image built with the recipe.
+    :param output: the qcow2 overlay created.
+    :param log: a file receiving the output of the commands.
+    :return: the files of the static trees copied, whether kanod-configure
+        was installed again and the duration of the patch.
+    '''
+    if path.abspath(base) == path.abspath(output):
+        raise Exception('The patched image must not overwrite its base')
+    start = time.monotonic()
+    index = element_graph.element_index(image_builder.elements_path())
+    elements = [
+        element for element in element_graph.closure(
+            image_builder.elements, index)
+        if element in index]
+    configure = CONFIGURE_ELEMENT in elements
+    hooks = tempfile.mkdtemp(prefix='kanod-patch-')
+    root = tempfile.mkdtemp(prefix='kanod-patch-root-')
+    image = None
+    try:
+        if configure:
+            name = output[:-len('.qcow2')] if output.endswith(
+                '.qcow2') else output
+            collect_configure(index, elements, hooks, name, log)
+        create_overlay(base, output)
+        image = ChrootImage(output, root, log)
+        try:
+            image.mount()
+            static = copy_static(index, elements, root, log)
+            if configure:
+                image.prepare_chroot(hooks)
+                release = os_release(root)
+                image.run(
+                    [path.join('/', IN_TARGET, INSTALL_SCRIPT)], {
+                        'DISTRO_NAME': release.get('ID', ''),
+                        'DIB_RELEASE': release.get('VERSION_ID', ''),
+                        'PIP_NO_CACHE_DIR': '1'})
+        finally:
+            image.release()
+    except BaseException:
+        if image is not None and path.exists(output):
+            os.remove(output)
+        raise
+    finally:
+        shutil.rmtree(hooks, ignore_errors=True)
+        # Never recursively: the image stays mounted if it cannot be
+        # released.
+        if not path.ismount(root):
+            os.rmdir(root)
+    return {
+        'base': base, 'static': static, 'configure': configure,
+        'seconds': round(time.monotonic() - start, 1)}
+
+
+def summary(output: str, report: Dict[str, Any]) -> str:
+    configure = (
+        ', kanod-configure installed' if report['configure'] else '')
+    return (
+        f'{output}: overlay of {report["base"]}, '
+        f'{len(report["static"])} static files copied{configure} '
+        f'in {report["seconds"]}s')
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog='kanod-image-builder patch',
+        description='Patch an image with the current kanod-configure, '
+        'element plugins and static files')
+    parser.add_argument('base', help='image built with the same recipe')
+    parser.add_argument('modules', nargs='*')
+    parser.add_argument(
+        '--output', '-o', required=True,
+        help='qcow2 overlay of the base image'
+    )
+    builder.add_recipe_arguments(parser)
+    args = parser.parse_args(argv)
+    vars = builder.parse_bindings(args.decl)
+    image_builder = builder.make_builder(args.modules, args.bool, vars)
+    report = patch_image(image_builder, args.base, args.output)
+    print(summary(args.output, report))
@@ -0,0 +1,70 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Content of a build without running diskimage-builder.'''
+
+import argparse
+import json
+import sys
+
+from typing import Any, Dict, List  # noqa: H301
+
+from kanod_image_builder import main as builder
+
+
+def plan(image_builder, format: str, additional: str) -> Dict[str, Any]:
+    packages = list(image_builder.packages)
+    if additional != '':
+        packages += additional.split(',')
+    return {
+        'format': format,
+        'flags': image_builder.bools,
+        'vars': image_builder.vars,
+        'elements': image_builder.elements,
+        'packages': packages,
+        'env': image_builder.osEnv,
+        'elements_path': image_builder.elements_path(),
+    }
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='kanod-image-builder plan')
+    parser.add_argument('modules', nargs='*')
+    builder.add_build_arguments(parser)
+    parser.add_argument(
+        '--validate', action='store_true',
+        help='Validate the configuration of modules against the schema'
+    )
+    parser.add_argument(
+        '--check', action='store_true',
+        help='Check the element graph and report its problems'
+    )
+    builder.add_package_index_arguments(parser)
+    args = parser.parse_args(argv)
+    vars = builder.parse_bindings(args.decl)
+    image_builder = builder.make_builder(
+        args.modules, args.bool, vars, validate=args.validate)
+    result = plan(image_builder, args.format, args.packages)
+    if args.check:
+        from kanod_image_builder import elements as element_graph
+        result['problems'] = element_graph.check(
+            image_builder.elements, image_builder.elements_path())
+        package_index = builder.open_package_index(args)
+        if package_index is not None:
+            from kanod_image_builder import package_index as pkg_index
+            result['problems'] += pkg_index.check(
+                image_builder, args.packages, package_index)
+    print(json.dumps(result, indent=2))
+    if args.check and len(result['problems']) > 0:
+        sys.exit(1)
@@ -0,0 +1,285 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Post-build stage: digests, size and compression of an image.
+
+The image is read once in large blocks. Holes of sparse images are found
+with SEEK_DATA/SEEK_HOLE and are never read. Each digest is computed by its
+own thread and blocks are compressed independently by a pool of threads. The
+compressed blocks are written in order as independent gzip members, xz
+streams or zstd frames: their concatenation is a valid archive for the
+standard tools.
+'''
+
+from concurrent import futures
+import errno
+import functools
+import hashlib
+import json
+import lzma
+import os
+from os import path
+import queue
+import struct
+import threading
+import zlib
+
+from typing import Any, Callable, Dict, Iterable, Iterator  # noqa: H301
+from typing import List, Optional, Tuple, Union  # noqa: H301
+
+from kanod_image_builder import parallelism
+
+BLOCK_SIZE = 16 * 1024 * 1024
+ZEROS = memoryview(bytes(BLOCK_SIZE))
+SPARSE_BLOCK_SIZE = 4096
+SPARSE_MAGIC = 0xED26FF3A
+CHUNK_RAW = 0xCAC1
+CHUNK_DONT_CARE = 0xCAC3
+DIGESTS = ['sha256', 'md5']
+EXTENSIONS = {'gz': 'gz', 'xz': 'xz', 'zstd': 'zst'}
+
+# Piece of a stream: bytes, length of a run of zeros or nothing.
+Piece = Union[bytes, int, None]
+
+
+def gzip_block(data: bytes) -> bytes:
+    # wbits=31 produces a complete gzip member for each block.
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def xz_block(data: bytes) -> bytes:
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=1)
+
+
+def zstd_block(data: bytes) -> bytes:
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception(
+            'zstd compression requires the zstandard python module '
+            '(zstd extra)')
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    'gz': gzip_block,
+    'xz': xz_block,
+    'zstd': zstd_block,
+}
+
+
+class DigestWorker(threading.Thread):
+    '''Computes a digest of the blocks it receives in order'''
+
+    def __init__(self, algorithm: str, depth: int):
+        super().__init__(daemon=True)
+        self.hash = hashlib.new(algorithm)
+        self.blocks: queue.Queue = queue.Queue(depth)
+
+    def run(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            self.hash.update(block)
+
+
+def data_extents(fd: int, size: int) -> List[Tuple[int, int]]:
+    '''Extents of a file containing data, aligned on sparse blocks
+
+    Files on filesystems without SEEK_DATA support are a single extent.
+    '''
+    extents: List[Tuple[int, int]] = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break
+            return [(0, size)] if size > 0 else []
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        start -= start % SPARSE_BLOCK_SIZE
+        end = min(size, -(-end // SPARSE_BLOCK_SIZE) * SPARSE_BLOCK_SIZE)
+        if extents and start <= extents[-1][1]:
+            extents[-1] = (extents[-1][0], end)
+        else:
+            extents.append((start, end))
+        offset = end
+    return extents
+
+
+def segments(fd: int, size: int) -> Iterator[Tuple[bool, int, int]]:
+    '''Cut a file in data and hole pieces of at most BLOCK_SIZE bytes
+
+    :return: triples (is_data, offset, length)
+    '''
+    offset = 0
+    for (start, end) in data_extents(fd, size) + [(size, size)]:
+        for (is_data, lo, hi) in [(False, offset, start), (True, start, end)]:
+            while lo < hi:
+                length = min(BLOCK_SIZE, hi - lo)
+                yield (is_data, lo, length)
+                lo += length
+        offset = end
+
+
+def plain_pieces(fd: int, size: int) -> Iterator[Tuple[Piece, Piece]]:
+    '''Pieces of an image and of its archive when it is copied as is'''
+    for (is_data, offset, length) in segments(fd, size):
+        piece = os.pread(fd, length, offset) if is_data else length
+        yield (piece, piece)
+
+
+def android_sparse_pieces(
+    fd: int, size: int
+) -> Iterator[Tuple[Piece, Piece]]:
+    '''Pieces of an image and of its Android sparse image
+
+    Holes are recorded as DONT_CARE chunks and data as RAW chunks. The last
+    chunk is padded to a whole number of sparse blocks.
+    '''
+    pieces = list(segments(fd, size))
+    total_blocks = -(-size // SPARSE_BLOCK_SIZE)
+    yield (None, struct.pack(
+        '<IHHHHIIII', SPARSE_MAGIC, 1, 0, 28, 12, SPARSE_BLOCK_SIZE,
+        total_blocks, len(pieces), 0))
+    for (is_data, offset, length) in pieces:
+        blocks = -(-length // SPARSE_BLOCK_SIZE)
+        if not is_data:
+            yield (
+                length, struct.pack('<HHII', CHUNK_DONT_CARE, 0, blocks, 12))
+            continue
+        data = os.pread(fd, length, offset)
+        padding = blocks * SPARSE_BLOCK_SIZE - length
+        header = struct.pack(
+            '<HHII', CHUNK_RAW, 0, blocks, 12 + length + padding)
+        yield (data, header + data + bytes(padding))
+
+
+@functools.lru_cache(maxsize=None)
+def compressed_zeros(compress: str, length: int) -> bytes:
+    return COMPRESSORS[compress](bytes(length))
+
+
+def process_stream(
+    pieces: Iterable[Tuple[Piece, Piece]], digests: List[str],
+    compress: Optional[str], archive_fd, threads: int
+) -> Dict[str, Any]:
+    '''Digest an image and write its archive in a single pass
+
+    Pieces are pairs of a piece of the image and of the archive. A piece is
+    either bytes, the length of a run of zero bytes or None. Zero runs are
+    neither read nor compressed more than once.
+
+    :return: the digests and the size of the image.
+    '''
+    workers = [DigestWorker(algorithm, 2 * threads) for algorithm in digests]
+    for worker in workers:
+        worker.start()
+    size = 0
+    pending: List[futures.Future] = []
+    compressor = None if compress is None else COMPRESSORS[compress]
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for (image_piece, archive_piece) in pieces:
+            if image_piece is not None:
+                if isinstance(image_piece, int):
+                    size += image_piece
+                    image_piece = ZEROS[:image_piece]
+                else:
+                    size += len(image_piece)
+                for worker in workers:
+                    worker.blocks.put(image_piece)
+            if archive_piece is None or archive_fd is None:
+                continue
+            if compressor is None:
+                if isinstance(archive_piece, int):
+                    archive_piece = ZEROS[:archive_piece]
+                archive_fd.write(archive_piece)
+                continue
+            if isinstance(archive_piece, int):
+                task: futures.Future = futures.Future()
+                task.set_result(compressed_zeros(compress, archive_piece))
+            else:
+                task = pool.submit(compressor, archive_piece)
+            pending.append(task)
+            # Bound the memory used by blocks waiting to be written.
+            while len(pending) > 2 * threads:
+                archive_fd.write(pending.pop(0).result())
+        for task in pending:
+            archive_fd.write(task.result())
+    for worker in workers:
+        worker.blocks.put(None)
+        worker.join()
+    result: Dict[str, Any] = {
+        algorithm: worker.hash.hexdigest()
+        for (algorithm, worker) in zip(digests, workers)}
+    result['size'] = size
+    return result
+
+
+def archive_name(image: str, compress: Optional[str], sparse: bool) -> str:
+    if sparse:
+        image = f'{path.splitext(image)[0]}.simg'
+    if compress is None:
+        return image
+    return f'{image}.{EXTENSIONS[compress]}'
+
+
+def process_image(
+    image: str, format: str, digests: List[str],
+    compress: Optional[str] = None, threads: Optional[int] = None,
+    keep: bool = False, sparse: bool = False
+) -> Dict[str, Any]:
+    '''Run the post-build stage on an image and write its manifest
+
+    Only the data extents of the image are read. With sparse, a raw image is
+    archived as an Android sparse image. The digests are always those of the
+    full image. The manifest is written in image.manifest.json and contains
+    the fields published as annotations of the image.
+    '''
+    if sparse and format != 'raw':
+        raise Exception(f'Sparse archives require a raw image, not {format}')
+    threads = threads or parallelism.cpu_limit()
+    archive = archive_name(image, compress, sparse)
+    generator = android_sparse_pieces if sparse else plain_pieces
+    with open(image, 'rb', buffering=0) as fd:
+        pieces = generator(fd.fileno(), os.fstat(fd.fileno()).st_size)
+        if archive == image:
+            result = process_stream(pieces, digests, None, None, threads)
+        else:
+            try:
+                with open(archive, 'wb') as archive_fd:
+                    result = process_stream(
+                        pieces, digests, compress, archive_fd, threads)
+            except BaseException:
+                # No partial archive is left next to the image.
+                if path.exists(archive):
+                    os.remove(archive)
+                raise
+    manifest = {
+        'filename': path.basename(image),
+        'image-format': format,
+        'compression': compress or 'none',
+        'sparse': sparse,
+        'archive': path.basename(archive),
+        'archive-size': 0 if archive == image else os.stat(archive).st_size,
+    }
+    manifest.update(result)
+    with open(f'{image}.manifest.json', 'w', encoding='utf-8') as fd:
+        json.dump(manifest, fd, indent=2)
+    if archive != image and not keep:
+        os.remove(image)
+    return manifest
@@ -0,0 +1,559 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Caching download proxy used by the chroot of builds.
+
+GET requests are answered from a cache of downloads. Contents are stored by
+sha256 checksum and indexed by URL. Entries with an ETag or a Last-Modified
+date are revalidated upstream, others are downloaded again. Large downloads
+are split in ranges fetched in parallel and resumed after an interruption.
+In offline mode, only the cache is used.
+
+HTTPS requests are intercepted with a certificate authority local to the
+cache folder and trusted in the chroot by the kanod-download-cache element.
+Certificates are generated with the openssl command. Without it, HTTPS
+requests are tunneled without caching.
+'''
+
+from concurrent import futures
+import hashlib
+import http.client
+from http import server
+import io
+import json
+import os
+from os import path
+import re
+import select
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+from urllib import error as urlerror
+from urllib import request
+
+from typing import Any, Dict, Optional, Tuple  # noqa: H301
+
+from kanod_image_builder import cache as image_cache
+
+DOWNLOAD_CACHE_ELEMENT = 'kanod-download-cache'
+CHUNK_SIZE = 1024 * 1024
+PART_SIZE = 32 * 1024 * 1024
+DOWNLOAD_THREADS = 4
+RETRIES = 3
+TIMEOUT = 60
+# Headers of a client request forwarded upstream for cached downloads.
+FORWARDED = ['User-Agent', 'Accept']
+HOP_BY_HOP = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailers', 'transfer-encoding', 'upgrade'}
+CONTENT_RANGE = re.compile(r'^bytes \d+-\d+/(\d+)$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class NotCached(Exception):
+    pass
+
+
+class NoRedirect(request.HTTPRedirectHandler):
+    '''Redirects of forwarded requests are followed by the client'''
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class CertificateAuthority:
+    '''Authority signing the certificates of intercepted servers'''
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.cert = path.join(folder, 'ca.crt')
+        self.key = path.join(folder, 'ca.key')
+        self.leaf_key = path.join(folder, 'leaf.key')
+        self.lock = threading.Lock()
+        self.contexts: Dict[str, ssl.SSLContext] = {}
+        os.makedirs(path.join(folder, 'hosts'), mode=0o700, exist_ok=True)
+        if not path.isfile(self.cert):
+            self.openssl(
+                'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                '-keyout', self.key, '-out', self.cert, '-days', '3650',
+                '-subj', '/CN=kanod-image-builder download cache',
+                '-addext', 'basicConstraints=critical,CA:TRUE',
+                '-addext', 'keyUsage=critical,keyCertSign,cRLSign')
+        if not path.isfile(self.leaf_key):
+            self.openssl(
+                'genpkey', '-algorithm', 'RSA', '-out', self.leaf_key,
+                '-pkeyopt', 'rsa_keygen_bits:2048')
+
+    @staticmethod
+    def openssl(*args: str, input: Optional[bytes] = None) -> bytes:
+        return subprocess.run(
+            ('openssl',) + args, input=input, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+    def context(self, host: str) -> ssl.SSLContext:
+        '''Server context presenting a certificate for host'''
+        with self.lock:
+            if host in self.contexts:
+                return self.contexts[host]
+            cert = path.join(self.folder, 'hosts', f'{host}.crt')
+            if not path.isfile(cert):
+                kind = 'IP' if re.match(r'^[\d.]+$|:', host) else 'DNS'
+                csr = self.openssl(
+                    'req', '-new', '-key', self.leaf_key, '-subj',
+                    f'/CN={host}')
+                with tempfile.NamedTemporaryFile('w') as ext:
+                    ext.write(f'subjectAltName={kind}:{host}\n')
+                    ext.flush()
+                    signed = self.openssl(
+                        'x509', '-req', '-CA', self.cert, '-CAkey', self.key,
+                        '-set_serial', str(int.from_bytes(
+                            os.urandom(8), 'big')),
+                        '-days', '825', '-extfile', ext.name, input=csr)
+                image_cache.write_atomically(cert, io.BytesIO(signed))
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, self.leaf_key)
+            self.contexts[host] = context
+            return context
+
+
+class DownloadCache:
+    '''Downloads stored by checksum in blobs and indexed by URL in urls'''
+
+    def __init__(self, root: str, max_size: Optional[int] = None):
+        self.root = path.abspath(root)
+        self.blobs = image_cache.LocalCache(
+            path.join(self.root, 'blobs'), max_size)
+        self.urls = path.join(self.root, 'urls')
+        self.partial = path.join(self.root, 'partial')
+        os.makedirs(self.urls, exist_ok=True)
+        os.makedirs(self.partial, exist_ok=True)
+        self.lock = threading.Lock()
+        self.url_locks: Dict[str, threading.Lock] = {}
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def url_lock(self, url: str) -> threading.Lock:
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path.join(self.urls, f'{self.key(url)}.json'),
+                      encoding='utf-8') as fd:
+                meta = json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not path.isfile(self.blobs.entry(meta['sha256'])):
+            return None
+        return meta
+
+    def get(
+        self, url: str, headers: Dict[str, str], offline: bool = False
+    ) -> Tuple[str, Dict[str, Any]]:
+        '''Path and metadata of the content of url, downloaded if needed'''
+        with self.url_lock(url):
+            meta = self.lookup(url)
+            if meta is not None and (
+                    offline or self.still_valid(url, meta, headers)):
+                blob = self.blobs.entry(meta['sha256'])
+                os.utime(blob)
+                return (blob, meta)
+            if offline:
+                raise NotCached(url)
+            meta = self.download(url, headers)
+            return (self.blobs.entry(meta['sha256']), meta)
+
+    def still_valid(
+        self, url: str, meta: Dict[str, Any], headers: Dict[str, str]
+    ) -> bool:
+        '''Revalidate an entry. Stale entries are used if upstream is down'''
+        conditions = {}
+        if meta.get('etag') is not None:
+            conditions['If-None-Match'] = meta['etag']
+        if meta.get('last-modified') is not None:
+            conditions['If-Modified-Since'] = meta['last-modified']
+        if len(conditions) == 0:
+            return False
+        req = request.Request(url, headers={**headers, **conditions})
+        try:
+            with request.urlopen(req, timeout=TIMEOUT):
+                return False
+        except urlerror.HTTPError as e:
+            # 304 or a server error of upstream.
+            if e.code == 304 or e.code >= 500:
+                return True
+            raise
+        except (urlerror.URLError, OSError):
+            return True
+
+    def download(self, url: str, headers: Dict[str, str]) -> Dict[str, Any]:
+        partial = path.join(self.partial, self.key(url))
+        probe = request.Request(url, headers={**headers, 'Range': 'bytes=0-0'})
+        with request.urlopen(probe, timeout=TIMEOUT) as response:
+            info = response.headers
+            meta: Dict[str, Any] = {
+                'url': url,
+                'etag': info.get('ETag', None),
+                'last-modified': info.get('Last-Modified', None),
+                'content-type': info.get(
+                    'Content-Type', 'application/octet-stream'),
+            }
+            match = CONTENT_RANGE.match(info.get('Content-Range', ''))
+            if response.status != 206 or match is None:
+                # Ranges are not supported: this is the whole content.
+                with open(partial, 'wb') as fd:
+                    shutil.copyfileobj(response, fd, CHUNK_SIZE)
+                return self.commit(url, partial, meta)
+            final_url = response.geturl()
+        self.fetch_ranges(
+            final_url, headers, partial, int(match.group(1)), meta)
+        return self.commit(url, partial, meta)
+
+    def fetch_ranges(
+        self, url: str, headers: Dict[str, str], partial: str, size: int,
+        meta: Dict[str, Any]
+    ):
+        '''Fetch parts of a download in parallel
+
+        Completed parts are recorded next to the partial file so that an
+        interrupted download is resumed.
+        '''
+        state_file = f'{partial}.json'
+        state = None
+        if path.isfile(partial) and path.isfile(state_file):
+            with open(state_file, encoding='utf-8') as fd:
+                state = json.load(fd)
+            if state['size'] != size or state['etag'] != meta['etag']:
+                state = None
+        if state is None:
+            state = {'size': size, 'etag': meta['etag'], 'done': []}
+            with open(partial, 'wb') as fd:
+                fd.truncate(size)
+        parts = [
+            (index, start, min(size, start + PART_SIZE))
+            for (index, start) in enumerate(range(0, size, PART_SIZE))
+            if index not in state['done']]
+        lock = threading.Lock()
+        fd = os.open(partial, os.O_WRONLY)
+
+        def fetch_part(part):
+            (index, offset, end) = part
+            attempts = 0
+            while offset < end:
+                req = request.Request(url, headers={
+                    **headers, 'Range': f'bytes={offset}-{end - 1}'})
+                try:
+                    with request.urlopen(req, timeout=TIMEOUT) as response:
+                        if response.status != 206:
+                            raise Exception(f'Range not honored by {url}')
+                        while offset < end:
+                            chunk = response.read(
+                                min(CHUNK_SIZE, end - offset))
+                            if not chunk:
+                                break
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                except (urlerror.URLError, http.client.HTTPException,
+                        OSError):
+                    if attempts >= RETRIES:
+                        raise
+                if offset < end:
+                    attempts += 1
+                    if attempts > RETRIES:
+                        raise Exception(f'Incomplete download of {url}')
+            with lock:
+                state['done'].append(index)
+                with open(state_file, 'w', encoding='utf-8') as sfd:
+                    json.dump(state, sfd)
+
+        try:
+            with futures.ThreadPoolExecutor(
+                    max_workers=DOWNLOAD_THREADS) as pool:
+                for task in [pool.submit(fetch_part, p) for p in parts]:
+                    task.result()
+        finally:
+            os.close(fd)
+
+    def commit(
+        self, url: str, partial: str, meta: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        '''Move a complete download to the blobs and index it'''
+        digest = hashlib.sha256()
+        with open(partial, 'rb') as fd:
+            for block in iter(lambda: fd.read(CHUNK_SIZE), b''):
+                digest.update(block)
+        meta['sha256'] = digest.hexdigest()
+        meta['size'] = os.stat(partial).st_size
+        os.chmod(partial, 0o644)
+        os.replace(partial, self.blobs.entry(meta['sha256']))
+        if path.isfile(f'{partial}.json'):
+            os.remove(f'{partial}.json')
+        image_cache.write_atomically(
+            path.join(self.urls, f'{self.key(url)}.json'),
+            io.BytesIO(json.dumps(meta).encode('utf-8')))
+        self.blobs.evict()
+        return meta
+
+
+class ProxyHandler(server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Scheme and authority of the requests of an intercepted tunnel.
+    tunnel: Optional[str] = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def target(self) -> Optional[str]:
+        if self.tunnel is not None:
+            return self.tunnel + self.path
+        if self.path.startswith('http://'):
+            return self.path
+        return None
+
+    def do_GET(self):
+        url = self.target()
+        if url is None:
+            self.send_error(400, 'Not a proxy request')
+            return
+        if 'Authorization' in self.headers or 'Cookie' in self.headers:
+            self.forward()
+            return
+        headers = {
+            name: self.headers[name] for name in FORWARDED
+            if name in self.headers}
+        try:
+            (blob, meta) = self.server.cache.get(
+                url, headers, self.server.offline)
+        except urlerror.HTTPError as e:
+            self.relay(e.code, e.headers, e.read())
+            return
+        except NotCached:
+            self.send_error(504, f'{url} is not in the cache (offline)')
+            return
+        except Exception as e:
+            self.send_error(502, f'Download of {url} failed: {e}')
+            return
+        self.send_blob(blob, meta, False)
+
+    def do_HEAD(self):
+        '''Answer from the metadata of the cache or forward upstream
+
+        A probe must not download the whole content into the cache.
+        '''
+        url = self.target()
+        if url is None:
+            self.send_error(400, 'Not a proxy request')
+            return
+        meta = None
+        if 'Authorization' not in self.headers and (
+                'Cookie' not in self.headers):
+            meta = self.server.cache.lookup(url)
+        if meta is not None:
+            self.send_blob(
+                self.server.cache.blobs.entry(meta['sha256']), meta, True)
+            return
+        if self.server.offline:
+            self.send_error(504, f'{url} is not in the cache (offline)')
+            return
+        self.forward()
+
+    def send_blob(self, blob: str, meta: Dict[str, Any], head: bool):
+        size = meta['size']
+        (start, end, status) = (0, size - 1, 200)
+        match = RANGE.match(self.headers.get('Range', ''))
+        if match is not None and match.group(0) != 'bytes=-':
+            if match.group(1) == '':
+                start = max(0, size - int(match.group(2)))
+            else:
+                start = int(match.group(1))
+                if match.group(2) != '':
+                    end = min(end, int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', meta['content-type'])
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        for header in ['etag', 'last-modified']:
+            if meta.get(header) is not None:
+                self.send_header(header.title(), meta[header])
+        self.end_headers()
+        if head:
+            return
+        with open(blob, 'rb') as fd:
+            fd.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fd.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def relay(self, status: int, headers, body: bytes, head: bool = False):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            if name.lower() not in HOP_BY_HOP and name.lower() not in {
+                    'content-length', 'content-encoding'}:
+                self.send_header(name, value)
+        # The answer to a HEAD request has the length of the content.
+        length = headers.get('Content-Length', None)
+        self.send_header(
+            'Content-Length',
+            length if head and length is not None else str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def forward(self):
+        '''Forward a request without caching'''
+        url = self.target()
+        if url is None:
+            self.send_error(400, 'Not a proxy request')
+            return
+        if self.server.offline:
+            self.send_error(503, f'{self.command} {url} refused (offline)')
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else None
+        headers = {
+            name: value for (name, value) in self.headers.items()
+            if name.lower() not in HOP_BY_HOP and name.lower() != 'host'}
+        req = request.Request(
+            url, data=body, headers=headers, method=self.command)
+        opener = request.build_opener(NoRedirect())
+        try:
+            with opener.open(req, timeout=TIMEOUT) as response:
+                self.relay(
+                    response.status, response.headers, response.read(),
+                    self.command == 'HEAD')
+        except urlerror.HTTPError as e:
+            self.relay(e.code, e.headers, e.read(), self.command == 'HEAD')
+        except Exception as e:
+            self.send_error(502, f'{self.command} {url} failed: {e}')
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = forward
+
+    def do_CONNECT(self):
+        (host, _, port) = self.path.rpartition(':')
+        if self.server.offline and self.server.ca is None:
+            self.send_error(503, f'Tunnel to {self.path} refused (offline)')
+            return
+        if self.server.ca is None:
+            self.tunnel_raw(host, int(port))
+            return
+        context = self.server.ca.context(host)
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            connection = context.wrap_socket(
+                self.connection, server_side=True)
+        except (ssl.SSLError, OSError):
+            return
+        authority = host if port == '443' else f'{host}:{port}'
+        TunnelHandler(
+            connection, self.client_address, self.server,
+            f'https://{authority}')
+
+    def tunnel_raw(self, host: str, port: int):
+        try:
+            upstream = socket.create_connection((host, port), TIMEOUT)
+        except OSError as e:
+            self.send_error(502, f'Connection to {self.path} failed: {e}')
+            return
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.close_connection = True
+        sockets = [self.connection, upstream]
+        with upstream:
+            while True:
+                (readable, _, _) = select.select(sockets, [], [], TIMEOUT)
+                if len(readable) == 0:
+                    return
+                for sock in readable:
+                    data = sock.recv(CHUNK_SIZE)
+                    if not data:
+                        return
+                    other = upstream if sock is self.connection else (
+                        self.connection)
+                    other.sendall(data)
+
+
+class TunnelHandler(ProxyHandler):
+    '''Handler of the requests sent in an intercepted HTTPS tunnel'''
+
+    def __init__(self, connection, client_address, proxy_server, tunnel):
+        self.tunnel = tunnel
+        super().__init__(connection, client_address, proxy_server)
+
+
+class CachingProxy(server.ThreadingHTTPServer):
+    '''Proxy listening on the loopback interface during builds'''
+
+    daemon_threads = True
+
+    def __init__(
+        self, cache: DownloadCache, ca: Optional[CertificateAuthority],
+        offline: bool = False
+    ):
+        super().__init__(('127.0.0.1', 0), ProxyHandler)
+        self.cache = cache
+        self.ca = ca
+        self.offline = offline
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def environment(self) -> Dict[str, str]:
+        '''Variables given to the kanod-download-cache element'''
+        env = {'DIB_KANOD_DOWNLOAD_PROXY': self.url}
+        if self.ca is not None:
+            env['DIB_KANOD_DOWNLOAD_CA'] = self.ca.cert
+        return env
+
+
+def open_proxy(
+    root: str, max_size: Optional[int] = None, offline: bool = False
+) -> CachingProxy:
+    '''Start a caching proxy on a download cache folder'''
+    cache = DownloadCache(root, max_size)
+    ca = None
+    if shutil.which('openssl') is not None:
+        ca = CertificateAuthority(path.join(cache.root, 'ca'))
+    else:
+        print('openssl not found: HTTPS downloads are not cached')
+    proxy = CachingProxy(cache, ca, offline)
+    proxy.start()
+    return proxy
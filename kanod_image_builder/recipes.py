@@ -0,0 +1,189 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Compiled form of the configuration of modules.
+
+Conditions, environment bindings and recipes are compiled once when a module
+is parsed. Templates are compiled on first use and shared by all builders.
+'''
+
+import functools
+import re
+import threading
+
+from typing import Any, Dict, Iterable, List, Optional, Set  # noqa: H301
+
+_jinja_env = None
+_jinja_lock = threading.Lock()
+
+
+def filter_regex_replace(value, pat, target):
+    return re.sub(pat, target, value)
+
+
+def jinja_environment():
+    '''Jinja2 environment shared by all builders'''
+    global _jinja_env
+    with _jinja_lock:
+        if _jinja_env is None:
+            import jinja2
+            _jinja_env = jinja2.Environment()
+            _jinja_env.filters['regex_replace'] = filter_regex_replace
+    return _jinja_env
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(source: str):
+    return jinja_environment().from_string(source)
+
+
+class Template:
+    '''A string that may contain a jinja2 template'''
+
+    __slots__ = ('source',)
+
+    def __init__(self, source: str):
+        self.source = source
+
+    def render(self, vars: Dict[str, str]) -> str:
+        if '{' not in self.source:
+            return self.source
+        return compile_template(self.source).render(vars)
+
+
+class Condition:
+    '''Compiled when clause
+
+    Each test is a triple (positive, key, value). When value is None, the
+    test checks that key is a flag set or a variable defined, otherwise it
+    checks that the variable key has the given value.
+    '''
+
+    __slots__ = ('tests',)
+
+    def __init__(self, when: Optional[List[str]]):
+        self.tests = []
+        for cond in when or []:
+            positive = cond[0] != '!'
+            if not positive:
+                cond = cond[1:]
+            if '=' in cond:
+                [key, value] = cond.split('=', 1)
+                self.tests.append((positive, key, value))
+            else:
+                self.tests.append((positive, cond, None))
+
+    def holds(self, bools: Set[str], vars: Dict[str, str]) -> bool:
+        for (positive, key, value) in self.tests:
+            if value is None:
+                present = key in bools or key in vars
+            else:
+                present = vars.get(key, None) == value
+            if present != positive:
+                return False
+        return True
+
+    def index_key(self) -> Optional[str]:
+        '''Key of the first positive test: it must be true for the clause'''
+        for (positive, key, value) in self.tests:
+            if positive:
+                return key if value is None else f'{key}={value}'
+        return None
+
+
+class Binding:
+    '''Compiled definition of an environment variable'''
+
+    __slots__ = ('name', 'value', 'condition')
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.name = spec['name']
+        self.value = Template(spec['value'])
+        self.condition = Condition(spec.get('when', None))
+
+
+class Recipe:
+    '''Compiled recipe'''
+
+    __slots__ = ('condition', 'packages', 'elements')
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.condition = Condition(spec.get('when', None))
+        self.packages = [Template(p) for p in spec.get('packages', [])]
+        self.elements = [Template(e) for e in spec.get('elements', [])]
+
+
+class RecipeIndex:
+    '''Recipes indexed by a flag or variable binding they depend on
+
+    Only recipes that are either unconditional or indexed by a flag set or a
+    variable binding can be applied. They are returned in their order of
+    definition.
+    '''
+
+    def __init__(self):
+        self.recipes: List[Recipe] = []
+        self.unconditional: List[int] = []
+        self.by_key: Dict[str, List[int]] = {}
+
+    def add(self, recipe: Recipe):
+        index = len(self.recipes)
+        self.recipes.append(recipe)
+        key = recipe.condition.index_key()
+        if key is None:
+            self.unconditional.append(index)
+        else:
+            self.by_key.setdefault(key, []).append(index)
+
+    def candidates(
+        self, bools: Iterable[str], vars: Dict[str, str]
+    ) -> List[Recipe]:
+        selected = list(self.unconditional)
+        for flag in bools:
+            selected += self.by_key.get(flag, [])
+        for (key, value) in vars.items():
+            selected += self.by_key.get(key, [])
+            selected += self.by_key.get(f'{key}={value}', [])
+        return [self.recipes[i] for i in sorted(set(selected))]
+
+
+class OrderedSet:
+    '''Insertion ordered set of strings'''
+
+    def __init__(self, items: Iterable[str] = ()):
+        self.items = dict.fromkeys(items)
+
+    def add(self, item: str):
+        self.items[item] = None
+
+    def discard(self, item: str):
+        self.items.pop(item, None)
+
+    def update(self, item: str):
+        '''Add an item or remove it if it begins with an exclamation mark'''
+        if item == '':
+            return
+        if item[0] == '!':
+            self.discard(item[1:])
+        else:
+            self.add(item)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
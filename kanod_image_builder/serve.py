@@ -0,0 +1,462 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Build service shared by the pipelines of a build host.
+
+Builds of matrix specifications are submitted through a small HTTP API on a
+Unix socket (or on a port of the loopback interface):
+
+* ``POST /builds`` with a matrix specification in YAML or JSON queues its
+  builds and returns their identifiers,
+* ``GET /builds`` returns the state of all the builds,
+* ``GET /builds/<id>`` returns the state and the result of a build,
+* ``GET /builds/<id>/log`` streams the log of a build until it ends.
+
+Builds are started in order of submission. The first build of the queue is
+admitted when the free processors, memory, disk space and loop devices of
+the host cover its requirements, and when the resources not yet reserved by
+running builds cover them too: builds take time to reach their peak usage.
+
+The configurations of modules are parsed and validated once and kept while
+their content does not change. The caches are shared by all the builds and
+the least recently used entries are evicted when no build is running.
+'''
+
+import argparse
+import glob
+from http import server
+import json
+import os
+from os import path
+import re
+import shutil
+import socketserver
+import threading
+import time
+
+import yaml
+
+from typing import Any, Dict, List, Optional, Tuple  # noqa: H301
+
+from kanod_image_builder import main as builder
+from kanod_image_builder import matrix
+from kanod_image_builder import parallelism as resources
+
+RESOURCES = ['cpus', 'memory', 'disk', 'loops']
+# Interval between two admission attempts when the host is busy.
+POLL_INTERVAL = 5
+LOG_CHUNK = 64 * 1024
+BUILD_PATH = re.compile(r'^/builds/([\w.-]+)(/log)?$')
+
+
+def loop_devices() -> Tuple[int, int]:
+    '''Number of loop device nodes and of loop devices in use'''
+    nodes = [
+        node for node in glob.glob('/dev/loop*')
+        if re.match(r'^/dev/loop\d+$', node)]
+    used = len(glob.glob('/sys/block/loop*/loop/backing_file'))
+    return (len(nodes), used)
+
+
+class Host:
+    '''Resources of the build host'''
+
+    def __init__(
+        self, folder: str, loops: Optional[int] = None,
+        cpus: Optional[int] = None
+    ):
+        self.folder = folder
+        self.loops = loops if loops is not None else max(
+            loop_devices()[0], 8)
+        self.cpus = cpus
+
+    def cpu_limit(self) -> int:
+        return self.cpus or resources.cpu_limit()
+
+    def total(self) -> Dict[str, float]:
+        return {
+            'cpus': self.cpu_limit(),
+            'memory': resources.meminfo().get('MemTotal', 0),
+            'disk': shutil.disk_usage(self.folder).total,
+            'loops': self.loops,
+        }
+
+    def free(self) -> Dict[str, float]:
+        return {
+            # Processors kept busy according to the load average.
+            'cpus': self.cpu_limit() - int(os.getloadavg()[0]),
+            'memory': resources.meminfo().get('MemAvailable', 0),
+            'disk': shutil.disk_usage(self.folder).free,
+            'loops': self.loops - loop_devices()[1],
+        }
+
+
+class ConfigCache:
+    '''Validated configurations of modules kept between builds'''
+
+    def __init__(self):
+        self.configs: Dict[str, Tuple[str, str, Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+        self.validator = builder.make_validator(
+            builder.load_schema('schema_config.yaml'))
+
+    def config(self, module: str) -> Tuple[str, Dict[str, Any]]:
+        '''Folder and parsed configuration of a module'''
+        content = builder.read_resource(module, 'config.yaml')
+        with self.lock:
+            cached = self.configs.get(module, None)
+            if cached is not None and cached[1] == content:
+                return (cached[0], cached[2])
+            folder = builder.module_folder(module)
+            config = yaml.load(content, Loader=builder.YamlLoader)
+            builder.report_errors(self.validator, config, folder)
+            self.configs[module] = (folder, content, config)
+            return (folder, config)
+
+    def make_builder(
+        self, modules: List[str], flags: List[str], vars: Dict[str, str]
+    ) -> builder.ImageBuilder:
+        image_builder = builder.ImageBuilder(validate=False)
+        for module in ['kanod_image_builder'] + modules:
+            image_builder.add_config(*self.config(module))
+        image_builder.compute_git_url()
+        image_builder.compile(flags, vars)
+        return image_builder
+
+
+class Job:
+    '''A build submitted to the service'''
+
+    def __init__(
+        self, id: str, build: matrix.Build,
+        image_builder: builder.ImageBuilder, workdir: str
+    ):
+        self.id = id
+        self.build = build
+        self.image_builder = image_builder
+        self.workdir = workdir
+        self.state = 'queued'
+        self.waiting: Optional[str] = None
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+
+    @property
+    def log(self) -> str:
+        return path.join(self.workdir, self.build.name, 'build.log')
+
+    @property
+    def done(self) -> bool:
+        return self.state not in ['queued', 'running']
+
+    def describe(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            'id': self.id, 'name': self.build.name, 'state': self.state,
+            'submitted': self.submitted, 'started': self.started,
+            'finished': self.finished}
+        if self.waiting is not None:
+            result['waiting'] = self.waiting
+        if self.result is not None:
+            result['result'] = self.result
+        return result
+
+
+class BuildService:
+    '''Queue of builds admitted according to the resources of the host'''
+
+    def __init__(
+        self, workdir: str, output_dir: str, requirements: Dict[str, float],
+        loops: Optional[int] = None,
+        options: Optional[builder.BuildOptions] = None,
+        postbuild: Optional[Dict[str, Any]] = None, package_index=None,
+        cpus: Optional[int] = None
+    ):
+        self.workdir = path.abspath(workdir)
+        self.output_dir = path.abspath(output_dir)
+        os.makedirs(self.workdir, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.requirements = requirements
+        self.host = Host(self.workdir, loops, cpus)
+        self.postbuild = postbuild
+        self.package_index = package_index
+        self.configs = ConfigCache()
+        # Builds use the resources they are admitted with.
+        self.options = (options or builder.BuildOptions()).with_parallelism(
+            resources.Parallelism(
+                int(requirements['cpus']), int(requirements['memory'])))
+        self.jobs: Dict[str, Job] = {}
+        self.queue: List[Job] = []
+        self.running: List[Job] = []
+        self.counter = 0
+        self.condition = threading.Condition()
+        total = self.host.total()
+        for key in RESOURCES:
+            if requirements[key] > total[key]:
+                raise Exception(
+                    f'A build requires more {key} than the host has')
+
+    def submit(self, content: str) -> List[Job]:
+        '''Queue the builds of a matrix specification
+
+        The builds are compiled and checked before being queued.
+        '''
+        (_, builds) = matrix.parse_matrix(content, 'request')
+        image_builders = [
+            self.configs.make_builder(build.modules, build.flags, build.vars)
+            for build in builds]
+        matrix.preflight(builds, image_builders, self.package_index)
+        jobs = []
+        with self.condition:
+            for (build, image_builder) in zip(builds, image_builders):
+                self.counter += 1
+                id = f'{self.counter:05d}-{build.name}'
+                job = Job(
+                    id, build, image_builder, path.join(self.workdir, id))
+                self.jobs[id] = job
+                self.queue.append(job)
+                jobs.append(job)
+            self.condition.notify_all()
+        return jobs
+
+    def blocking(self) -> Optional[str]:
+        '''Resource missing to admit a new build, if any'''
+        free = self.host.free()
+        total = self.host.total()
+        for key in RESOURCES:
+            reserved = self.requirements[key] * len(self.running)
+            if min(free[key], total[key] - reserved) < self.requirements[key]:
+                return key
+        return None
+
+    def schedule(self):
+        '''Admit the builds of the queue in order, forever'''
+        while True:
+            with self.condition:
+                while len(self.queue) > 0:
+                    job = self.queue[0]
+                    job.waiting = self.blocking()
+                    if job.waiting is not None:
+                        break
+                    self.queue.pop(0)
+                    self.running.append(job)
+                    job.state = 'running'
+                    job.started = time.time()
+                    threading.Thread(
+                        target=self.run, args=(job,), daemon=True).start()
+                self.condition.wait(POLL_INTERVAL)
+
+    def run(self, job: Job):
+        output_dir = path.join(self.output_dir, job.id)
+        os.makedirs(output_dir, exist_ok=True)
+        result = matrix.run_build(
+            job.build, job.image_builder, job.workdir, output_dir,
+            options=self.options, postbuild=self.postbuild)
+        with self.condition:
+            job.result = result
+            job.state = result['status']
+            job.finished = time.time()
+            self.running.remove(job)
+            idle = len(self.running) == 0
+            self.condition.notify_all()
+        if idle:
+            self.evict()
+
+    def evict(self):
+        '''Evict the shared caches: they must not be used by any build'''
+        with self.condition:
+            if len(self.running) > 0:
+                return
+            for cache in [
+                self.options.package_cache, self.options.artifact_cache
+            ]:
+                if cache is not None:
+                    cache.evict()
+
+
+class ServiceHandler(server.BaseHTTPRequestHandler):
+    '''HTTP API of the build service'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self) -> str:
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'local'
+
+    @property
+    def service(self) -> BuildService:
+        return self.server.service  # type: ignore
+
+    def send_json(self, code: int, content: Any):
+        body = json.dumps(content, indent=2).encode('utf-8') + b'\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/builds':
+            self.send_json(404, {'error': 'not found'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        content = self.rfile.read(length).decode('utf-8')
+        try:
+            jobs = self.service.submit(content)
+        except Exception as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(
+            202, {'builds': [
+                {'id': job.id, 'name': job.build.name} for job in jobs]})
+
+    def do_GET(self):
+        if self.path == '/builds':
+            with self.service.condition:
+                self.send_json(200, [
+                    job.describe() for job in self.service.jobs.values()])
+            return
+        match = BUILD_PATH.match(self.path)
+        job = None if match is None else self.service.jobs.get(
+            match.group(1), None)
+        if job is None:
+            self.send_json(404, {'error': 'not found'})
+        elif match.group(2) is None:
+            with self.service.condition:
+                self.send_json(200, job.describe())
+        else:
+            self.stream_log(job)
+
+    def stream_log(self, job: Job):
+        '''Send the log of a build as it is written, until the build ends'''
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        fd = None
+        try:
+            while True:
+                done = job.done
+                if fd is None and path.isfile(job.log):
+                    fd = open(job.log, 'rb')
+                chunk = b'' if fd is None else fd.read(LOG_CHUNK)
+                if len(chunk) > 0:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    self.wfile.flush()
+                elif done:
+                    break
+                else:
+                    time.sleep(0.5)
+            self.wfile.write(b'0\r\n\r\n')
+        finally:
+            if fd is not None:
+                fd.close()
+
+
+class UnixServiceServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_requirements(args) -> Dict[str, float]:
+    from kanod_image_builder import cache as image_cache
+    return {
+        'cpus': args.build_cpus,
+        'memory': image_cache.parse_size(args.build_memory),
+        'disk': image_cache.parse_size(args.build_disk),
+        'loops': args.build_loops,
+    }
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='kanod-image-builder serve')
+    parser.add_argument(
+        '--socket', default='kanod-image-builder.sock',
+        help='Unix socket of the API'
+    )
+    parser.add_argument(
+        '--listen', default=None,
+        help='port of the loopback interface for the API instead of a socket'
+    )
+    parser.add_argument(
+        '--workdir', '-w', default='kanod-builds',
+        help='folder of the work directories of the builds'
+    )
+    parser.add_argument(
+        '--output-dir', '-o', default='.',
+        help='folder where images are produced (one sub-folder per build)'
+    )
+    parser.add_argument(
+        '--build-cpus', type=float, default=2,
+        help='processors required by a build'
+    )
+    parser.add_argument(
+        '--build-memory', default='4G',
+        help='memory required by a build'
+    )
+    parser.add_argument(
+        '--build-disk', default='20G',
+        help='disk space required by a build in the work directory'
+    )
+    parser.add_argument(
+        '--build-loops', type=int, default=1,
+        help='loop devices required by a build'
+    )
+    parser.add_argument(
+        '--loop-devices', type=int, default=None,
+        help='loop devices usable on the host (default: existing, at least 8)'
+    )
+    builder.add_cache_arguments(parser)
+    builder.add_timing_arguments(parser)
+    builder.add_optimize_arguments(parser)
+    builder.add_postbuild_arguments(parser)
+    builder.add_package_cache_arguments(parser)
+    builder.add_artifact_cache_arguments(parser)
+    builder.add_download_cache_arguments(parser)
+    builder.add_base_image_arguments(parser)
+    builder.add_package_index_arguments(parser)
+    builder.add_parallelism_arguments(parser)
+    args = parser.parse_args(argv)
+    proxy = builder.open_proxy(args)
+    try:
+        service = BuildService(
+            args.workdir, args.output_dir, parse_requirements(args),
+            loops=args.loop_devices,
+            options=builder.build_options(args, proxy),
+            postbuild=builder.postbuild_options(args),
+            package_index=builder.open_package_index(args),
+            cpus=args.parallelism)
+        if args.listen is not None:
+            api = server.ThreadingHTTPServer(
+                ('127.0.0.1', int(args.listen)), ServiceHandler)
+            print(f'Listening on http://127.0.0.1:{args.listen}', flush=True)
+        else:
+            if path.exists(args.socket):
+                os.remove(args.socket)
+            api = UnixServiceServer(args.socket, ServiceHandler)
+            print(f'Listening on {args.socket}', flush=True)
+        api.service = service  # type: ignore
+        threading.Thread(target=service.schedule, daemon=True).start()
+        try:
+            api.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            api.server_close()
+            if args.listen is None and path.exists(args.socket):
+                os.remove(args.socket)
+    finally:
+        if proxy is not None:
+            proxy.stop()
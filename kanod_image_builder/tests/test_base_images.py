@@ -0,0 +1,177 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Store of base images against a local upstream server.'''
+
+import gzip
+import hashlib
+import os
+from os import path
+import shutil
+import tempfile
+import threading
+import unittest
+
+from typing import Dict, Optional  # noqa: H301
+
+from kanod_image_builder import base_images
+from kanod_image_builder.tests import upstream
+
+IMAGES = {
+    'noble.img': b'noble image',
+    'jammy.img': b'jammy image',
+    'plucky.img': b'plucky image',
+}
+
+
+def sha256(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class FakeBuilder:
+    '''Compiled builder reduced to what the store uses'''
+
+    def __init__(self, image: str, vars: Optional[Dict[str, str]] = None):
+        self.vars = {'image': image, 'target': 'ubuntu', **(vars or {})}
+
+    def environment(self) -> Dict[str, str]:
+        return {'DIB_RELEASE': 'noble'}
+
+
+class TestBaseImageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        files = {f'/images/{name}': content
+                 for (name, content) in IMAGES.items()}
+        files['/images/compressed.img.gz'] = gzip.compress(b'gz image')
+        files['/images/SHA256SUMS'] = ''.join(
+            f'{sha256(content)} *{name[len("/images/"):]}\n'
+            for (name, content) in files.items()).encode('utf-8')
+        self.upstream = upstream.Upstream(files)
+        self.store = self.open()
+
+    def tearDown(self):
+        self.upstream.stop()
+        shutil.rmtree(self.folder)
+
+    def open(self, **kwargs) -> base_images.BaseImageStore:
+        return base_images.BaseImageStore(
+            path.join(self.folder, 'store'), **kwargs)
+
+    def url(self, name: str) -> str:
+        return f'{self.upstream.url}/images/{name}'
+
+    def source(self, name: str, **vars) -> Dict[str, str]:
+        return self.store.source(FakeBuilder(self.url(name), vars))
+
+    def read(self, filename: str) -> bytes:
+        with open(filename, 'rb') as fd:
+            return fd.read()
+
+    def test_checksum_file(self):
+        source = self.source('noble.img')
+        self.assertEqual(source['sha256'], sha256(IMAGES['noble.img']))
+        lease = self.store.acquire(source)
+        try:
+            self.assertEqual(self.read(lease.path), IMAGES['noble.img'])
+            self.assertEqual(
+                path.dirname(lease.path), self.store.folder(source))
+        finally:
+            lease.release()
+        self.assertEqual(
+            self.store.read_index(), {source['url']: source['sha256']})
+
+    def test_checksum_mismatch(self):
+        source = self.source('noble.img', image_sha256='0' * 64)
+        with self.assertRaisesRegex(Exception, 'expected 0000'):
+            self.store.acquire(source)
+        self.assertIsNone(self.store.entry(source))
+        self.assertEqual(
+            os.listdir(path.join(self.store.root, base_images.TMP)), [])
+
+    def test_no_published_checksum(self):
+        del self.upstream.files['/images/SHA256SUMS']
+        with self.assertRaisesRegex(Exception, 'No sha256 published'):
+            self.source('noble.img')
+
+    def test_decompression(self):
+        lease = self.store.acquire(self.source('compressed.img.gz'))
+        try:
+            self.assertEqual(path.basename(lease.path), 'compressed.img')
+            self.assertEqual(self.read(lease.path), b'gz image')
+        finally:
+            lease.release()
+
+    def test_offline(self):
+        offline = self.open(offline=True)
+        with self.assertRaisesRegex(Exception, 'offline'):
+            offline.source(FakeBuilder(self.url('noble.img')))
+        source = self.source('noble.img')
+        with self.assertRaisesRegex(Exception, 'offline'):
+            offline.acquire(source)
+        self.store.acquire(source).release()
+        self.upstream.requests = []
+        source = offline.source(FakeBuilder(self.url('noble.img')))
+        lease = offline.acquire(source)
+        lease.release()
+        self.assertEqual(self.read(lease.path), IMAGES['noble.img'])
+        self.assertEqual(self.upstream.requests, [])
+
+    def test_incomplete_entry(self):
+        source = self.source('noble.img')
+        folder = self.store.folder(source)
+        os.makedirs(folder)
+        for name in ['noble.img', 'noble.img.gz']:
+            with open(path.join(folder, name), 'wb') as fd:
+                fd.write(b'partial')
+        lease = self.store.acquire(source)
+        lease.release()
+        self.assertEqual(os.listdir(folder), ['noble.img'])
+        self.assertEqual(self.read(lease.path), IMAGES['noble.img'])
+
+    def test_concurrent_downloads(self):
+        source = self.source('noble.img')
+        leases = []
+
+        def acquire():
+            leases.append(self.store.acquire(source))
+
+        threads = [threading.Thread(target=acquire) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for lease in leases:
+            lease.release()
+        self.assertEqual(len(leases), 4)
+        self.assertEqual(self.upstream.methods('/images/noble.img'), ['GET'])
+
+    def test_eviction_keeps_leased_images(self):
+        self.store.max_size = len(IMAGES['noble.img'])
+        noble = self.store.acquire(self.source('noble.img'))
+        jammy = self.store.acquire(self.source('jammy.img'))
+        # Both images are in use: none is evicted.
+        self.assertEqual(len(self.store.entries()), 2)
+        os.utime(path.dirname(noble.path), (1000, 1000))
+        jammy.release()
+        # noble is the least recently used image but it is leased.
+        self.store.evict()
+        self.assertTrue(path.isfile(noble.path))
+        self.assertFalse(path.exists(jammy.path))
+        noble.release()
+        plucky = self.store.acquire(self.source('plucky.img'))
+        plucky.release()
+        self.assertFalse(path.exists(noble.path))
+        self.assertTrue(path.isfile(plucky.path))
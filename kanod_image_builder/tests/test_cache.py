@@ -0,0 +1,227 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Digest of recipes and local and HTTP caches of images.'''
+
+import contextlib
+import io
+import os
+from os import path
+import shutil
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from typing import Any, Dict, Optional  # noqa: H301
+
+from kanod_image_builder import cache as image_cache
+from kanod_image_builder.tests import upstream
+
+
+class FakeBuilder:
+    '''Compiled builder reduced to what the digest uses'''
+
+    def __init__(self, elements_path: str, env: Dict[str, str]):
+        self.folders = elements_path
+        self.env = env
+        self.elements = ['vm', 'ubuntu-minimal', 'kanod-configure']
+        self.packages = ['curl', 'jq']
+        self.base_image: Optional[Dict[str, Any]] = None
+
+    def environment(self) -> Dict[str, str]:
+        return self.env
+
+    def elements_path(self) -> str:
+        return self.folders
+
+
+class TestRecipeDigest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def checkout(self, name: str) -> str:
+        '''Element folder with the same content in each checkout'''
+        elements = path.join(self.folder, name, 'elements')
+        os.makedirs(path.join(elements, 'kanod-configure', 'install.d'))
+        hook = path.join(
+            elements, 'kanod-configure', 'install.d', '10-configure')
+        with open(hook, 'w') as fd:
+            fd.write('#!/bin/bash\necho configure\n')
+        os.chmod(hook, 0o755)
+        return elements
+
+    def image(self, name: str) -> str:
+        filename = path.join(self.folder, name)
+        with open(filename, 'wb') as fd:
+            fd.write(b'base image')
+        return filename
+
+    def digest(self, image_builder: FakeBuilder) -> str:
+        return image_cache.recipe_digest(image_builder, 'qcow2', '')
+
+    def test_host_independent(self):
+        first = FakeBuilder(self.checkout('first'), {
+            'DIB_RELEASE': 'noble', 'HOME': '/home/first',
+            'DIB_LOCAL_IMAGE': self.image('first.img'),
+            'DIB_KANOD_GIT_URL': 'git@gitlab.example.com:kanod'})
+        second = FakeBuilder(self.checkout('second'), {
+            'DIB_RELEASE': 'noble', 'PATH': '/opt/bin',
+            'DIB_LOCAL_IMAGE': self.image('second.img'),
+            'DIB_KANOD_GIT_URL': 'https://ci@gitlab.example.com/kanod/'})
+        # Files generated on the host are ignored.
+        cache_folder = path.join(second.folders, 'kanod-configure',
+                                 '__pycache__')
+        os.makedirs(cache_folder)
+        with open(path.join(cache_folder, 'x.pyc'), 'wb') as fd:
+            fd.write(b'\0')
+        self.assertEqual(self.digest(first), self.digest(second))
+
+    def test_recipe_changes(self):
+        elements = self.checkout('first')
+        reference = self.digest(FakeBuilder(elements, {'DIB_RELEASE': 'x'}))
+        self.assertNotEqual(
+            self.digest(FakeBuilder(elements, {'DIB_RELEASE': 'y'})),
+            reference)
+        image_builder = FakeBuilder(elements, {'DIB_RELEASE': 'x'})
+        image_builder.packages.append('vim')
+        self.assertNotEqual(self.digest(image_builder), reference)
+        hook = path.join(
+            elements, 'kanod-configure', 'install.d', '10-configure')
+        os.chmod(hook, 0o644)
+        self.assertNotEqual(
+            self.digest(FakeBuilder(elements, {'DIB_RELEASE': 'x'})),
+            reference)
+
+    def test_local_image_content(self):
+        elements = self.checkout('first')
+        image = self.image('base.img')
+        reference = self.digest(
+            FakeBuilder(elements, {'DIB_LOCAL_IMAGE': image}))
+        with open(image, 'ab') as fd:
+            fd.write(b' changed')
+        self.assertNotEqual(
+            self.digest(FakeBuilder(elements, {'DIB_LOCAL_IMAGE': image})),
+            reference)
+
+    def test_normalize_git_url(self):
+        for url in ['git@gitlab.example.com:org/kanod',
+                    'ssh://git@gitlab.example.com:2222/org/kanod',
+                    'https://user@GitLab.example.com/org/kanod.git',
+                    'http://gitlab.example.com/org/kanod/']:
+            self.assertEqual(
+                image_cache.normalize_git_url(url),
+                'gitlab.example.com/org/kanod', url)
+        self.assertEqual(
+            image_cache.normalize_git_url('/srv/git/org'), '/srv/git/org')
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = image_cache.LocalCache(
+            path.join(self.folder, 'cache'), max_size=25)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def store(self, key: str, used: int):
+        source = path.join(self.folder, key)
+        with open(source, 'wb') as fd:
+            fd.write(b'x' * 10)
+        self.cache.store(key, source)
+        os.utime(self.cache.entry(key), (used, used))
+
+    def test_hit_and_miss(self):
+        self.store('a', 1000)
+        target = path.join(self.folder, 'image')
+        self.assertFalse(self.cache.fetch('b', target))
+        self.assertTrue(self.cache.fetch('a', target))
+        with open(target, 'rb') as fd:
+            self.assertEqual(fd.read(), b'x' * 10)
+
+    def test_lru_eviction(self):
+        self.store('a', 1000)
+        self.store('b', 2000)
+        # A hit makes a the most recently used entry.
+        self.assertTrue(
+            self.cache.fetch('a', path.join(self.folder, 'image')))
+        self.store('c', 3000)
+        self.assertEqual(
+            sorted(e['path'] for e in self.cache.entries()),
+            [self.cache.entry('a'), self.cache.entry('c')])
+
+    def test_unbounded(self):
+        cache = image_cache.LocalCache(path.join(self.folder, 'unbounded'))
+        source = path.join(self.folder, 'source')
+        with open(source, 'wb') as fd:
+            fd.write(b'x' * 100)
+        for key in ['a', 'b', 'c']:
+            cache.store(key, source)
+        self.assertEqual(len(cache.entries()), 3)
+
+
+class TestHttpCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.upstream = upstream.Upstream()
+        self.cache = image_cache.open_cache(f'{self.upstream.url}/images/')
+        self.target = path.join(self.folder, 'image')
+
+    def tearDown(self):
+        self.upstream.stop()
+        shutil.rmtree(self.folder)
+
+    def test_store_and_fetch(self):
+        self.assertFalse(self.cache.fetch('key.qcow2', self.target))
+        source = path.join(self.folder, 'source')
+        with open(source, 'wb') as fd:
+            fd.write(b'image content')
+        self.cache.store('key.qcow2', source)
+        self.assertEqual(
+            self.upstream.files['/images/key.qcow2'], b'image content')
+        self.assertTrue(self.cache.fetch('key.qcow2', self.target))
+        with open(self.target, 'rb') as fd:
+            self.assertEqual(fd.read(), b'image content')
+
+    def test_server_errors(self):
+        self.upstream.files['/images/key.qcow2'] = b'image content'
+        self.upstream.status = 503
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.assertFalse(self.cache.fetch('key.qcow2', self.target))
+            self.cache.store('other.qcow2', __file__)
+        self.assertIn('failed', stderr.getvalue())
+        self.assertIn('not stored', stderr.getvalue())
+        self.assertFalse(path.exists(self.target))
+
+    @mock.patch.object(image_cache, 'TIMEOUT', 0.2)
+    def test_timeout(self):
+        # The connection is accepted by the kernel but never answered.
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(8)
+            cache = image_cache.HttpCache(
+                f'http://127.0.0.1:{sock.getsockname()[1]}')
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                self.assertFalse(cache.fetch('key.qcow2', self.target))
+                cache.store('key.qcow2', __file__)
+        self.assertIn('timed out', stderr.getvalue())
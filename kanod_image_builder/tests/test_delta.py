@@ -0,0 +1,100 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Deltas between versions of raw and qcow2 images.'''
+
+import os
+from os import path
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from kanod_image_builder import delta as image_delta
+
+CHUNK = image_delta.MIN_CHUNK_SIZE
+QEMU_IMG = shutil.which('qemu-img')
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = random.Random(0)
+        self.old = path.join(self.folder, 'old.raw')
+        self.new = path.join(self.folder, 'new.raw')
+        data = bytearray(rng.randbytes(32 * CHUNK))
+        with open(self.old, 'wb') as fd:
+            fd.write(data)
+        # Two chunks changed, one zeroed and one duplicated.
+        data[3 * CHUNK:4 * CHUNK] = rng.randbytes(CHUNK)
+        data[10 * CHUNK:11 * CHUNK] = data[3 * CHUNK:4 * CHUNK]
+        data[20 * CHUNK:21 * CHUNK] = bytes(CHUNK)
+        with open(self.new, 'wb') as fd:
+            fd.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read(self, filename: str) -> bytes:
+        with open(filename, 'rb') as fd:
+            return fd.read()
+
+    def test_raw(self):
+        delta = path.join(self.folder, 'new.delta')
+        stats = image_delta.make_delta(self.old, self.new, delta, CHUNK)
+        self.assertEqual(stats['stored'], 1)
+        self.assertEqual(stats['duplicate'], 1)
+        self.assertEqual(stats['zero'], 1)
+        self.assertEqual(stats['old'], 29)
+        output = path.join(self.folder, 'rebuilt.raw')
+        image_delta.apply_delta(self.old, delta, output)
+        self.assertEqual(self.read(output), self.read(self.new))
+        self.assertEqual(
+            sorted(os.listdir(self.folder)),
+            ['new.delta', 'new.raw', 'old.raw', 'rebuilt.raw'])
+
+    def test_wrong_old_image(self):
+        delta = path.join(self.folder, 'new.delta')
+        image_delta.make_delta(self.old, self.new, delta, CHUNK)
+        other = path.join(self.folder, 'other.raw')
+        with open(other, 'wb') as fd:
+            fd.write(random.Random(1).randbytes(32 * CHUNK))
+        output = path.join(self.folder, 'rebuilt.raw')
+        with self.assertRaisesRegex(Exception, 'does not match'):
+            image_delta.apply_delta(other, delta, output)
+        self.assertFalse(path.exists(output))
+
+    @unittest.skipIf(QEMU_IMG is None, 'qemu-img is not installed')
+    def test_compressed_qcow2(self):
+        images = {}
+        for name in ['old', 'new']:
+            images[name] = path.join(self.folder, f'{name}.qcow2')
+            subprocess.run(
+                ['qemu-img', 'convert', '-f', 'raw', '-O', 'qcow2', '-c',
+                 '-o', f'compression_type=zstd,cluster_size={CHUNK}',
+                 path.join(self.folder, f'{name}.raw'), images[name]],
+                check=True)
+        delta = path.join(self.folder, 'new.delta')
+        stats = image_delta.make_delta(images['old'], images['new'], delta)
+        # Only the changed chunk of the guest data is stored.
+        self.assertEqual(stats['stored'], 1)
+        self.assertLess(stats['delta-size'], 2 * CHUNK)
+        output = path.join(self.folder, 'rebuilt.qcow2')
+        image_delta.apply_delta(images['old'], delta, output)
+        self.assertEqual(image_delta.image_format(output), 'qcow2')
+        subprocess.run(
+            ['qemu-img', 'compare', '-f', 'qcow2', '-F', 'qcow2', output,
+             images['new']], check=True, stdout=subprocess.DEVNULL)
@@ -0,0 +1,118 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Footprint reports from recorded kanod-footprint files.'''
+
+import contextlib
+import io
+import json
+from os import path
+import shutil
+import tempfile
+import unittest
+
+from kanod_image_builder import footprint
+
+FIXTURE = path.join(path.dirname(__file__), 'fixtures', 'footprint')
+OWNERS = {
+    ('root', '01-kanod-footprint'): 'kanod-footprint',
+    ('root', '10-debootstrap'): 'ubuntu-minimal',
+    ('install', '10-packages'): 'package-installs',
+    ('install', '50-kanod-configure'): 'kanod-configure',
+    ('post-install', '10-cleanup'): 'kanod-configure',
+}
+
+
+class TestFootprint(unittest.TestCase):
+
+    def setUp(self):
+        self.report = footprint.make_report(FIXTURE, OWNERS)
+
+    def test_steps(self):
+        steps = self.report['steps']
+        # Steps that do not change the usage are not reported.
+        self.assertNotIn('install.d/10-packages', steps)
+        self.assertEqual(steps['root.d/10-debootstrap'], {
+            'element': 'ubuntu-minimal',
+            'devices': {'root': 499000, 'lvm_var': 20000}})
+        self.assertEqual(steps['install.d/99-local'], {
+            'element': 'unknown',
+            'devices': {'root': -10000, 'lvm_var': 10000}})
+        self.assertEqual(len(steps), 5)
+
+    def test_elements(self):
+        self.assertEqual(self.report['elements'], {
+            'kanod-footprint': {'root': 1000},
+            'ubuntu-minimal': {'root': 499000, 'lvm_var': 20000},
+            'kanod-configure': {'root': 160000},
+            'unknown': {'root': -10000, 'lvm_var': 10000},
+        })
+
+    def test_totals(self):
+        self.assertEqual(
+            self.report['mounts'], {'root': '/', 'lvm_var': '/var'})
+        self.assertEqual(
+            self.report['total'], {'root': 650000, 'lvm_var': 30000})
+        self.assertEqual(
+            self.report['packages']['tzdata'],
+            {'root': 3000000, 'lvm_var': 1000})
+        # The usage of the elements adds up to the final usage.
+        for device in ['root', 'lvm_var']:
+            self.assertEqual(
+                sum(usage.get(device, 0)
+                    for usage in self.report['elements'].values()),
+                self.report['total'][device])
+
+    def test_without_records(self):
+        folder = tempfile.mkdtemp()
+        try:
+            shutil.copy(path.join(FIXTURE, 'mounts'), folder)
+            report = footprint.make_report(folder, OWNERS)
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(
+            (report['total'], report['steps'], report['packages']),
+            ({}, {}, {}))
+
+    def test_compare(self):
+        old = {'curl': {'root': 500000}, 'jq': {'root': 70000},
+               'vim': {'root': 4000}}
+        new = {'curl': {'root': 520000}, 'jq': {'root': 70000},
+               'htop': {'root': 300, 'lvm_var': 10}}
+        self.assertEqual(footprint.compare(old, new), {
+            'curl': {'root': 20000},
+            'htop': {'root': 300, 'lvm_var': 10},
+            'vim': {'root': -4000},
+        })
+
+    def test_main(self):
+        folder = tempfile.mkdtemp()
+        try:
+            old = footprint.write_report(
+                self.report, path.join(folder, 'old'))
+            with open(old) as fd:
+                self.assertEqual(json.load(fd), self.report)
+            new_report = dict(self.report, packages={
+                **self.report['packages'], 'vim': {'root': 4000}})
+            new = footprint.write_report(
+                new_report, path.join(folder, 'new'))
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                footprint.main([old, new])
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(output.getvalue().splitlines(), [
+            'Devices:', '  no change',
+            'Elements:', '  no change',
+            'Packages:', '  vim: root +4,000'])
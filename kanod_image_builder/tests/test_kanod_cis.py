@@ -0,0 +1,191 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Native CIS rules of kanod-cis applied to a temporary root.'''
+
+from importlib import machinery
+from importlib import util
+import json
+import os
+from os import path
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+ENGINE = path.join(
+    path.dirname(path.dirname(__file__)), 'elements', 'cis-remediation',
+    'kanod-cis', 'kanod-cis')
+
+
+def load_engine():
+    loader = machinery.SourceFileLoader('kanod_cis', ENGINE)
+    module = util.module_from_spec(util.spec_from_loader('kanod_cis', loader))
+    loader.exec_module(module)
+    return module
+
+
+kanod_cis = load_engine()
+
+
+class RootTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, filename: str, content: str, mode: int = 0o644):
+        name = path.join(self.root, filename)
+        os.makedirs(path.dirname(name), exist_ok=True)
+        with open(name, 'w') as fd:
+            fd.write(content)
+        os.chmod(name, mode)
+
+    def read(self, filename: str) -> str:
+        with open(path.join(self.root, filename)) as fd:
+            return fd.read()
+
+
+class TestFileRules(RootTestCase):
+
+    def test_ensure_line(self):
+        self.write('etc/pam.d/common-session', 'session required pam_unix.so')
+        line = 'session optional pam_mkhomedir.so umask=0027'
+        self.assertTrue(kanod_cis.ensure_line(
+            self.root, '/etc/pam.d/common-session', line))
+        self.assertFalse(kanod_cis.ensure_line(
+            self.root, '/etc/pam.d/common-session', line))
+        self.assertEqual(
+            self.read('etc/pam.d/common-session'),
+            f'session required pam_unix.so\n{line}\n')
+
+    def test_blacklist(self):
+        os.makedirs(path.join(self.root, 'etc', 'modprobe.d'))
+        self.assertTrue(kanod_cis.blacklist(self.root, 'udf', 'udf'))
+        self.assertFalse(kanod_cis.blacklist(self.root, 'udf', 'udf'))
+        self.assertEqual(
+            self.read('etc/modprobe.d/udf.conf'), 'blacklist udf\n')
+
+    def test_kernel_parameters(self):
+        self.write('etc/default/grub', (
+            'GRUB_DEFAULT=0\n'
+            'GRUB_CMDLINE_LINUX="old"\n'
+            'GRUB_CMDLINE_LINUX_DEFAULT="splash"\n'
+            'GRUB_CMDLINE_LINUX="quiet audit_backlog_limit=64 '
+            'console=ttyS0"\n'))
+        self.assertTrue(kanod_cis.kernel_parameters(
+            self.root, ['audit_backlog_limit=8192', 'audit=1']))
+        self.assertEqual(self.read('etc/default/grub'), (
+            'GRUB_DEFAULT=0\n'
+            'GRUB_CMDLINE_LINUX_DEFAULT="splash"\n'
+            'GRUB_CMDLINE_LINUX="quiet console=ttyS0 '
+            'audit_backlog_limit=8192 audit=1"\n'))
+        self.assertFalse(
+            kanod_cis.kernel_parameters(self.root, ['audit=1']))
+
+    def test_kernel_parameters_without_grub(self):
+        self.assertIsNone(kanod_cis.kernel_parameters(self.root, ['audit=1']))
+
+    @mock.patch.object(kanod_cis.os, 'chown')
+    def test_restrict(self, chown):
+        self.write('etc/ssh/sshd_config', 'Port 22\n', 0o755)
+        self.assertTrue(
+            kanod_cis.restrict(self.root, '/etc/ssh/sshd_config', 0o600))
+        mode = stat.S_IMODE(
+            os.stat(path.join(self.root, 'etc/ssh/sshd_config')).st_mode)
+        # Permissions are only removed.
+        self.assertEqual(mode, 0o600)
+        self.write('boot/grub/grub.cfg', '', 0o400)
+        kanod_cis.restrict(self.root, '/boot/grub/grub.cfg', 0o600)
+        mode = stat.S_IMODE(
+            os.stat(path.join(self.root, 'boot/grub/grub.cfg')).st_mode)
+        self.assertEqual(mode, 0o400)
+        if os.geteuid() == 0:
+            chown.assert_not_called()
+            self.assertFalse(
+                kanod_cis.restrict(self.root, '/etc/ssh/sshd_config', 0o600))
+
+    def test_privileged_programs(self):
+        for filename in ['usr/bin/su', 'usr/bin/ls', 'proc/1/exe', 'tmp/x',
+                         'run/y', 'var/tmp/z', 'usr/bin/wall']:
+            self.write(filename, '')
+        os.chmod(path.join(self.root, 'usr/bin/su'), 0o4755)
+        os.chmod(path.join(self.root, 'usr/bin/wall'), 0o2755)
+        for filename in ['proc/1/exe', 'tmp/x', 'run/y', 'var/tmp/z']:
+            os.chmod(path.join(self.root, filename), 0o4755)
+        os.symlink('su', path.join(self.root, 'usr/bin/link'))
+        self.assertEqual(
+            kanod_cis.privileged_programs(self.root),
+            ['/usr/bin/su', '/usr/bin/wall', '/var/tmp/z'])
+
+    @unittest.skipUnless(os.geteuid() == 0, 'files are owned by root')
+    def test_post_root_idempotent(self):
+        self.write('etc/login.defs', 'UMASK 022\nENCRYPT_METHOD SHA512\n')
+        self.write('etc/ssh/sshd_config', 'Port 22\n')
+        self.write('etc/pam.d/common-session', '')
+        os.makedirs(path.join(self.root, 'etc/modprobe.d'))
+        os.makedirs(path.join(self.root, 'etc/audit/rules.d'))
+        first = kanod_cis.apply(self.root, 'post-root')
+        self.assertEqual(first['rule_1.1.1.1']['status'], 'remediated')
+        self.assertEqual(first['rp_filter']['status'], 'skipped')
+        second = kanod_cis.apply(self.root, 'post-root')
+        self.assertEqual(
+            {record['status'] for record in second.values()},
+            {'compliant', 'skipped'})
+
+
+class TestReport(RootTestCase):
+
+    def report(self, name: str, records):
+        with open(path.join(self.root, name), 'w') as fd:
+            json.dump(records, fd)
+
+    def record(self, engine: str, status: str, seconds: float):
+        return {'engine': engine, 'title': 'x', 'status': status,
+                'seconds': seconds}
+
+    def test_merge(self):
+        merged = kanod_cis.merge(
+            self.record('ansible', 'compliant', 1.0),
+            self.record('native', 'remediated', 0.5))
+        self.assertEqual(merged['engine'], 'ansible,native')
+        self.assertEqual(merged['status'], 'remediated')
+        self.assertEqual(merged['seconds'], 1.5)
+        merged = kanod_cis.merge(merged, self.record('native', 'skipped', 0))
+        self.assertEqual(merged['engine'], 'ansible,native')
+        self.assertEqual(merged['status'], 'remediated')
+
+    def test_collect(self):
+        self.report('post-root.ansible.json', {
+            'a': self.record('ansible', 'failed', 2.0),
+            'b': self.record('ansible', 'skipped', 0.0)})
+        self.report('post-root.native.json', {
+            'a': self.record('native', 'remediated', 1.0),
+            'b': self.record('native', 'compliant', 0.1)})
+        self.report('finalise.native.json', {
+            'c': self.record('native', 'compliant', 0.2)})
+        self.write('notes.txt', 'ignored')
+        report = kanod_cis.collect(self.root)
+        self.assertEqual(sorted(report), ['finalise', 'post-root'])
+        self.assertEqual(report['post-root']['a']['status'], 'failed')
+        self.assertEqual(report['post-root']['b']['status'], 'compliant')
+        self.assertEqual(
+            report['post-root']['b']['engine'], 'ansible,native')
+        self.assertEqual(
+            kanod_cis.summary(report).splitlines(),
+            ['CIS finalise: 1 rules in 0.2s (1 compliant)',
+             'CIS post-root: 2 rules in 3.1s (1 compliant, 1 failed)'])
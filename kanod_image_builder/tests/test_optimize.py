@@ -0,0 +1,64 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Measures of the optimizer stage on a raw image.'''
+
+import os
+from os import path
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from kanod_image_builder import optimize
+
+MIB = 1 << 20
+
+
+def zero_free_space(image: str, log=None):
+    '''Stands for the discard: the second MiB of data is free space'''
+    with open(image, 'r+b') as fd:
+        fd.seek(MIB)
+        fd.write(bytes(MIB))
+    return {'partition 1': 'zero'}
+
+
+@unittest.skipIf(shutil.which('fallocate') is None, 'fallocate is missing')
+class TestOptimizeImage(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.raw = path.join(self.folder, 'image.raw')
+        with open(self.raw, 'wb') as fd:
+            # Data, free space with data and zeros written by DIB.
+            fd.write(os.urandom(2 * MIB) + bytes(2 * MIB))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @mock.patch.object(optimize, 'discard_free_space', zero_free_space)
+    def test_raw(self):
+        target = path.join(self.folder, 'image')
+        report = optimize.optimize_image(self.raw, target, 'raw', MIB)
+        # Zeros written by DIB are not counted as saved by the discard.
+        self.assertLessEqual(report['before']['allocated'], 2 * MIB + 4096)
+        self.assertLess(
+            report['discarded']['allocated'], report['before']['allocated'])
+        self.assertEqual(
+            report['after']['allocated'], report['discarded']['allocated'])
+        self.assertFalse(path.exists(self.raw))
+        self.assertEqual(
+            optimize.summary(report),
+            'Image optimized: raw data 2 MiB -> 1 MiB (partition 1: zero), '
+            'final image 1 MiB')
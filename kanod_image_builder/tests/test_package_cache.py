@@ -0,0 +1,181 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Package cache accounting and the apt wrappers of kanod-package-cache.'''
+
+import os
+from os import path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from kanod_image_builder import package_cache
+
+ELEMENT = path.join(
+    path.dirname(path.dirname(__file__)), 'elements',
+    package_cache.PACKAGE_CACHE_ELEMENT)
+# Mounts are not done: the shared folder is not used by the wrappers.
+FAKE_SUDO = '''#!/bin/bash
+if [ "$1" = mount ]; then
+    exit 0
+fi
+exec "$@"
+'''
+FAKE_APT = '''#!/bin/bash
+echo "$(basename "$0") $*" >> "$(dirname "$0")/calls"
+[ ! -f "$(dirname "$0")/broken" ]
+'''
+
+
+class TestPackageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = package_cache.PackageCache(self.folder, max_size=250)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def package(self, name: str, size: int, used: int) -> str:
+        filename = path.join(self.folder, name)
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as fd:
+            fd.write(b'p' * size)
+        os.utime(filename, (used, used))
+        return filename
+
+    def test_entries(self):
+        self.package('apt/ubuntu-noble/a.deb', 100, 1000)
+        self.package('apt/ubuntu-noble/lock', 10, 1000)
+        self.package('apt/ubuntu-noble/partial/b.deb', 50, 1000)
+        reads = self.package('zypp/opensuse-15.6/c.rpm', 30, 1000)
+        # A package read by a build is used even if it is not modified.
+        os.utime(reads, (5000, 1000))
+        entries = {
+            path.relpath(e['path'], self.folder): e
+            for e in self.cache.entries()}
+        self.assertEqual(
+            sorted(entries),
+            ['apt/ubuntu-noble/a.deb', 'zypp/opensuse-15.6/c.rpm'])
+        self.assertEqual(entries['zypp/opensuse-15.6/c.rpm']['used'], 5000)
+        self.assertEqual(self.cache.usage(), 130)
+
+    def test_evict(self):
+        old = self.package('apt/ubuntu-noble/old.deb', 100, 1000)
+        self.package('apt/ubuntu-noble/new.deb', 100, 3000)
+        middle = self.package('apt/ubuntu-jammy/middle.deb', 100, 2000)
+        self.package('apt/ubuntu-noble/partial/big.deb', 1000, 0)
+        self.assertEqual(self.cache.evict(), 200)
+        self.assertFalse(path.exists(old))
+        self.assertTrue(path.exists(middle))
+        self.assertEqual(self.cache.evict(), 200)
+
+    def test_unbounded(self):
+        self.package('apt/ubuntu-noble/a.deb', 1000, 1000)
+        cache = package_cache.PackageCache(self.folder)
+        self.assertEqual(cache.evict(), 1000)
+        self.assertEqual(len(cache.entries()), 1)
+
+
+class TestAptWrapper(unittest.TestCase):
+    '''Wrappers installed by root.d run with their paths in a folder'''
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.root = path.join(self.folder, 'root')
+        bin_dir = path.join(self.folder, 'bin')
+        os.makedirs(bin_dir)
+        with open(path.join(bin_dir, 'sudo'), 'w') as fd:
+            fd.write(FAKE_SUDO)
+        os.chmod(path.join(bin_dir, 'sudo'), 0o755)
+        env = dict(
+            os.environ, PATH=f'{bin_dir}:{os.environ["PATH"]}',
+            TARGET_ROOT=self.root, DISTRO_NAME='ubuntu', DIB_RELEASE='noble',
+            DIB_KANOD_PACKAGE_CACHE=path.join(self.folder, 'cache'))
+        subprocess.run(
+            ['bash', path.join(ELEMENT, 'root.d', '51-kanod-package-cache')],
+            env=env, check=True, stdout=subprocess.DEVNULL)
+        self.usr_bin = path.join(self.root, 'usr', 'bin')
+        os.makedirs(self.usr_bin)
+        for command in ['apt', 'apt-get']:
+            with open(path.join(self.usr_bin, command), 'w') as fd:
+                fd.write(FAKE_APT)
+            os.chmod(path.join(self.usr_bin, command), 0o755)
+            wrapper = path.join(self.root, 'usr', 'local', 'sbin', command)
+            with open(wrapper) as fd:
+                content = fd.read()
+            for folder in ['/etc/apt', '/var/lib/apt', '/usr/bin']:
+                content = content.replace(folder, f'{self.root}{folder}')
+            with open(wrapper, 'w') as fd:
+                fd.write(content)
+        os.makedirs(path.join(self.root, 'etc', 'apt', 'sources.list.d'))
+        os.makedirs(path.join(self.root, 'var', 'lib', 'apt', 'lists'))
+        self.sources('deb http://archive.ubuntu.com/ubuntu noble main\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def sources(self, content: str, name: str = 'sources.list'):
+        folder = path.join(self.root, 'etc', 'apt')
+        if name != 'sources.list':
+            folder = path.join(folder, 'sources.list.d')
+        with open(path.join(folder, name), 'w') as fd:
+            fd.write(content)
+
+    def run_apt(self, *args: str, command: str = 'apt-get') -> int:
+        return subprocess.run(
+            [path.join(self.root, 'usr', 'local', 'sbin', command)] +
+            list(args), stdout=subprocess.DEVNULL).returncode
+
+    def calls(self):
+        filename = path.join(self.usr_bin, 'calls')
+        if not path.isfile(filename):
+            return []
+        with open(filename) as fd:
+            return fd.read().splitlines()
+
+    def test_keep_packages(self):
+        conf = path.join(
+            self.root, 'etc', 'apt', 'apt.conf.d', '00kanod-package-cache')
+        with open(conf) as fd:
+            self.assertIn('Keep-Downloaded-Packages "true"', fd.read())
+
+    def test_update_once(self):
+        self.assertEqual(self.run_apt('update'), 0)
+        self.assertEqual(self.run_apt('-q', 'update'), 0)
+        self.assertEqual(self.run_apt('update', command='apt'), 0)
+        self.assertEqual(self.calls(), ['apt-get update'])
+
+    def test_sources_changed(self):
+        self.run_apt('update')
+        self.sources('deb http://example.com/repo noble main\n', 'x.list')
+        self.run_apt('update')
+        self.run_apt('update')
+        self.assertEqual(self.calls(), ['apt-get update'] * 2)
+
+    def test_failed_update(self):
+        open(path.join(self.usr_bin, 'broken'), 'w').close()
+        self.assertNotEqual(self.run_apt('update'), 0)
+        os.remove(path.join(self.usr_bin, 'broken'))
+        self.assertEqual(self.run_apt('update'), 0)
+        self.assertEqual(self.calls(), ['apt-get update'] * 2)
+
+    def test_other_actions(self):
+        self.run_apt('update')
+        self.run_apt('install', '-y', 'curl')
+        self.run_apt('install', '-y', 'curl')
+        self.assertEqual(
+            self.calls(),
+            ['apt-get update'] + ['apt-get install -y curl'] * 2)
@@ -0,0 +1,127 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Package checks against local fixture mirrors served as file:// URLs.'''
+
+import gzip
+import os
+from os import path
+import shutil
+import tempfile
+import unittest
+
+from typing import Dict, List  # noqa: H301
+
+from kanod_image_builder import package_index
+
+MIRRORS = path.join(path.dirname(__file__), 'fixtures', 'mirrors')
+
+
+class FakeBuilder:
+    '''Compiled builder reduced to what package checks use'''
+
+    def __init__(
+        self, elements: List[str], packages: List[str], env: Dict[str, str]
+    ):
+        self.elements = elements
+        self.packages = packages
+        self.env = env
+
+    def environment(self) -> Dict[str, str]:
+        return self.env
+
+
+class TestPackageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.mirror = path.join(self.folder, 'mirror')
+        shutil.copytree(MIRRORS, self.mirror)
+        self.index = package_index.PackageIndex(
+            path.join(self.folder, 'index'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def ubuntu(self, packages: List[str], additional: str = '') -> List[str]:
+        image_builder = FakeBuilder(
+            ['ubuntu-minimal', 'kanod-configure'], packages,
+            {'DIB_DISTRIBUTION_MIRROR': f'file://{self.mirror}/ubuntu',
+             'DIB_RELEASE': 'noble'})
+        return package_index.check(image_builder, additional, self.index)
+
+    def test_ubuntu_packages_found(self):
+        self.assertEqual(
+            self.ubuntu(['openssh-server', 'nmap'], 'iptables'), [])
+
+    def test_ubuntu_provides_and_updates(self):
+        self.assertEqual(
+            self.ubuntu(['ssh-client', 'linux-image-generic']), [])
+
+    def test_versions_are_ignored(self):
+        self.assertEqual(
+            self.ubuntu(['openssh-server=1:9.6p1-3ubuntu13,iptables']), [])
+
+    def test_missing_package_with_hint(self):
+        self.assertEqual(self.ubuntu(['openssh-servr', 'nmap']), [
+            'package openssh-servr not found in ubuntu noble '
+            '(did you mean openssh-server, ssh-server, openssh-client?)'])
+
+    def test_compressed_index_preferred(self):
+        folder = path.join(
+            self.mirror, 'ubuntu', 'dists', 'noble', 'universe',
+            'binary-amd64')
+        with open(path.join(folder, 'Packages'), 'rb') as fd, \
+                gzip.open(path.join(folder, 'Packages.gz'), 'wb') as out:
+            out.write(fd.read().replace(b'nmap', b'zenmap'))
+        self.assertEqual(self.ubuntu(['zenmap']), [])
+
+    def test_stale_index_used_offline(self):
+        self.assertEqual(self.ubuntu(['nmap']), [])
+        shutil.rmtree(path.join(self.mirror, 'ubuntu'))
+        self.index.max_age = 0
+        self.assertEqual(self.ubuntu(['nmap']), [])
+        self.assertEqual(len(self.ubuntu(['nope'])), 1)
+
+    def test_no_repository(self):
+        shutil.rmtree(path.join(self.mirror, 'ubuntu'))
+        with self.assertRaisesRegex(Exception, 'No package index found'):
+            self.ubuntu(['nmap'])
+
+    def test_centos_primary_metadata(self):
+        image_builder = FakeBuilder(
+            ['centos-minimal'], ['openssh-server', 'iproute2', 'dhclient'],
+            {'DIB_DISTRIBUTION_MIRROR': f'file://{self.mirror}/centos',
+             'DIB_RELEASE': '9-stream'})
+        self.assertEqual(
+            package_index.check(image_builder, '', self.index),
+            ['package dhclient not found in centos 9-stream'])
+        # AppStream does not exist in the mirror: it is not indexed.
+        self.assertEqual(
+            len([name for name in os.listdir(self.index.root)
+                 if name.endswith('.sqlite')]), 1)
+
+    def test_unsupported_distribution(self):
+        image_builder = FakeBuilder(['fedora'], [], {})
+        with self.assertRaisesRegex(Exception, 'can only be checked'):
+            package_index.check(image_builder, '', self.index)
+
+
+class TestPackageNames(unittest.TestCase):
+
+    def test_names(self):
+        self.assertEqual(
+            package_index.package_names(
+                ['a=1.0,b>=2', ' c:amd64', 'd*', '', 'a']),
+            ['a', 'b', 'c'])
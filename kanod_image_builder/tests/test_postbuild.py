@@ -0,0 +1,62 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Post-build digests and archives of images.'''
+
+import gzip
+import hashlib
+import os
+from os import path
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from kanod_image_builder import postbuild
+
+
+def broken_compressor(data: bytes) -> bytes:
+    raise Exception('compression failed')
+
+
+class TestProcessImage(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.image = path.join(self.folder, 'image.raw')
+        self.content = b'data' * 1000 + bytes(1 << 20) + b'end'
+        with open(self.image, 'wb') as fd:
+            fd.write(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_gz_archive(self):
+        manifest = postbuild.process_image(
+            self.image, 'raw', postbuild.DIGESTS, 'gz', threads=2)
+        self.assertEqual(
+            manifest['sha256'], hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(
+            manifest['md5'], hashlib.md5(self.content).hexdigest())
+        self.assertEqual(manifest['size'], len(self.content))
+        self.assertFalse(path.exists(self.image))
+        with gzip.open(f'{self.image}.gz', 'rb') as fd:
+            self.assertEqual(fd.read(), self.content)
+
+    @mock.patch.dict(postbuild.COMPRESSORS, {'gz': broken_compressor})
+    def test_failed_compression(self):
+        with self.assertRaisesRegex(Exception, 'compression failed'):
+            postbuild.process_image(
+                self.image, 'raw', postbuild.DIGESTS, 'gz', threads=2)
+        self.assertEqual(os.listdir(self.folder), ['image.raw'])
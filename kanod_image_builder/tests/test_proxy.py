@@ -0,0 +1,200 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Caching download proxy against a local upstream server.'''
+
+import http.client
+import os
+from os import path
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from typing import Dict, Optional  # noqa: H301
+
+from kanod_image_builder import proxy
+from kanod_image_builder.tests import upstream
+
+CONTENT = bytes(range(256)) * 1024
+PART = 64 * 1024
+
+
+class TestDownloadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.upstream = upstream.Upstream({'/file': CONTENT})
+        self.url = f'{self.upstream.url}/file'
+        self.cache = proxy.DownloadCache(self.folder)
+
+    def tearDown(self):
+        self.upstream.stop()
+        shutil.rmtree(self.folder)
+
+    def read(self, filename: str) -> bytes:
+        with open(filename, 'rb') as fd:
+            return fd.read()
+
+    def test_miss_then_hit(self):
+        (blob, meta) = self.cache.get(self.url, {})
+        self.assertEqual(self.read(blob), CONTENT)
+        self.assertEqual(meta['size'], len(CONTENT))
+        count = len(self.upstream.requests)
+        (blob, _) = self.cache.get(self.url, {}, offline=True)
+        self.assertEqual(self.read(blob), CONTENT)
+        self.assertEqual(len(self.upstream.requests), count)
+
+    def test_without_ranges(self):
+        self.upstream.ranges = False
+        (blob, _) = self.cache.get(self.url, {})
+        self.assertEqual(self.read(blob), CONTENT)
+        self.assertEqual(self.upstream.methods('/file'), ['GET'])
+
+    @mock.patch.object(proxy, 'PART_SIZE', PART)
+    def test_resumed_ranges(self):
+        self.upstream.failing_ranges = {2 * PART}
+        with self.assertRaisesRegex(Exception, '503'):
+            self.cache.get(self.url, {})
+        self.assertEqual(len(os.listdir(self.cache.partial)), 2)
+        self.upstream.failing_ranges = set()
+        self.upstream.requests = []
+        (blob, _) = self.cache.get(self.url, {})
+        self.assertEqual(self.read(blob), CONTENT)
+        # The probe and the part that failed.
+        ranges = [h['Range'] for (_, _, h) in self.upstream.requests]
+        self.assertEqual(
+            ranges, ['bytes=0-0', f'bytes={2 * PART}-{3 * PART - 1}'])
+        self.assertEqual(os.listdir(self.cache.partial), [])
+
+    def test_revalidation(self):
+        self.cache.get(self.url, {})
+        self.upstream.requests = []
+        (blob, _) = self.cache.get(self.url, {})
+        self.assertEqual(self.read(blob), CONTENT)
+        [(_, _, headers)] = self.upstream.requests
+        self.assertIn('If-None-Match', headers)
+
+    def test_changed_upstream(self):
+        self.cache.get(self.url, {})
+        self.upstream.files['/file'] = b'new content'
+        (blob, meta) = self.cache.get(self.url, {})
+        self.assertEqual(self.read(blob), b'new content')
+        self.assertEqual(meta['size'], 11)
+
+    def test_stale_on_server_error(self):
+        self.cache.get(self.url, {})
+        self.upstream.status = 503
+        (blob, _) = self.cache.get(self.url, {})
+        self.assertEqual(self.read(blob), CONTENT)
+
+    def test_stale_when_upstream_is_down(self):
+        self.cache.get(self.url, {})
+        self.upstream.stop()
+        (blob, _) = self.cache.get(self.url, {})
+        self.assertEqual(self.read(blob), CONTENT)
+
+    def test_offline_miss(self):
+        with self.assertRaises(proxy.NotCached):
+            self.cache.get(self.url, {}, offline=True)
+        self.assertEqual(self.upstream.requests, [])
+
+
+class TestCachingProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.upstream = upstream.Upstream({'/file': CONTENT})
+        self.url = f'{self.upstream.url}/file'
+        self.proxy = self.start(False)
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.upstream.stop()
+        shutil.rmtree(self.folder)
+
+    def start(self, offline: bool) -> proxy.CachingProxy:
+        server = proxy.CachingProxy(
+            proxy.DownloadCache(path.join(self.folder, 'cache')), None,
+            offline)
+        server.start()
+        return server
+
+    def call(
+        self, method: str, headers: Optional[Dict[str, str]] = None,
+        server: Optional[proxy.CachingProxy] = None
+    ):
+        server = server or self.proxy
+        connection = http.client.HTTPConnection(
+            '127.0.0.1', server.server_address[1], timeout=proxy.TIMEOUT)
+        try:
+            connection.request(method, self.url, headers=headers or {})
+            response = connection.getresponse()
+            return (response.status, dict(response.headers), response.read())
+        finally:
+            connection.close()
+
+    def test_get(self):
+        (status, headers, body) = self.call('GET')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, CONTENT)
+        self.assertEqual(headers['Content-Length'], str(len(CONTENT)))
+
+    def test_range(self):
+        (status, headers, body) = self.call('GET', {'Range': 'bytes=10-19'})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, CONTENT[10:20])
+        self.assertEqual(
+            headers['Content-Range'], f'bytes 10-19/{len(CONTENT)}')
+        (status, _, body) = self.call('GET', {'Range': 'bytes=-5'})
+        self.assertEqual((status, body), (206, CONTENT[-5:]))
+        (status, _, _) = self.call(
+            'GET', {'Range': f'bytes={len(CONTENT)}-'})
+        self.assertEqual(status, 416)
+
+    def test_head_miss_is_not_cached(self):
+        (status, headers, body) = self.call('HEAD')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'')
+        self.assertEqual(headers['Content-Length'], str(len(CONTENT)))
+        self.assertEqual(self.upstream.methods('/file'), ['HEAD'])
+        self.assertIsNone(self.proxy.cache.lookup(self.url))
+
+    def test_head_hit(self):
+        self.call('GET')
+        self.upstream.requests = []
+        (status, headers, body) = self.call('HEAD')
+        self.assertEqual((status, body), (200, b''))
+        self.assertEqual(headers['Content-Length'], str(len(CONTENT)))
+        self.assertEqual(self.upstream.requests, [])
+
+    def test_upstream_error(self):
+        self.upstream.status = 404
+        (status, _, _) = self.call('GET')
+        self.assertEqual(status, 404)
+
+    def test_offline(self):
+        offline = self.start(True)
+        try:
+            (status, _, _) = self.call('GET', server=offline)
+            self.assertEqual(status, 504)
+            (status, _, _) = self.call('HEAD', server=offline)
+            self.assertEqual(status, 504)
+            self.call('GET')
+            self.upstream.requests = []
+            (status, _, body) = self.call('GET', server=offline)
+            self.assertEqual((status, body), (200, CONTENT))
+            self.assertEqual(self.upstream.requests, [])
+        finally:
+            offline.stop()
@@ -0,0 +1,184 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Build service run end to end with a fake disk-image-create.
+
+The service is started as a separate process through serve.main. The
+builder puts the folder of its python interpreter first in the PATH of
+diskimage-builder: the interpreter is linked in a temporary folder next to
+the fake disk-image-create. The elements of diskimage-builder used by the
+builds are replaced by empty elements so that the pre-flight check does not
+need diskimage-builder.
+'''
+
+import json
+import os
+from os import path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from urllib import error as urlerror
+from urllib import request
+
+FAKE_DIB = '''#!/bin/bash
+# Records its arguments, prints hook messages and writes the image.
+set -eu
+echo "$*" >> "$(dirname "$0")/calls"
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) output=$2; shift ;;
+    esac
+    shift
+done
+echo "dib-run-parts Running /tmp/hooks/root.d/10-fake"
+echo "dib-run-parts 10-fake completed"
+if [ "${DIB_IMAGE_SIZE:-}" = 13 ]; then
+    echo "fake failure" >&2
+    exit 1
+fi
+echo "image of ${DIB_RELEASE:-}" > "$output"
+'''
+# Elements of diskimage-builder used by the default build and what they
+# provide.
+DIB_ELEMENTS = {
+    'block-device-efi': [], 'bootloader': [], 'install-bin': [],
+    'install-static': [], 'openssh-server': [], 'package-installs': [],
+    'pkg-map': [], 'runtime-ssh-host-keys': [], 'source-repositories': [],
+    'ubuntu-minimal': ['operating-system'], 'vm': [],
+}
+ROOT = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+TIMEOUT = 60
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestBuildService(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        bin_dir = path.join(cls.folder, 'bin')
+        os.makedirs(bin_dir)
+        os.symlink(sys.executable, path.join(bin_dir, 'python3'))
+        fake = path.join(bin_dir, 'disk-image-create')
+        with open(fake, 'w', encoding='utf-8') as fd:
+            fd.write(FAKE_DIB)
+        os.chmod(fake, 0o755)
+        dib_elements = path.join(cls.folder, 'dib-elements')
+        for (element, provides) in DIB_ELEMENTS.items():
+            os.makedirs(path.join(dib_elements, element))
+            if len(provides) > 0:
+                with open(path.join(dib_elements, element,
+                                    'element-provides'), 'w') as fd:
+                    fd.write(''.join(f'{p}\n' for p in provides))
+        cls.calls = path.join(bin_dir, 'calls')
+        cls.output = path.join(cls.folder, 'images')
+        cls.port = free_port()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [p for p in [env.get('PYTHONPATH', '')] if p != ''])
+        cls.process = subprocess.Popen(
+            [path.join(bin_dir, 'python3'), '-c',
+             'import sys; from kanod_image_builder import elements, serve; '
+             f'elements.dib_elements_folder = lambda: {dib_elements!r}; '
+             'serve.main(sys.argv[1:])',
+             '--listen', str(cls.port),
+             '--workdir', path.join(cls.folder, 'builds'),
+             '--output-dir', cls.output,
+             '--build-cpus', '1', '--build-memory', '1M',
+             '--build-disk', '1M', '--build-loops', '0',
+             '--loop-devices', '0', '--workspace', 'disk'],
+            cwd=cls.folder, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        line = cls.process.stdout.readline().decode('utf-8')
+        if not line.startswith('Listening'):
+            cls.tearDownClass()
+            raise Exception(f'serve did not start: {line}')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        cls.process.wait(TIMEOUT)
+        cls.process.stdout.close()
+        shutil.rmtree(cls.folder)
+
+    def call(self, method: str, url: str, body=None):
+        req = request.Request(
+            f'http://127.0.0.1:{self.port}{url}', data=body, method=method)
+        try:
+            with request.urlopen(req, timeout=TIMEOUT) as response:
+                return (response.status, response.read())
+        except urlerror.HTTPError as e:
+            return (e.code, e.read())
+
+    def wait(self, id: str):
+        deadline = time.monotonic() + TIMEOUT
+        while time.monotonic() < deadline:
+            (_, body) = self.call('GET', f'/builds/{id}')
+            job = json.loads(body)
+            if job['state'] not in ['queued', 'running']:
+                return job
+            time.sleep(0.2)
+        self.fail(f'build {id} did not finish')
+
+    def test_builds(self):
+        spec = (
+            'builds:\n'
+            '- name: ok\n'
+            '  set: {release: noble}\n'
+            '- name: broken\n'
+            '  set: {image_size: "13"}\n')
+        (status, body) = self.call('POST', '/builds', spec.encode('utf-8'))
+        self.assertEqual(status, 202)
+        [ok, broken] = json.loads(body)['builds']
+        self.assertEqual(ok['name'], 'ok')
+
+        job = self.wait(ok['id'])
+        self.assertEqual(job['state'], 'success', job)
+        image = job['result']['image']
+        self.assertTrue(image.startswith(self.output))
+        with open(image, encoding='utf-8') as fd:
+            self.assertEqual(fd.read(), 'image of noble\n')
+        with open(self.calls, encoding='utf-8') as fd:
+            calls = fd.read()
+        self.assertIn('-t qcow2', calls)
+        self.assertIn('ubuntu-minimal', calls)
+
+        job = self.wait(broken['id'])
+        self.assertEqual(job['state'], 'failed')
+        (status, log) = self.call('GET', f'/builds/{broken["id"]}/log')
+        self.assertEqual(status, 200)
+        self.assertIn(b'fake failure', log)
+
+        (status, body) = self.call('GET', '/builds')
+        self.assertEqual(
+            {job['id'] for job in json.loads(body)},
+            {ok['id'], broken['id']})
+
+    def test_invalid_matrix(self):
+        (status, body) = self.call('POST', '/builds', b'builds: [{}]\n')
+        self.assertEqual(status, 400)
+        self.assertIn('error', json.loads(body))
+
+    def test_unknown_build(self):
+        (status, _) = self.call('GET', '/builds/00042-none')
+        self.assertEqual(status, 404)
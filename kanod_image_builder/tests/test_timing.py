@@ -0,0 +1,117 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Timing reports built from a recorded diskimage-builder log.'''
+
+import json
+from os import path
+import tempfile
+import unittest
+
+from kanod_image_builder import timing
+
+FIXTURES = path.join(path.dirname(__file__), 'fixtures')
+OWNERS = {
+    ('root', '08-debootstrap'): 'ubuntu',
+    ('root', '50-shared-apt-cache'): 'dpkg',
+    ('install', '01-package-installs'): 'package-installs',
+    ('install', '10-install-static-files'): 'install-static',
+}
+
+
+def parse_fixture(name: str) -> timing.TimingParser:
+    parser = timing.TimingParser(OWNERS)
+    with open(path.join(FIXTURES, name), encoding='utf-8') as fd:
+        for line in fd:
+            parser.feed(line, now=0.0)
+    return parser
+
+
+class TestTimingReport(unittest.TestCase):
+
+    def setUp(self):
+        self.report = parse_fixture('dib-run-parts.log').report()
+
+    def test_scripts(self):
+        self.assertEqual(
+            [(s['phase'], s['script'], s['element'])
+             for s in self.report['scripts']],
+            [('root', '08-debootstrap', 'ubuntu'),
+             ('root', '50-shared-apt-cache', 'dpkg'),
+             ('install', '01-package-installs', 'package-installs'),
+             ('install', '10-install-static-files', 'install-static')])
+
+    def test_durations_from_profiling(self):
+        durations = {
+            s['script']: s['duration'] for s in self.report['scripts']}
+        self.assertEqual(durations, {
+            '08-debootstrap': 0.206, '50-shared-apt-cache': 0.104,
+            '01-package-installs': 0.306, '10-install-static-files': 0.106})
+
+    def test_offsets_from_timestamps(self):
+        starts = [s['start'] for s in self.report['scripts']]
+        self.assertEqual(starts, [0.0, 0.113, 0.251, 0.558])
+        self.assertEqual(self.report['total'], 0.685)
+
+    def test_phases(self):
+        self.assertEqual(self.report['phases'], [
+            {'phase': 'root', 'start': 0.0, 'duration': 0.217},
+            {'phase': 'install', 'start': 0.251, 'duration': 0.413}])
+
+    def test_elements_by_duration(self):
+        self.assertEqual(
+            list(self.report['elements']),
+            ['package-installs', 'ubuntu', 'install-static', 'dpkg'])
+
+    def test_unknown_owner(self):
+        parser = timing.TimingParser({})
+        parser.feed('dib-run-parts Running /hooks/root.d/10-a', now=1.0)
+        parser.feed('dib-run-parts 10-a completed', now=3.5)
+        [script] = parser.report()['scripts']
+        self.assertEqual(script['element'], 'unknown')
+        self.assertEqual(script['duration'], 2.5)
+
+
+class TestChromeTrace(unittest.TestCase):
+
+    def test_events(self):
+        report = parse_fixture('dib-run-parts.log').report()
+        events = timing.chrome_trace(report)['traceEvents']
+        self.assertEqual(
+            [e['name'] for e in events if e['ph'] == 'M'],
+            ['thread_name', 'thread_name'])
+        phases = [e for e in events if e.get('cat') == 'phase']
+        self.assertEqual(
+            [(e['name'], e['tid']) for e in phases],
+            [('root', 1), ('install', 1)])
+        scripts = [e for e in events if e['ph'] == 'X' and e['tid'] == 2]
+        self.assertEqual(len(scripts), 4)
+        install = scripts[2]
+        self.assertEqual(install['name'], '01-package-installs')
+        self.assertEqual(install['cat'], 'install')
+        self.assertAlmostEqual(install['ts'], 251000, delta=1)
+        self.assertAlmostEqual(install['dur'], 306000, delta=1)
+        self.assertEqual(install['args'], {'element': 'package-installs'})
+
+    def test_write_reports(self):
+        report = parse_fixture('dib-run-parts.log').report()
+        with tempfile.TemporaryDirectory() as folder:
+            image = path.join(folder, 'img.qcow2')
+            timing.write_reports(report, image)
+            with open(f'{image}.timing.json', encoding='utf-8') as fd:
+                self.assertEqual(json.load(fd), report)
+            with open(f'{image}.trace.json', encoding='utf-8') as fd:
+                trace = json.load(fd)
+            self.assertEqual(trace['displayTimeUnit'], 'ms')
+            self.assertEqual(len(trace['traceEvents']), 8)
@@ -0,0 +1,122 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''In-memory HTTP server standing for upstream servers in tests.'''
+
+import hashlib
+from http import server
+import re
+import threading
+
+from typing import Dict, List, Optional, Set, Tuple  # noqa: H301
+
+RANGE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class UpstreamHandler(server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.answer(True)
+
+    def do_HEAD(self):
+        self.answer(False)
+
+    def do_PUT(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.record(self)
+        if self.server.status is not None:
+            self.send_error(self.server.status)
+            return
+        self.server.files[self.path] = body
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def answer(self, body: bool):
+        self.server.record(self)
+        if self.server.status is not None:
+            self.send_error(self.server.status)
+            return
+        content = self.server.files.get(self.path, None)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+        if self.headers.get('If-None-Match', None) == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        (start, end, status) = (0, len(content) - 1, 200)
+        match = RANGE.match(self.headers.get('Range', ''))
+        if match is not None and self.server.ranges:
+            start = int(match.group(1))
+            if match.group(2) != '':
+                end = min(end, int(match.group(2)))
+            status = 206
+            if start in self.server.failing_ranges:
+                self.send_error(503)
+                return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        if status == 206:
+            self.send_header(
+                'Content-Range', f'bytes {start}-{end}/{len(content)}')
+        self.end_headers()
+        if body:
+            self.wfile.write(content[start:end + 1])
+
+
+class Upstream(server.ThreadingHTTPServer):
+    '''Server of files kept in memory, recording the requests it receives
+
+    status forces the answer to every request. Ranges starting at an
+    offset of failing_ranges are answered with 503.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, files: Optional[Dict[str, bytes]] = None):
+        super().__init__(('127.0.0.1', 0), UpstreamHandler)
+        self.files = dict(files or {})
+        self.requests: List[Tuple[str, str, Dict[str, str]]] = []
+        self.status: Optional[int] = None
+        self.ranges = True
+        self.failing_ranges: Set[int] = set()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def record(self, handler: UpstreamHandler):
+        with self.lock:
+            self.requests.append(
+                (handler.command, handler.path, dict(handler.headers)))
+
+    def methods(self, path: str) -> List[str]:
+        '''Methods of the requests received for a path'''
+        with self.lock:
+            return [m for (m, p, _) in self.requests if p == path]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,181 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Timing of the phases and scripts of a diskimage-builder run.
+
+The output of disk-image-create is parsed line by line. Script boundaries
+come from dib-run-parts messages and durations from the profiling table it
+prints at the end of each phase. Lines are timestamped by the outfilter of
+diskimage-builder; the time of reception is used otherwise.
+'''
+
+import datetime
+import json
+import os
+from os import path
+import re
+import time
+
+from typing import Any, Dict, List, Optional, Tuple  # noqa: H301
+
+from kanod_image_builder import elements
+
+TIMESTAMP = re.compile(
+    r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{3}) \| (.*)$')
+RUNNING = re.compile(r'^dib-run-parts Running (\S+)/([^/\s]+)\.d/(\S+)$')
+COMPLETED = re.compile(r'^dib-run-parts (\S+) completed$')
+TARGET = re.compile(r'^dib-run-parts Target: ([^/\s]+)\.d$')
+PROFILE = re.compile(r'^dib-run-parts (\S+)\s+(\d+\.\d+)$')
+END_PROFILE = re.compile(r'^dib-run-parts -+ END PROFILING -+$')
+
+
+def script_owners(elements_path: str) -> Dict[Tuple[str, str], str]:
+    '''Map (phase, script) to the name of the element defining it'''
+    owners: Dict[Tuple[str, str], str] = {}
+    for (element, element_dir) in elements.element_index(
+            elements_path).items():
+        for hook_dir in os.listdir(element_dir):
+            if not hook_dir.endswith('.d'):
+                continue
+            hook_path = path.join(element_dir, hook_dir)
+            if not path.isdir(hook_path):
+                continue
+            for script in os.listdir(hook_path):
+                owners.setdefault((hook_dir[:-2], script), element)
+    return owners
+
+
+class TimingParser:
+    '''Accumulates the timing of scripts from the output of a build'''
+
+    def __init__(self, owners: Dict[Tuple[str, str], str]):
+        self.owners = owners
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        self.scripts: List[Dict[str, Any]] = []
+        self.running: Dict[str, Dict[str, Any]] = {}
+        self.profile_phase: Optional[str] = None
+
+    def feed(self, line: str, now: Optional[float] = None):
+        line = line.rstrip('\n')
+        match = TIMESTAMP.match(line)
+        if match is not None:
+            stamp = datetime.datetime.strptime(
+                match.group(1), '%Y-%m-%d %H:%M:%S.%f').replace(
+                    tzinfo=datetime.timezone.utc).timestamp()
+            line = match.group(2)
+        else:
+            stamp = time.time() if now is None else now
+        if self.start is None:
+            self.start = stamp
+        self.end = stamp
+        line = line.strip()
+        match = RUNNING.match(line)
+        if match is not None:
+            (phase, script) = (match.group(2), match.group(3))
+            entry = {
+                'phase': phase, 'script': script,
+                'element': self.owners.get((phase, script), None),
+                'start': stamp, 'duration': None}
+            self.scripts.append(entry)
+            self.running[script] = entry
+            return
+        match = COMPLETED.match(line)
+        if match is not None:
+            entry = self.running.pop(match.group(1), None)
+            if entry is not None:
+                entry['duration'] = stamp - entry['start']
+            return
+        match = TARGET.match(line)
+        if match is not None:
+            self.profile_phase = match.group(1)
+            return
+        if self.profile_phase is not None:
+            if END_PROFILE.match(line):
+                self.profile_phase = None
+                return
+            match = PROFILE.match(line)
+            if match is not None:
+                self.set_duration(
+                    self.profile_phase, match.group(1),
+                    float(match.group(2)))
+
+    def set_duration(self, phase: str, script: str, duration: float):
+        '''Use the duration measured by dib-run-parts'''
+        for entry in reversed(self.scripts):
+            if entry['phase'] == phase and entry['script'] == script:
+                entry['duration'] = duration
+                return
+
+    def report(self) -> Dict[str, Any]:
+        '''Timing report with durations by script, phase and element'''
+        start = self.start or 0.0
+        phases: Dict[str, Dict[str, Any]] = {}
+        elements: Dict[str, float] = {}
+        scripts = []
+        for entry in self.scripts:
+            duration = entry['duration'] or 0.0
+            offset = entry['start'] - start
+            phase = phases.setdefault(
+                entry['phase'],
+                {'phase': entry['phase'], 'start': offset, 'end': offset})
+            phase['end'] = max(phase['end'], offset + duration)
+            element = entry['element'] or 'unknown'
+            elements[element] = elements.get(element, 0.0) + duration
+            scripts.append({
+                'phase': entry['phase'], 'script': entry['script'],
+                'element': element, 'start': round(offset, 3),
+                'duration': round(duration, 3)})
+        return {
+            'total': round((self.end or start) - start, 3),
+            'phases': [
+                {'phase': p['phase'], 'start': round(p['start'], 3),
+                 'duration': round(p['end'] - p['start'], 3)}
+                for p in phases.values()],
+            'elements': {
+                element: round(duration, 3)
+                for (element, duration) in sorted(
+                    elements.items(), key=lambda e: -e[1])},
+            'scripts': scripts,
+        }
+
+
+def chrome_trace(report: Dict[str, Any]) -> Dict[str, Any]:
+    '''Trace in the Chrome trace event format (readable by Perfetto)'''
+    events: List[Dict[str, Any]] = [
+        {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 1,
+         'args': {'name': 'phases'}},
+        {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 2,
+         'args': {'name': 'scripts'}},
+    ]
+    for phase in report['phases']:
+        events.append({
+            'name': phase['phase'], 'cat': 'phase', 'ph': 'X',
+            'pid': 1, 'tid': 1, 'ts': int(phase['start'] * 1e6),
+            'dur': int(phase['duration'] * 1e6)})
+    for script in report['scripts']:
+        events.append({
+            'name': script['script'], 'cat': script['phase'], 'ph': 'X',
+            'pid': 1, 'tid': 2, 'ts': int(script['start'] * 1e6),
+            'dur': int(script['duration'] * 1e6),
+            'args': {'element': script['element']}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_reports(report: Dict[str, Any], image: str):
+    '''Write image.timing.json and image.trace.json'''
+    with open(f'{image}.timing.json', 'w', encoding='utf-8') as fd:
+        json.dump(report, fd, indent=2)
+    with open(f'{image}.trace.json', 'w', encoding='utf-8') as fd:
+        json.dump(chrome_trace(report), fd)
@@ -0,0 +1,254 @@
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Placement of the workspace of a build in memory or on disk.
+
+diskimage-builder stages the chroot and the image it produces in two
+folders of TMP_DIR. By default, it mounts a tmpfs on each of them as soon as
+the host has 4 GB of memory. Each of them may use half of the memory of the
+host whatever the cgroup limits and the number of concurrent builds are.
+
+The builder decides instead. The workspace may hold both the chroot and the
+image file while the chroot is copied into the image: it needs up to twice
+the size of the image, given by the block-device layout or by
+DIB_IMAGE_SIZE. A tmpfs bounded to this size is mounted on TMP_DIR only when
+the memory available on the host (within the memory limit of the builder),
+less the memory reserved for the processes of the build and the tmpfs of the
+other running builds, leaves room for it. Otherwise the workspace stays on
+disk and diskimage-builder applies its own policy.
+'''
+
+import os
+import re
+import subprocess
+import tempfile
+import threading
+
+import yaml
+
+from typing import Any, Dict, List, Optional  # noqa: H301
+
+from kanod_image_builder import elements as element_graph
+from kanod_image_builder import parallelism as resources
+
+PLACEMENTS = ['auto', 'tmpfs', 'disk']
+# Memory kept for the processes of the build (package managers, compilers).
+RESERVED_MEMORY = 4 << 30
+# Size of images without layout: diskimage-builder sizes them after their
+# content.
+DEFAULT_IMAGE_SIZE = 8 << 30
+# Configurations searched in each element, like diskimage-builder.
+BLOCK_DEVICE_CONFIGS = ['block-device-amd64.yaml', 'block-device-default.yaml']
+# Units of the sizes of the block-device configurations.
+DIB_SIZE_UNITS = {
+    'TiB': 1024 ** 4, 'GiB': 1024 ** 3, 'MiB': 1024 ** 2, 'KiB': 1024,
+    'TB': 1000 ** 4, 'GB': 1000 ** 3, 'MB': 1000 ** 2, 'KB': 1000,
+    'T': 1000 ** 4, 'G': 1000 ** 3, 'M': 1000 ** 2, 'K': 1000,
+    'B': 1, '': 1,
+}
+DIB_SIZE = re.compile(r'^([\d.]*) ?([a-zA-Z]*)$')
+# Memory of the tmpfs workspaces placed by the running builds of this
+# process. It is not used yet when the next decision is taken but will be.
+_reserved = 0
+_reserved_lock = threading.Lock()
+
+
+def reserve(size: int):
+    '''Reserve (or release if negative) memory for a tmpfs workspace'''
+    global _reserved
+    with _reserved_lock:
+        _reserved += size
+
+
+def parse_dib_size(value: Any) -> Optional[int]:
+    '''Parse an absolute size like diskimage-builder
+
+    :return: the size in bytes or None for empty or relative sizes.
+    '''
+    match = DIB_SIZE.match(str(value).strip())
+    if (match is None or match.group(0) == '' or
+            match.group(2) not in DIB_SIZE_UNITS):
+        return None
+    count = float(match.group(1)) if match.group(1) != '' else 1
+    return int(count * DIB_SIZE_UNITS[match.group(2)])
+
+
+def block_device_config(
+    env: Dict[str, str], elements: List[str], elements_path: str
+) -> Any:
+    '''Block-device configuration used by diskimage-builder for a build'''
+    config = env.get('DIB_BLOCK_DEVICE_CONFIG', '')
+    if config.startswith('file://'):
+        with open(config[len('file://'):], encoding='utf-8') as fd:
+            return yaml.safe_load(fd)
+    if config != '':
+        return yaml.safe_load(config)
+    index = element_graph.element_index(elements_path)
+    for element in element_graph.closure(elements, index):
+        if element not in index:
+            continue
+        for name in BLOCK_DEVICE_CONFIGS:
+            filename = os.path.join(index[element], name)
+            if os.path.isfile(filename):
+                with open(filename, encoding='utf-8') as fd:
+                    return yaml.safe_load(fd)
+    return None
+
+
+def image_size(
+    env: Dict[str, str], elements: List[str], elements_path: str
+) -> Optional[int]:
+    '''Size of the disk images of a build
+
+    :return: the size in bytes or None if diskimage-builder computes it
+        from the content of the image.
+    '''
+    default = None
+    if env.get('DIB_IMAGE_SIZE', '') != '':
+        default = int(float(env['DIB_IMAGE_SIZE']) * (1 << 30))
+    config = block_device_config(env, elements, elements_path)
+    loops = [
+        item['local_loop'] for item in config or []
+        if isinstance(item, dict) and 'local_loop' in item]
+    if len(loops) == 0:
+        return default
+    total = 0
+    for loop in loops:
+        size = parse_dib_size(loop.get('size', '')) or default
+        if size is None:
+            return None
+        total += size
+    return total
+
+
+def decide(
+    mode: str, env: Dict[str, str], elements: List[str],
+    elements_path: str
+) -> Dict[str, Any]:
+    '''Place the workspace of a build
+
+    :param mode: auto, tmpfs or disk.
+    :param env: environment of the build.
+    :param elements: elements of the build.
+    :return: the placement, the size of the workspace and, for auto, the
+        memory budget and the reason of the decision.
+    '''
+    if mode not in PLACEMENTS:
+        raise Exception(f'Unknown workspace placement {mode}')
+    size = image_size(env, elements, elements_path) or DEFAULT_IMAGE_SIZE
+    result: Dict[str, Any] = {'placement': mode, 'size': 2 * size}
+    if mode != 'auto':
+        result['reason'] = 'requested'
+        if mode == 'tmpfs':
+            reserve(result['size'])
+        return result
+    global _reserved
+    available = min(
+        resources.memory_limit(), resources.meminfo().get('MemAvailable', 0))
+    with _reserved_lock:
+        budget = available - RESERVED_MEMORY - _reserved
+        result['budget'] = max(0, budget)
+        if budget >= result['size']:
+            result['placement'] = 'tmpfs'
+            result['reason'] = 'enough memory'
+            # Reserved under the lock: concurrent decisions take it into
+            # account.
+            _reserved += result['size']
+        else:
+            result['placement'] = 'disk'
+            result['reason'] = 'not enough memory'
+    return result
+
+
+class Workspace:
+    '''TMP_DIR of a build on disk or on a tmpfs bounded to its size'''
+
+    def __init__(self, decision: Dict[str, Any], folder: Optional[str]):
+        '''Workspace of a build
+
+        :param decision: the placement decided for the build.
+        :param folder: TMP_DIR of the build, if it has a private one.
+        '''
+        self.decision = decision
+        self.folder = folder
+        self.created = False
+        self.mounted = False
+        # Memory reserved by decide for the tmpfs.
+        self.reserved = (
+            decision['size'] if decision['placement'] == 'tmpfs' else 0)
+
+    def environment(self) -> Dict[str, str]:
+        '''TMP_DIR and the tmpfs policy of diskimage-builder
+
+        diskimage-builder must not mount its own tmpfs in the tmpfs of the
+        workspace or when the disk is requested. A workspace placed on disk
+        for lack of memory keeps the default policy.
+        '''
+        env = {}
+        if self.mounted or self.decision['reason'] == 'requested':
+            env['DIB_NO_TMPFS'] = '1'
+        if self.folder is not None:
+            env['TMP_DIR'] = self.folder
+        return env
+
+    def mount(self, log=None):
+        '''Mount the tmpfs if the workspace is placed in memory
+
+        The workspace falls back to disk if the tmpfs cannot be mounted.
+        '''
+        if self.decision['placement'] != 'tmpfs':
+            return
+        if self.folder is None:
+            self.folder = tempfile.mkdtemp(prefix='kanod-workspace-')
+            self.created = True
+        options = (
+            f'size={self.decision["size"]},mode=0755,'
+            f'uid={os.getuid()},gid={os.getgid()}')
+        process = subprocess.run(
+            ['sudo', 'mount', '-t', 'tmpfs', '-o', options, 'tmpfs',
+             self.folder],
+            stdout=log, stderr=None if log is None else subprocess.STDOUT)
+        if process.returncode == 0:
+            self.mounted = True
+            return
+        reserve(-self.reserved)
+        self.reserved = 0
+        self.decision['placement'] = 'disk'
+        self.decision['reason'] = 'tmpfs mount failed'
+        if self.created:
+            os.rmdir(self.folder)
+            self.folder = None
+            self.created = False
+
+    def release(self, log=None):
+        reserve(-self.reserved)
+        self.reserved = 0
+        if self.mounted:
+            # Lazily: a failed build may leave mounts in the workspace.
+            subprocess.run(
+                ['sudo', 'umount', '--lazy', self.folder], check=True,
+                stdout=log,
+                stderr=None if log is None else subprocess.STDOUT)
+            self.mounted = False
+        if self.created:
+            os.rmdir(self.folder)
+            self.created = False
+
+
+def summary(decision: Dict[str, Any]) -> str:
+    size = decision['size'] >> 30
+    text = f'Workspace on {decision["placement"]} ({size} GiB needed'
+    if 'budget' in decision:
+        text += f', {decision["budget"] >> 30} GiB available'
+    return f'{text}, {decision["reason"]})'
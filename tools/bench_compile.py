@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2026 Orange
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Benchmark of the compilation of configurations on synthetic catalogs.
+
+A catalog of n recipes is generated with the shape of the recipes of
+config.yaml: guards on the target distribution, on flags and on releases,
+negated conditions, templated packages and elements, and '!' removals. The
+catalog is added to the base configuration and compiled for a few flag and
+variable combinations. The median time of compile is printed for each size
+so that its growth with the number of recipes can be checked::
+
+    python3 tools/bench_compile.py --sizes 1000,2000,4000,8000
+'''
+
+import argparse
+import random
+import statistics
+import time
+
+from typing import Any, Dict, List  # noqa: H301
+
+from kanod_image_builder import main as builder
+
+TARGETS = ['ubuntu', 'centos', 'opensuse']
+RELEASES = ['jammy', 'noble', '9-stream', '15.6']
+FLAGS = 20
+VARS = 10
+
+
+def synthetic_catalog(size: int, seed: int = 0) -> Dict[str, Any]:
+    '''Module configuration with size recipes'''
+    rng = random.Random(seed)
+    options: List[Dict[str, Any]] = [
+        {'name': f'bench_flag_{i}', 'kind': 'flag'} for i in range(FLAGS)]
+    options += [
+        {'name': f'bench_var_{i}', 'kind': 'var', 'default': f'v{i}'}
+        for i in range(VARS)]
+    recipes = []
+    for index in range(size):
+        when = [f'target={rng.choice(TARGETS)}']
+        if rng.random() < 0.5:
+            when.append(f'bench_flag_{rng.randrange(FLAGS)}')
+        if rng.random() < 0.3:
+            when.append(f'!release={rng.choice(RELEASES)}')
+        if rng.random() < 0.2:
+            var = rng.randrange(VARS)
+            when.append(f'bench_var_{var}=v{var}')
+        recipe: Dict[str, Any] = {
+            'when': when,
+            'packages': [
+                f'bench-pkg-{rng.randrange(size)}'
+                for _ in range(rng.randrange(1, 6))],
+        }
+        if rng.random() < 0.1:
+            recipe['packages'].append('{{ "bench-tmpl-" ~ target }}')
+        if rng.random() < 0.05:
+            recipe['packages'].append(f'!bench-pkg-{rng.randrange(size)}')
+        if rng.random() < 0.3:
+            recipe['elements'] = [f'bench-element-{index % 50}']
+        recipes.append(recipe)
+    return {'options': options, 'recipes': recipes}
+
+
+def time_compile(
+    catalog: Dict[str, Any], flags: List[str], vars: Dict[str, str]
+) -> float:
+    image_builder = builder.ImageBuilder(validate=False)
+    image_builder.parse('kanod_image_builder')
+    image_builder.add_config('bench', catalog)
+    start = time.perf_counter()
+    image_builder.compile(flags, vars)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', default='1000,2000,4000,8000',
+        help='comma separated numbers of recipes of the catalogs')
+    parser.add_argument(
+        '--repeat', type=int, default=7,
+        help='compilations measured for each size and combination')
+    args = parser.parse_args()
+    combinations = [
+        ([], {'target': 'ubuntu', 'release': 'noble'}),
+        (['bench_flag_1', 'bench_flag_7', 'debug'],
+         {'target': 'centos', 'release': '9-stream'}),
+        ([f'bench_flag_{i}' for i in range(FLAGS)],
+         {'target': 'opensuse', 'release': '15.6'}),
+    ]
+    print(f'{"Recipes":>8}  {"Median (ms)":>12}  {"us/recipe":>10}')
+    for size in [int(s) for s in args.sizes.split(',')]:
+        catalog = synthetic_catalog(size)
+        samples = [
+            time_compile(catalog, flags, vars)
+            for _ in range(args.repeat)
+            for (flags, vars) in combinations]
+        median = statistics.median(samples)
+        print(f'{size:>8}  {median * 1000:>12.1f}  '
+              f'{median * 1e6 / size:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()